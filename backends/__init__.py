@@ -0,0 +1,22 @@
+"""
+Hardware backends: i2c bus, gpio inputs/outputs and the audio player.
+The 'rpi' backend drives the real hardware (smbus, gpiozero, mpv). The 'simulator' backend runs everything in-process,
+so the radio can run without a raspberry pi. Select the backend with Config.BACKEND (env var PIRADIO_BACKEND).
+
+Every backend module provides:
+    i2c_bus(bus) -> object with write_byte_data() and write_i2c_block_data() like smbus.SMBus
+    output_device(pin) -> object with on() and off() like gpiozero.OutputDevice
+    button(pin, pull_up, bounce_time) -> object like gpiozero.Button
+    rotary_encoder(a, b, bounce_time, max_steps, wrap) -> object like gpiozero.RotaryEncoder
+    player(log_handler, audio_device) -> Player (see backends.rpi.MpvPlayer)
+    PlayerShutdown -> exception raised by the player after it has been shut down
+    start() -> called once the radio is set up
+"""
+from config import Config
+
+if Config.BACKEND == 'simulator':
+    from backends import simulator as backend
+else:
+    from backends import rpi as backend
+
+__all__ = ['backend']
@@ -0,0 +1,99 @@
+"""Backend for the raspberry pi: smbus, gpiozero and libmpv"""
+import logging
+from typing import Callable
+
+import mpv
+from gpiozero import Button, OutputDevice, RotaryEncoder
+from smbus import SMBus
+
+LOG = logging.getLogger(__name__)
+
+PlayerShutdown = mpv.ShutdownError
+
+EVENT_NAMES = {
+    mpv.MpvEventID.START_FILE: 'start-file',
+    mpv.MpvEventID.FILE_LOADED: 'file-loaded',
+    mpv.MpvEventID.PLAYBACK_RESTART: 'playback-restart',
+    mpv.MpvEventID.END_FILE: 'end-file',
+    mpv.MpvEventID.SHUTDOWN: 'shutdown',
+}
+
+END_FILE_REASONS = {
+    mpv.MpvEventEndFile.EOF: 'eof',
+    mpv.MpvEventEndFile.RESTARTED: 'restarted',
+    mpv.MpvEventEndFile.ABORTED: 'stop',
+    mpv.MpvEventEndFile.QUIT: 'quit',
+    mpv.MpvEventEndFile.ERROR: 'error',
+    mpv.MpvEventEndFile.REDIRECT: 'redirect',
+}
+
+
+def i2c_bus(bus: int) -> SMBus:
+    return SMBus(bus)
+
+
+def output_device(pin: int) -> OutputDevice:
+    return OutputDevice(pin)
+
+
+def button(pin: int, pull_up: bool, bounce_time: float) -> Button:
+    return Button(pin, pull_up=pull_up, bounce_time=bounce_time)
+
+
+def rotary_encoder(a: int, b: int, bounce_time: float, max_steps: int, wrap: bool) -> RotaryEncoder:
+    return RotaryEncoder(a, b, bounce_time=bounce_time, max_steps=max_steps, wrap=wrap)
+
+
+def player(log_handler: Callable, audio_device: str) -> 'MpvPlayer':
+    return MpvPlayer(log_handler, audio_device)
+
+
+def start():
+    """Nothing to do for real hardware"""
+
+
+class MpvPlayer:
+    """
+    The part of python-mpv.MPV used by the radio.
+    Events are passed to the callbacks as (name, data) with the mpv event name and a dict with the event data.
+    """
+    def __init__(self, log_handler: Callable, audio_device: str):
+        self._mpv = mpv.MPV(log_handler=log_handler, audio_device=audio_device, ytdl=False)
+        self._mpv.set_loglevel('error')
+
+    def play(self, url: str):
+        self._mpv.play(url)
+
+    def stop(self):
+        self._mpv.stop()
+
+    def set_volume(self, volume: int):
+        """@param volume: int, 0-100"""
+        self._mpv.volume = volume
+
+    def pause(self, paused: bool):
+        self._mpv.pause = paused
+
+    def observe_property(self, name: str, handler: Callable):
+        """Call handler(name, value) in the mpv event thread when the property changes"""
+        self._mpv.observe_property(name, handler)
+
+    def on_event(self, callback: Callable[[str, dict], None]):
+        """Call callback(name, data) in the mpv event thread for the events in EVENT_NAMES"""
+        def translate(event):
+            name = EVENT_NAMES.get(event.event_id.value)
+            if name is None:
+                return
+
+            data = {}
+            if name in ('start-file', 'end-file'):
+                data['playlist_entry_id'] = event.data.playlist_entry_id
+            if name == 'end-file':
+                data['reason'] = END_FILE_REASONS.get(event.data.reason, 'unknown')
+            callback(name, data)
+
+        self._mpv.register_event_callback(translate)
+
+    def python_stream(self, name: str) -> Callable:
+        """Decorator to register a generator function as python://name stream"""
+        return self._mpv.python_stream(name)
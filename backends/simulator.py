@@ -0,0 +1,487 @@
+"""
+In-process simulator backend. Runs the radio without raspberry pi, lcd, buttons or mpv.
+    FakeSMBus decodes the lcd command stream into a virtual 16x2 screen
+    FakeButton and FakeRotaryEncoder are driven by a script or by calling press()/rotate()
+    FakePlayer emits mpv-like events for the played urls
+The created devices are kept in BUSES, BUTTONS, ENCODERS and PLAYERS so a script can reach them.
+
+Script format (Config.SIMULATOR_SCRIPT), one command per line. The delay is relative to the previous command:
+    <delay> press toggle|select
+    <delay> release toggle|select
+    <delay> rotate <steps>        negative steps -> counterclockwise
+    <delay> title <icy-title>     set the icy-title of the stream that is playing
+    <delay> fail <url>            playing url ends with an error from now on
+    <delay> stall                 the playing stream stops delivering data: the cache drains, then playback pauses
+    <delay> resume                the stalled stream delivers data again
+    <delay> drop                  the server closes the playing stream (end-file eof)
+    <delay> link <kbit/s>         throughput of the network link (cache-speed), 0 -> unlimited
+    <delay> quit                  shut down the player -> the radio exits
+With Config.SIMULATOR_REPLAY the player events are delivered by dispatcher timers instead of the event thread, so a
+replay (benchmarks/replay.py) can run them on a virtual clock.
+"""
+import heapq
+import itertools
+import logging
+from queue import Empty, Queue
+from threading import Lock, Thread
+from time import monotonic, sleep
+from typing import Callable, Dict, List, Optional, Tuple
+
+import lcd_charset
+from config import Config
+from dispatcher import dispatcher
+
+LOG = logging.getLogger(__name__)
+
+# lcd controller
+CTRLBYTE_COMMAND = 0x00
+CTRLBYTE_DATA = 0x40
+CTRLBYTE_CONTINUE = 0x80
+LCD_LINE_ADDRESSES = (0x00, 0x40)
+LCD_WIDTH = 16
+MAX_BLOCK = 32  # smbus block limit
+
+# player cache
+CACHE_SECONDS = 5.0  # demuxer cache of a healthy stream
+CACHE_TICK = 0.5  # interval of the cache updates
+STREAM_BITRATE = 128  # kbit/s
+
+BUSES: Dict[int, 'FakeSMBus'] = {}
+BUTTONS: Dict[int, 'FakeButton'] = {}
+ENCODERS: List['FakeRotaryEncoder'] = []
+PLAYERS: List['FakePlayer'] = []
+
+
+class PlayerShutdown(Exception):
+    """Raised by FakePlayer after shutdown, like mpv.ShutdownError"""
+
+
+def i2c_bus(bus: int) -> 'FakeSMBus':
+    """Create a FakeSMBus, kept in BUSES"""
+    BUSES[bus] = FakeSMBus(bus)
+    return BUSES[bus]
+
+
+def output_device(pin: int) -> 'FakeOutputDevice':
+    """Create a FakeOutputDevice"""
+    return FakeOutputDevice(pin)
+
+
+def button(pin: int, pull_up: bool, bounce_time: float) -> 'FakeButton':
+    """Create a FakeButton, kept in BUTTONS"""
+    BUTTONS[pin] = FakeButton(pin, pull_up, bounce_time)
+    return BUTTONS[pin]
+
+
+def rotary_encoder(a: int, b: int, bounce_time: float, max_steps: int, wrap: bool) -> 'FakeRotaryEncoder':
+    """Create a FakeRotaryEncoder, kept in ENCODERS"""
+    ENCODERS.append(FakeRotaryEncoder(a, b, bounce_time, max_steps, wrap))
+    return ENCODERS[-1]
+
+
+def player(log_handler: Callable, audio_device: str) -> 'FakePlayer':
+    """Create a FakePlayer, kept in PLAYERS"""
+    PLAYERS.append(FakePlayer(log_handler, audio_device))
+    return PLAYERS[-1]
+
+
+def start():
+    """Run Config.SIMULATOR_SCRIPT in a separate thread"""
+    if Config.SIMULATOR_SCRIPT:
+        Thread(target=run_script, args=(Config.SIMULATOR_SCRIPT,), name="simulator_script", daemon=True).start()
+
+
+class FakeSMBus:
+    """I2C bus with a virtual lcd. Keeps DDRAM, CGRAM and the traffic counters"""
+    def __init__(self, bus: int):
+        self.bus = bus
+        self.ddram = bytearray([0x20] * 0x80)
+        self.cgram = bytearray(64)
+        self.transactions = 0
+        self.bytes = 0  # bytes following the address byte
+        self._address = 0
+        self._cgram_mode = False
+        self._lock = Lock()
+
+    @property
+    def lines(self) -> List[str]:
+        """Text on the virtual screen"""
+        return [lcd_charset.decode(self.ddram[start:start + LCD_WIDTH], self.cgram) for start in LCD_LINE_ADDRESSES]
+
+    def write_byte_data(self, addr: int, ctrl: int, value: int):
+        """Write one byte, like smbus.SMBus"""
+        self.write_i2c_block_data(addr, ctrl, [value])
+
+    def write_i2c_block_data(self, _addr: int, ctrl: int, data: List[int]):
+        """Write a block, like smbus.SMBus. Raises OSError for a block longer than the smbus limit"""
+        if len(data) > MAX_BLOCK:
+            raise OSError(f"smbus block too long: {len(data)} bytes")
+
+        with self._lock:
+            old = bytes(self.ddram)
+            self.transactions += 1
+            self.bytes += 1 + len(data)
+            stream = iter(data)
+            for value in stream:
+                # Co bit set: one byte follows, then the next control byte
+                if ctrl & CTRLBYTE_CONTINUE:
+                    self._write(ctrl, value)
+                    ctrl = next(stream, CTRLBYTE_COMMAND)
+                else:
+                    self._write(ctrl, value)
+            changed = old != self.ddram
+
+        if changed:
+            LOG.info("LCD |%s|%s|", *self.lines)
+
+    def _write(self, ctrl: int, value: int):
+        if ctrl & CTRLBYTE_DATA:
+            self._data(value)
+        else:
+            self._command(value)
+
+    def _command(self, cmd: int):
+        if cmd & 0x80:  # set DDRAM address
+            self._address = cmd & 0x7f
+            self._cgram_mode = False
+        elif cmd & 0x40:  # set CGRAM address
+            self._address = cmd & 0x3f
+            self._cgram_mode = True
+        elif cmd in (0x02, 0x03):  # return home
+            self._address = 0
+            self._cgram_mode = False
+        elif cmd == 0x01:  # clear display
+            self.ddram[:] = bytes([0x20] * len(self.ddram))
+            self._address = 0
+            self._cgram_mode = False
+
+    def _data(self, value: int):
+        if self._cgram_mode:
+            self.cgram[self._address] = value
+            self._address = (self._address + 1) & 0x3f
+        else:
+            self.ddram[self._address] = value
+            self._address = (self._address + 1) & 0x7f
+
+
+class FakeOutputDevice:
+    """Stand-in for a gpiozero OutputDevice"""
+    def __init__(self, pin: int):
+        self.pin = pin
+        self.value = 0
+
+    def on(self):
+        """Switch the output on"""
+        self.value = 1
+
+    def off(self):
+        """Switch the output off"""
+        self.value = 0
+
+
+class FakeButton:
+    """Button with the gpiozero handlers. press() and release() call the handlers in the calling thread"""
+    def __init__(self, pin: int, pull_up: bool, bounce_time: float):
+        self.pin = pin
+        self.pull_up = pull_up
+        self.bounce_time = bounce_time
+        self.is_active = False
+        self.when_pressed: Optional[Callable] = None
+        self.when_released: Optional[Callable] = None
+
+    def press(self):
+        """Press the button and call when_pressed"""
+        self.is_active = True
+        if self.when_pressed is not None:
+            self.when_pressed()
+
+    def release(self):
+        """Release the button and call when_released"""
+        self.is_active = False
+        if self.when_released is not None:
+            self.when_released()
+
+
+class FakeRotaryEncoder:
+    """Rotary encoder with the gpiozero handlers. rotate() calls the handlers in the calling thread"""
+    def __init__(self, a: int, b: int, bounce_time: float, max_steps: int, wrap: bool):
+        self.pins = (a, b)
+        self.bounce_time = bounce_time
+        self.max_steps = max_steps
+        self.wrap = wrap
+        self.steps = 0
+        self.when_rotated_clockwise: Optional[Callable] = None
+        self.when_rotated_counter_clockwise: Optional[Callable] = None
+
+    def rotate(self, steps: int):
+        """
+        Turn the encoder one detent at a time
+        @param steps: int, negative -> counterclockwise
+        """
+        for _ in range(abs(steps)):
+            self.steps += 1 if steps > 0 else -1
+            if self.wrap and abs(self.steps) > self.max_steps:
+                self.steps = -self.max_steps if self.steps > 0 else self.max_steps
+            handler = self.when_rotated_clockwise if steps > 0 else self.when_rotated_counter_clockwise
+            if handler is not None:
+                handler()
+
+
+class FakePlayer:
+    """
+    Player emitting mpv-like events and property changes from its own 'event thread', like libmpv.
+    A url starts playing after tune_delay seconds, unless it is in fail_urls. python:// streams are read like mpv does.
+    With Config.SIMULATOR_REPLAY there is no event thread, the events are delivered in the dispatcher thread.
+    The demuxer cache is simulated: it drains while the stream is stalled and playback pauses when it is empty.
+    """
+    def __init__(self, log_handler: Callable, audio_device: str):
+        self.log_handler = log_handler
+        self.audio_device = audio_device
+        self.tune_delay = Config.SIMULATOR_TUNE_DELAY
+        self.fail_urls = set()
+        self.titles: Dict[str, str] = {}  # url -> icy-title
+        self.url: Optional[str] = None
+        self.volume = 100
+        self.paused = False
+        self.properties = {'core-idle': True, 'metadata': None, 'demuxer-cache-duration': None,
+                           'paused-for-cache': False, 'cache-speed': None}
+        self.stalled = False
+        self.link = 0  # kbit/s, 0 -> unlimited
+        self._observers: Dict[str, List[Callable]] = {}
+        self._callbacks: List[Callable] = []
+        self._streams: Dict[str, Callable] = {}
+        self._entry_ids = itertools.count(1)
+        self._entry_id = 0
+        self._shutdown = False
+        self._seq = itertools.count()
+        self._scheduled = []  # heap with (due, seq, entry_id, action, args)
+        self._queue = Queue()
+        if not Config.SIMULATOR_REPLAY:
+            Thread(target=self._event_thread, name="fake_mpv_event_thread", daemon=True).start()
+
+    def play(self, url: str):
+        """Start playing url, like mpv.MPV.play"""
+        self._check_alive()
+        if self.url is not None:
+            self._post(self._end, 'stop', self._entry_id)
+        self._entry_id = next(self._entry_ids)
+        self.url = url
+        self._post(self.emit, 'start-file', {'playlist_entry_id': self._entry_id})
+        if url in self.fail_urls:
+            self._schedule(self.tune_delay, self._end, 'error', self._entry_id)
+            return
+
+        self._schedule(self.tune_delay / 2, self.emit, 'file-loaded', {})
+        self._schedule(self.tune_delay, self._start_audio)
+
+    def stop(self):
+        """Stop playing, like mpv.MPV.stop"""
+        self._check_alive()
+        if self.url is not None:
+            self._post(self._end, 'stop', self._entry_id)
+            self._entry_id = next(self._entry_ids)  # drop the scheduled events
+            self.url = None
+
+    def set_volume(self, volume: int):
+        """Set the volume property"""
+        self._check_alive()
+        self.volume = volume
+
+    def pause(self, paused: bool):
+        """Pause playback, a python stream isn't read while paused"""
+        self._check_alive()
+        self.paused = paused
+        self.set_property('core-idle', paused or self.url is None)
+
+    def observe_property(self, name: str, handler: Callable):
+        """Register a property observer, like mpv.MPV.observe_property"""
+        self._observers.setdefault(name, []).append(handler)
+
+    def on_event(self, callback: Callable[[str, dict], None]):
+        """Call callback(name, data) in the event thread for the player events"""
+        self._callbacks.append(callback)
+
+    def python_stream(self, name: str) -> Callable:
+        """Decorator registering a python stream, like mpv.MPV.python_stream"""
+        def register(generator_function):
+            self._streams[name] = generator_function
+            generator_function.unregister = lambda: self._streams.pop(name, None)
+            return generator_function
+        return register
+
+    def stall(self, stalled: bool = True):
+        """Stop (or restart) the data of the playing stream"""
+        self.stalled = stalled
+
+    def drop(self):
+        """The server closes the playing stream"""
+        self._post(self._end, 'eof', self._entry_id)
+
+    def set_property(self, name: str, value):
+        """Change a property and notify the observers in the event thread"""
+        self._post(self._set_property, name, value)
+
+    def emit(self, name: str, data: dict):
+        """Call the event callbacks. Only call this in the event thread (or through a script)"""
+        for callback in self._callbacks:
+            callback(name, data)
+
+    def shutdown(self):
+        """Shut down the player: the next calls raise PlayerShutdown"""
+        self._shutdown = True
+        self._post(self.emit, 'shutdown', {})
+
+    def _check_alive(self):
+        if self._shutdown:
+            raise PlayerShutdown("FakePlayer has been shut down")
+
+    def _start_audio(self):
+        if self.url.startswith('python://'):
+            stream = self._streams.get(self.url[len('python://'):])
+            if stream is None:
+                self._end('error', self._entry_id)
+                return
+            Thread(target=self._read_stream, args=(stream, self._entry_id), name="fake_mpv_stream", daemon=True).start()
+
+        self.stalled = False
+        self._set_property('core-idle', False)
+        self._set_property('paused-for-cache', False)
+        self._set_property('demuxer-cache-duration', CACHE_SECONDS)
+        self._schedule(CACHE_TICK, self._cache_tick)
+        self.emit('playback-restart', {})
+        if self.url in self.titles:
+            self._set_property('metadata', {'icy-title': self.titles[self.url]})
+
+    def _read_stream(self, stream: Callable, entry_id: int):
+        """Consume a python stream at STREAM_BITRATE until another url is played"""
+        for chunk in stream():
+            if not chunk or entry_id != self._entry_id:
+                break
+            sleep(len(chunk) * 8 / (STREAM_BITRATE * 1000))
+            while self.paused and entry_id == self._entry_id:
+                sleep(CACHE_TICK)
+
+    def _cache_tick(self):
+        """Drain the cache while stalled, refill it otherwise. Playback pauses when it is empty"""
+        cache = self.properties['demuxer-cache-duration'] or 0.0
+        if self.stalled:
+            cache = max(0.0, cache - CACHE_TICK)
+        else:
+            cache = min(CACHE_SECONDS, cache + 2 * CACHE_TICK)
+        self._set_property('demuxer-cache-duration', cache)
+        speed = 0 if self.stalled else min(self.link or STREAM_BITRATE, STREAM_BITRATE)
+        self._set_property('cache-speed', speed * 1000 / 8)
+        paused = self.properties['paused-for-cache']
+        if not paused and cache == 0.0 or paused and cache >= 1.0:
+            self._set_property('paused-for-cache', not paused)
+            self._set_property('core-idle', not paused)
+        self._schedule(CACHE_TICK, self._cache_tick)
+
+    def _end(self, reason: str, entry_id: int):
+        self.emit('end-file', {'playlist_entry_id': entry_id, 'reason': reason})
+        if entry_id == self._entry_id:
+            self.url = None
+        self._set_property('core-idle', True)
+        self._set_property('metadata', None)
+        self._set_property('demuxer-cache-duration', None)
+
+    def _set_property(self, name: str, value):
+        self.properties[name] = value
+        for handler in self._observers.get(name, ()):
+            handler(name, value)
+
+    def _post(self, action: Callable, *args):
+        """Run action in the event thread, after the events posted before"""
+        if Config.SIMULATOR_REPLAY:
+            dispatcher.call_later(0, action, *args)
+        else:
+            self._queue.put((None, self._entry_id, action, args))
+
+    def _schedule(self, delay: float, action: Callable, *args):
+        """Run action in the event thread after delay seconds, unless another url is played by then"""
+        if Config.SIMULATOR_REPLAY:
+            dispatcher.call_later(delay, self._run_scheduled, self._entry_id, action, args)
+        else:
+            self._queue.put((monotonic() + delay, self._entry_id, action, args))
+
+    def _run_scheduled(self, entry_id: int, action: Callable, args: tuple):
+        if entry_id == self._entry_id:
+            action(*args)
+
+    def _event_thread(self):
+        """Deliver the events in order. Scheduled events of a replaced url are dropped"""
+        while True:
+            timeout = None
+            while self._scheduled:
+                due, _, entry_id, action, args = self._scheduled[0]
+                timeout = due - monotonic()
+                if timeout > 0:
+                    break
+                heapq.heappop(self._scheduled)
+                timeout = None
+                if entry_id == self._entry_id:
+                    action(*args)
+
+            try:
+                due, entry_id, action, args = self._queue.get(timeout=timeout)
+            except Empty:
+                continue
+
+            if due is None:
+                action(*args)
+            else:
+                heapq.heappush(self._scheduled, (due, next(self._seq), entry_id, action, args))
+
+
+def parse_script(filename: str) -> List[Tuple[float, str, List[str]]]:
+    """
+    Read a simulator script (see module docstring)
+    @param filename: str
+    @return: list with (delay, command, arguments)
+    """
+    with open(filename, 'r', encoding='utf-8') as file:
+        lines = [line.strip().split(maxsplit=2) for line in file if line.strip() and not line.startswith('#')]
+    return [(float(delay), command, args) for delay, command, *args in lines]
+
+
+def run_script(filename: str):
+    """
+    Run a simulator script (see module docstring)
+    @param filename: str
+    """
+    for delay, command, args in parse_script(filename):
+        sleep(delay)
+        LOG.info("Script: %s %s", command, " ".join(args))
+        run_command(command, args)
+
+
+def run_command(command: str, args: List[str]):
+    """
+    Run a script command on the created devices
+    @param command: 'press', 'rotate', ...
+    @param args: the arguments of the command
+    """
+    buttons = {'toggle': Config.PIN_BTN_TOGGLE, 'select': Config.PIN_BTN_ROTARY}
+    if command == 'press':
+        BUTTONS[buttons[args[0]]].press()
+    elif command == 'release':
+        BUTTONS[buttons[args[0]]].release()
+    elif command == 'rotate':
+        ENCODERS[0].rotate(int(args[0]))
+    elif command == 'title':
+        PLAYERS[0].titles[PLAYERS[0].url] = args[0]
+        PLAYERS[0].set_property('metadata', {'icy-title': args[0]})
+    elif command == 'fail':
+        PLAYERS[0].fail_urls.add(args[0])
+    elif command == 'stall':
+        PLAYERS[0].stall()
+    elif command == 'resume':
+        PLAYERS[0].stall(False)
+    elif command == 'drop':
+        PLAYERS[0].drop()
+    elif command == 'link':
+        PLAYERS[0].link = int(args[0])
+    elif command == 'quit':
+        PLAYERS[0].shutdown()
+    else:
+        LOG.error("Unknown script command: %s", command)
@@ -0,0 +1,264 @@
+"""
+Replay benchmark. Input traces (encoder ticks, button presses, icy-titles and stream events, in the simulator script
+format) are replayed through Radio, ButtonPanel and Lcd with the simulator backend, faster than real time:
+    - the radio modules read a virtual clock, which jumps from one due timer, scroll frame or trace command to the next
+      and runs in real time in between, so the processing time of the radio is part of the measured latencies
+    - the dispatcher is driven from the replay loop (Dispatcher.run_pending) and the lcd scrolls from it
+      (Lcd.scroll_step), so the timers of the radio and the scroll frames are due in virtual time
+    - the simulated player delivers its events through the dispatcher (Config.SIMULATOR_REPLAY)
+Prefetch, prober and timeshift are off: they need the network.
+
+Results per trace:
+    tick_to_render_p50/p95/p99_ms   encoder tick -> the next full lcd frame is written
+    i2c_bytes_per_event             i2c bytes written for the lcd per trace command
+    cpu_seconds_per_hour            cpu time of the process per simulated hour
+    threads                         most threads alive at the same time
+A result regresses when it is above its baseline (baselines.json) by more than its TOLERANCE. Every trace runs in its
+own process, so the threads and the cpu time of one trace don't mix with the next one.
+
+Usage (from the piradio directory):
+    python -m benchmarks.replay                 replay the synthetic traces (traces.py), compare with the baselines
+    python -m benchmarks.replay script.txt ...  replay recorded traces, e.g. simulator scripts
+    python -m benchmarks.replay --update        store the results of the synthetic traces as the new baselines
+    python -m benchmarks.replay --write DIR     write the synthetic traces as simulator scripts
+The exit status is 1 when a result regressed.
+"""
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+from bisect import bisect_left
+from time import perf_counter, process_time, time
+from typing import Dict, List, Optional
+
+from benchmarks import traces
+
+BASELINES = os.path.join(os.path.dirname(__file__), 'baselines.json')
+TAIL = 10.0  # seconds replayed after the last command, e.g. for a pending commit and tune
+STATIONS = 60
+# metric -> (relative, absolute) tolerance, a result regresses when > baseline * (1 + relative) + absolute
+TOLERANCE = {
+    'tick_to_render_p50_ms': (0.25, 1.0),
+    'tick_to_render_p95_ms': (0.25, 2.0),
+    'tick_to_render_p99_ms': (0.25, 5.0),
+    'i2c_bytes_per_event': (0.05, 0.0),
+    'cpu_seconds_per_hour': (0.5, 0.5),
+    'threads': (0.0, 0.0),
+}
+
+
+class VirtualClock:
+    """monotonic() replacement: jumps with set(), runs in real time in between"""
+    def __init__(self):
+        self._base = 0.0
+        self._real_base = perf_counter()
+
+    def now(self) -> float:
+        return self._base + perf_counter() - self._real_base
+
+    def set(self, now: float):
+        """Jump to now. The clock never goes back"""
+        self._base = max(now, self.now())
+        self._real_base = perf_counter()
+
+
+def percentile(values: List[float], share: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(share * len(values)))]
+
+
+def configure(directory: str):
+    """Set up Config for a replay. The radio modules read it at import time"""
+    from config import Config  # pylint: disable=import-outside-toplevel
+
+    Config.BACKEND = 'simulator'
+    Config.SIMULATOR_REPLAY = True
+    Config.SIMULATOR_TUNE_DELAY = 0.5
+    Config.PREFETCH = False
+    Config.PROBE = False
+    Config.TIMESHIFT = False
+    Config.METRICS_FILE = None
+    Config.STATE_FILE = os.path.join(directory, 'state.json')
+    Config.SAVED_STATION = os.path.join(directory, 'last_station.txt')
+    Config.CATALOG = os.path.join(directory, 'catalog.json')
+    Config.RESOLVER_CACHE = os.path.join(directory, 'resolver_cache.json')
+    Config.HISTORY_FILE = os.path.join(directory, 'history.log')
+
+    # stations which never need the network: resolved in the cache, the fake player doesn't connect
+    rng = random.Random(traces.SEED)
+    stations = [{'id': f'replay{number}', 'name': " ".join(rng.choices(traces.WORDS, k=rng.randint(1, 3))).title(),
+                 'url': f'http://127.0.0.1:9/replay{number}'} for number in range(STATIONS)]
+    with open(Config.CATALOG, 'w', encoding='utf-8') as file:
+        json.dump(stations, file)
+    with open(Config.RESOLVER_CACHE, 'w', encoding='utf-8') as file:
+        json.dump({station['url']: {'final_url': station['url'], 'resolved': time()} for station in stations}, file)
+
+
+def replay(name: str) -> Dict[str, float]:
+    """
+    Replay a trace in this process. Call only once per process
+    @param name: name of a synthetic trace or a script filename
+    @return: results
+    """
+    directory = tempfile.mkdtemp(prefix='piradio_replay_')
+    configure(directory)
+    random.seed(traces.SEED)  # e.g. the jitter of the watchdog
+    # pylint: disable=import-outside-toplevel
+    import dispatcher as dispatcher_module
+    import lcd_screen
+    import metrics as metrics_module
+    import radio
+    import rotary
+    import stream_watchdog
+    import variant_selector
+    from backends import simulator
+    from config import Config
+    from models.catalog import catalog
+
+    trace = traces.synthetic(name) if name in traces.SYNTHETIC else simulator.parse_script(name)
+    clock = VirtualClock()
+    for module in (dispatcher_module, lcd_screen, metrics_module, radio, rotary, stream_watchdog, variant_selector):
+        module.monotonic = clock.now
+
+    frames: List[float] = []  # times of the full lcd frames written
+    observe = metrics_module.metrics.observe
+
+    def recording_observe(name: str, value: float, **labels):
+        if name == 'lcd_frame_seconds':
+            frames.append(clock.now())
+        observe(name, value, **labels)
+
+    metrics_module.metrics.observe = recording_observe
+
+    dispatcher, lcd = dispatcher_module.dispatcher, lcd_screen.lcd
+    catalog.load(Config.CATALOG)
+    radio.Radio.load_station()
+    radio.Radio.init_player()
+    lcd.init(scroll_thread=False)
+    radio.ButtonPanel.setup()
+    lcd.wait()
+
+    threads = threading.active_count()
+    ticks: List[float] = []
+
+    def run_until(target: float):
+        """Run the timers and scroll frames which are due until target"""
+        nonlocal threads
+        while True:
+            waits = [wait for wait in (dispatcher.run_pending(), lcd.scroll_step()) if wait is not None]
+            lcd.wait()
+            threads = max(threads, threading.active_count())
+            if not waits or clock.now() + min(waits) > target:
+                break
+            clock.set(clock.now() + min(waits))
+        clock.set(target)
+
+    cpu = process_time()
+    wall = perf_counter()
+    elapsed = 0.0
+    for delay, command, args in trace:
+        elapsed += delay
+        run_until(elapsed)
+        if command == 'quit':
+            break
+        if command == 'rotate':
+            ticks.append(clock.now())
+        simulator.run_command(command, args)
+    run_until(elapsed + TAIL)
+    cpu = process_time() - cpu
+    wall = perf_counter() - wall
+
+    latencies = []
+    for tick in ticks:
+        index = bisect_left(frames, tick)
+        if index < len(frames):
+            latencies.append(frames[index] - tick)
+    simulated = elapsed + TAIL
+    return {
+        'tick_to_render_p50_ms': percentile(latencies, 0.5) * 1000,
+        'tick_to_render_p95_ms': percentile(latencies, 0.95) * 1000,
+        'tick_to_render_p99_ms': percentile(latencies, 0.99) * 1000,
+        'i2c_bytes_per_event': lcd.total.bytes / max(1, len(trace)),
+        'cpu_seconds_per_hour': cpu / simulated * 3600,
+        'threads': threads,
+        'events': len(trace),
+        'ticks': len(ticks),
+        'simulated_seconds': simulated,
+        'speedup': simulated / wall,
+    }
+
+
+def run(trace: str) -> Dict[str, float]:
+    """
+    Replay a trace in a new process
+    @param trace: name of a synthetic trace or a script filename
+    @return: results
+    """
+    output = subprocess.run([sys.executable, '-m', 'benchmarks.replay', '--run', trace], check=True,
+                            stdout=subprocess.PIPE, encoding='utf-8').stdout
+    return json.loads(output.splitlines()[-1])
+
+
+def regressions(name: str, results: Dict[str, float], baselines: Dict[str, Dict[str, float]]) -> List[str]:
+    """@return: a message per result of trace name that regressed"""
+    messages = []
+    for metric, (relative, absolute) in TOLERANCE.items():
+        baseline: Optional[float] = baselines.get(name, {}).get(metric)
+        if baseline is not None and results[metric] > baseline * (1 + relative) + absolute:
+            messages.append(f"{name}: {metric} {results[metric]:.3f} > baseline {baseline:.3f}")
+    return messages
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay input traces through the radio with the simulator backend")
+    parser.add_argument('traces', nargs='*', help="simulator scripts, default: the synthetic traces")
+    parser.add_argument('--update', action='store_true', help="store the results as the new baselines")
+    parser.add_argument('--write', metavar='DIR', help="write the synthetic traces as simulator scripts")
+    parser.add_argument('--run', help=argparse.SUPPRESS)  # replay one trace in this process
+    options = parser.parse_args()
+
+    if options.run is not None:
+        print(json.dumps(replay(options.run)))
+        return
+
+    if options.write is not None:
+        for name in traces.SYNTHETIC:
+            traces.write(traces.synthetic(name), os.path.join(options.write, f'{name}.txt'))
+        return
+
+    try:
+        with open(BASELINES, 'r', encoding='utf-8') as file:
+            baselines = json.load(file)
+    except FileNotFoundError:
+        baselines = {}
+
+    failed = []
+    for name in options.traces or list(traces.SYNTHETIC):
+        results = run(name)
+        print(f"{name}: {results['events']} events ({results['ticks']} ticks), "
+              f"{results['simulated_seconds']:.0f}s simulated, {results['speedup']:.0f}x real time")
+        for metric in TOLERANCE:
+            baseline = baselines.get(name, {}).get(metric)
+            line = f"    {metric:24} {results[metric]:10.3f}"
+            print(line + (f"   baseline {baseline:10.3f}" if baseline is not None else ""))
+        failed += regressions(name, results, baselines)
+        if options.update:
+            baselines[name] = {metric: round(results[metric], 3) for metric in TOLERANCE}
+
+    if options.update:
+        with open(BASELINES, 'w', encoding='utf-8') as file:
+            json.dump(baselines, file, indent=4, sort_keys=True)
+            file.write("\n")
+    elif failed:
+        print("Regressions:\n    " + "\n    ".join(failed))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
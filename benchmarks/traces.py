@@ -0,0 +1,83 @@
+"""
+Synthetic input traces for the replay benchmark. A trace is a list of simulator script commands
+(delay, command, arguments), see backends/simulator.py. Every rotate command is one detent of the encoder.
+The traces are generated from a fixed seed, so every run replays the same input.
+    browse      an hour of use: listening with title changes, browsing the stations now and then, stream drops
+    spin        ten minutes of fast spinning through the station list
+    titles      an hour of listening to a station with long, scrolling titles
+"""
+import random
+from typing import Callable, Dict, List, Tuple
+
+Trace = List[Tuple[float, str, List[str]]]
+
+SEED = 1
+WORDS = ("night", "café", "radio", "blue", "Müller", "river", "electric", "señor", "dance", "summer", "Ørsted", "live",
+         "orchestra", "mix", "dreams", "Bach", "Beyoncé", "session", "the", "of", "ça", "va", "jazz", "forever")
+
+
+def title(rng: random.Random) -> str:
+    """'Artist - Song' with 2 to 12 words"""
+    return f"{' '.join(rng.choices(WORDS, k=rng.randint(1, 4)))} - {' '.join(rng.choices(WORDS, k=rng.randint(1, 8)))}"
+
+
+def spin(rng: random.Random, ticks: int, rate: float) -> Trace:
+    """Turn the encoder one way by ticks detents at about rate detents per second"""
+    direction = rng.choice(('1', '-1'))
+    return [(rng.uniform(0.5, 1.5) / rate, 'rotate', [direction]) for _ in range(ticks)]
+
+
+def duration(trace: Trace) -> float:
+    """Seconds from the start to the last command"""
+    return sum(delay for delay, _, _ in trace)
+
+
+def browse_trace(rng: random.Random) -> Trace:
+    trace: Trace = [(1.0, 'press', ['toggle'])]
+    while duration(trace) < 3600:
+        # listen
+        for _ in range(rng.randint(1, 4)):
+            trace.append((rng.uniform(20, 90), 'title', [title(rng)]))
+        if rng.random() < 0.1:
+            trace.append((rng.uniform(1, 10), 'drop', []))
+        # browse: a few spins, then wait for the commit or press select
+        for _ in range(rng.randint(1, 4)):
+            trace.extend(spin(rng, rng.randint(3, 25), rng.uniform(5, 40)))
+            trace.append((rng.uniform(0.5, 2), 'title', [title(rng)]))
+        if rng.random() < 0.5:
+            trace.append((rng.uniform(0.3, 2), 'press', ['select']))
+    return trace
+
+
+def spin_trace(rng: random.Random) -> Trace:
+    trace: Trace = [(1.0, 'press', ['toggle'])]
+    while duration(trace) < 600:
+        burst = spin(rng, rng.randint(50, 200), rng.uniform(100, 300))
+        trace.append((rng.uniform(0.2, 4), *burst[0][1:]))
+        trace.extend(burst[1:])
+    return trace
+
+
+def titles_trace(rng: random.Random) -> Trace:
+    trace: Trace = [(1.0, 'press', ['toggle'])]
+    while duration(trace) < 3600:
+        trace.append((rng.uniform(10, 20), 'title', [f"{title(rng)} - {title(rng)}"]))
+    return trace
+
+
+SYNTHETIC: Dict[str, Callable[[random.Random], Trace]] = {
+    'browse': browse_trace,
+    'spin': spin_trace,
+    'titles': titles_trace,
+}
+
+
+def synthetic(name: str) -> Trace:
+    return SYNTHETIC[name](random.Random(f"{SEED}-{name}"))
+
+
+def write(trace: Trace, filename: str):
+    """Write a trace as simulator script, e.g. to run it in real time with PIRADIO_SCRIPT"""
+    with open(filename, 'w', encoding='utf-8') as file:
+        for delay, command, args in trace:
+            file.write(f"{delay:.3f} {command} {' '.join(args)}".rstrip() + "\n")
@@ -0,0 +1,96 @@
+"""
+Command queue for the inputs of the radio: the buttons, the rotary encoder and the control api.
+An input never changes the radio in its own thread. It posts a Command, which the dispatcher thread (the only thread
+changing the Radio) looks up in a transition table (command, state) -> handler and runs. A command without an entry
+for the current state is ignored. post() only takes a lock and puts the command on the dispatcher queue, so the gpio
+callback threads return at once, and the commands run one at a time in the order they were posted.
+A command which is posted again before it ran is merged with the waiting one, e.g. two presses of the toggle button
+cancel each other out and the moves of the encoder add up. The merged command keeps the place of the first one.
+"""
+import logging
+from enum import Enum
+from threading import Lock
+from typing import Callable, Dict, Optional, Tuple
+
+from dispatcher import dispatcher
+from metrics import metrics
+from models.enums import Command, Event
+
+LOG = logging.getLogger(__name__)
+
+Merge = Callable[[tuple, tuple], Optional[tuple]]  # (waiting args, new args) -> merged args, None cancels both
+
+
+def cancel(_waiting: tuple, _new: tuple) -> None:
+    """Merge for a command undoing itself, e.g. toggle"""
+    return None
+
+
+def replace(_waiting: tuple, new: tuple) -> tuple:
+    """Merge for a command setting a value: the last one wins"""
+    return new
+
+
+def add(waiting: tuple, new: tuple) -> tuple:
+    """Merge for a command moving by a number of steps"""
+    return (waiting[0] + new[0],)
+
+
+class CommandQueue:
+    """Run the commands of all threads in the dispatcher thread through a transition table"""
+    def __init__(self, transitions: Dict[Tuple[Command, Enum], Callable], state: Callable[[], Enum],
+                 merges: Dict[Command, Merge]):
+        """
+        @param transitions: (command, state) -> handler, called with the arguments of the command
+        @param state: callable returning the current state, called in the dispatcher thread
+        @param merges: command -> merge function. The commands without one are never merged
+        """
+        self._transitions = transitions
+        self._state = state
+        self._merges = merges
+        self._lock = Lock()
+        self._waiting: Dict[Command, tuple] = {}  # arguments of the mergeable commands which didn't run yet
+        dispatcher.subscribe(Event.COMMAND, self._run)
+
+    def post(self, command: Command, *args):
+        """
+        Queue a command. Can be called from any thread, returns at once
+        @param command: Command
+        @param args: arguments for the handler
+        """
+        metrics.inc('commands_total', command=command.name.lower())
+        merge = self._merges.get(command)
+        if merge is None:
+            dispatcher.post(Event.COMMAND, command, args)
+            return
+        with self._lock:
+            if command not in self._waiting:
+                self._waiting[command] = args
+                dispatcher.post(Event.COMMAND, command, None)
+                return
+            merged = merge(self._waiting[command], args)
+            if merged is None:
+                del self._waiting[command]  # the queued Event.COMMAND finds nothing to run
+                metrics.inc('commands_cancelled_total', command=command.name.lower())
+            else:
+                self._waiting[command] = merged
+                metrics.inc('commands_merged_total', command=command.name.lower())
+
+    def execute(self, command: Command, *args):
+        """Run a command at once. Call only from the dispatcher thread, e.g. for input coalesced already"""
+        state = self._state()
+        handler = self._transitions.get((command, state))
+        if handler is None:
+            LOG.debug("Command %s ignored in state %s", command.name, state.name)
+            return
+        LOG.debug("Command %s in state %s", command.name, state.name)
+        handler(*args)
+
+    def _run(self, command: Command, args: Optional[tuple]):
+        """Event.COMMAND handler. args None -> the command is waiting in _waiting"""
+        if args is None:
+            with self._lock:
+                args = self._waiting.pop(command, None)
+            if args is None:
+                return  # cancelled
+        self.execute(command, *args)
@@ -1,15 +1,54 @@
 import logging
+import os
 from dataclasses import dataclass
 
 
 @dataclass
 class Config:
     """Globals configuration vars. Threat as read-only..."""
+    # hardware backend: 'rpi' or 'simulator' (runs without raspberry pi, see backends/simulator.py)
+    BACKEND = os.environ.get('PIRADIO_BACKEND', 'rpi')
+    SIMULATOR_SCRIPT = os.environ.get('PIRADIO_SCRIPT')  # input script for the simulator
+    SIMULATOR_TUNE_DELAY = 0.2  # seconds before a simulated stream starts playing
+    SIMULATOR_REPLAY = False  # deliver the simulated player events in the dispatcher thread (benchmarks/replay.py)
+
     # audio
     AUDIO_DEVICE = 'alsa/hw:CARD=sndrpihifiberry'  # to check hw devices -> aplay -L
     TIMEOUT = 30
+    WATCHDOG = True  # reconnect when the playing stream stalls or drops
+    WATCHDOG_INTERVAL = 1  # seconds between the stall checks
+    WATCHDOG_STALL = 3  # seconds without audio or cache growth before reconnecting
+    WATCHDOG_LOW_CACHE = 2  # reconnect a stalled stream when the cache holds fewer seconds of audio
+    WATCHDOG_BACKOFF = 0.5  # first reconnect delay, doubled for every attempt (+ jitter)
+    WATCHDOG_BACKOFF_MAX = 30
+    WATCHDOG_ATTEMPTS = 8
+    WATCHDOG_CONNECT_TIMEOUT = 10  # seconds for a reconnect attempt to play audio
+    ABR = True  # switch between the variants of a station (needs WATCHDOG)
+    ABR_MIN_RATIO = 0.9  # the throughput must stay above this ratio of the bitrate
+    ABR_SLOW = 10  # seconds of too low throughput before switching down
+    ABR_SMOOTHING = 0.3  # weight of a new throughput sample
+    ABR_REBUFFERS = 2  # rebuffer events within ABR_WINDOW seconds before switching down
+    ABR_WINDOW = 60
+    ABR_PROBE_AFTER = 300  # seconds without problems before trying a better variant
+    ABR_PROBE_MAX = 3600
+    RESUME_ON_BOOT = False  # start playing the last station when the service starts
+
+    # prefetch: pre-connect to the stations around the cursor while selecting a station
+    PREFETCH = True
+    PREFETCH_NEIGHBOURS = 1  # stations on each side of the cursor
+    PREFETCH_STREAMS = 3  # max simultaneous warm streams (cursor + neighbours)
+    PREFETCH_BUFFER = 64 * 1024  # bytes of audio kept per warm stream (~4 sec at 128 kbps)
+    PREFETCH_DELAY = 0.3  # seconds the cursor has to rest on a station before connecting
+    PREFETCH_TTL = 15  # seconds before an unused warm stream is closed
+    PREFETCH_CONNECT_TIMEOUT = 5
+    RACE_STAGGER = 0.25  # seconds between the connection attempts to the endpoints of a stream with mirrors
+    TIMESHIFT = False  # record the playing station to pause and rewind it (see timeshift.py)
+    TIMESHIFT_FILE = '/dev/shm/piradio_timeshift'  # ring file, on tmpfs to spare the sd card
+    TIMESHIFT_SIZE = 32 * 1024 * 1024  # bytes, ~35 min at 128 kbps, ~14 min at 320 kbps
+    TIMESHIFT_STEP = 10  # seconds per encoder step while paused
 
     # lcd
+    LCD_CACHE = 256  # encoded lines and wrapped texts kept in memory
     SCROLL_DELAY = 0.75  # SET SPEED OF SCROLLING TEXT (1=1sec/hop)
 
     # rpi pins
@@ -18,6 +57,9 @@ class Config:
     PIN_ROTARY_DT = 5  # Momentary encoder DT
     PIN_ROTARY_CLK = 6  # Momentary encoder CLK
     BTN_BOUNCE = 0.05  # Button debounce time in seconds
+    ROTARY_RENDER_RATE = 20  # max station changes rendered per second while spinning the rotary encoder
+    ROTARY_ACCEL_RATE = 15  # ticks per second from which a tick counts for several stations
+    ROTARY_ACCEL_MAX = 10  # max stations per tick
     LCD_POWER_PIN = 16
 
     # log
@@ -27,4 +69,47 @@ class Config:
         fmt='[%(asctime)s.%(msecs)03d] [%(module)s] %(levelname)s: %(message)s',
         datefmt='%D %H:%M:%S',
     )
-    SAVED_STATION = 'last_station.txt'  # save last opened station
+    LOG_MAX_BYTES = 1024 * 1024  # size of the log file before it is rotated
+    LOG_BACKUPS = 2
+    LOG_QUEUE_SIZE = 1000  # records waiting for the log writer thread, more records are dropped
+    LOG_RING_SIZE = 500  # last records kept in memory for LOG_DUMP_FILE
+    LOG_DUMP_FILE = 'piradio_dump.log'  # written on SIGUSR1 and after a crash
+    LOG_RATE = 5  # max mpv log records per component ...
+    LOG_RATE_WINDOW = 10  # ... in this many seconds
+    DIAG_DIR = 'diagnostics'  # reports written on SIGUSR2 and POST /diagnostics (see diagnostics.py)
+    DIAG_STACKS_FILE = 'piradio_stacks.txt'  # stacks of all threads, appended on SIGUSR2 even when python hangs
+    DIAG_PROFILE_SECONDS = 10  # default profile length of a report
+    DIAG_PROFILE_MAX = 120
+    DIAG_SAMPLE_RATE = 100  # stack samples per second of the sampling profiler
+    DIAG_KEEP = 5  # newest reports kept in DIAG_DIR
+    STATE_FILE = 'piradio_state.json'  # last station, volume, favourites and station stats
+    STATE_DELAY = 10  # seconds to coalesce changes before writing the state file
+    STATE_WRITES_PER_HOUR = 12
+    HISTORY_SIZE = 100  # last titles kept in memory for the lcd and the control api (see history.py)
+    HISTORY_FILE = 'piradio_history.log'  # all titles played. None -> memory only
+    HISTORY_MAX_BYTES = 512 * 1024  # size of the history file before it is rotated (one old file is kept)
+    HISTORY_DELAY = 60  # seconds to collect titles before appending them to HISTORY_FILE
+    SAVED_STATION = 'last_station.txt'  # saved station of older versions, imported once into STATE_FILE
+    CATALOG = None  # json or sqlite station catalog (see models/catalog.py). None -> models/stations.py
+    CATALOG_CACHE = 64  # station records kept in memory
+    METRICS_FILE = 'piradio.prom'  # latency metrics in the prometheus text format. None -> disabled
+    METRICS_INTERVAL = 60  # seconds between writes of METRICS_FILE
+    METRICS_SOCKET = None  # unix socket path serving the metrics, e.g. '/run/piradio/metrics.sock'
+    CONTROL_SOCKET = None  # unix socket path of the control api (see control.py), e.g. '/run/piradio/control.sock'
+    CONTROL_PORT = None  # localhost tcp port of the control api, e.g. 8080. None -> disabled
+    CONTROL_MAX_CLIENTS = 8  # open connections, event streams included
+    CONTROL_LONG_POLL = 30  # max seconds a GET /status?since= request waits for a change
+    CONTROL_KEEPALIVE = 15  # seconds between keepalive comments on an idle event stream
+    CONTROL_READ_TIMEOUT = 5  # seconds to receive a request
+    RESOLVER_CACHE = 'resolver_cache.json'  # resolved stream urls (redirects, playlists)
+    RESOLVER_TTL = 24 * 3600  # seconds before a resolved url is revalidated
+    RESOLVER_TIMEOUT = 5
+    RESOLVER_PRELOAD = 20  # stations resolved at startup (favourites first)
+    PROBE = True  # check the reachability of the stations in the background (see prober.py)
+    PROBE_START_DELAY = 60  # seconds after startup, the first tune goes first
+    PROBE_INTERVAL = 30 * 60  # seconds between two rounds
+    PROBE_CONCURRENCY = 4  # simultaneous probes
+    PROBE_TIMEOUT = 5  # seconds for the connection, the headers and the first audio bytes
+    PROBE_BUDGET = 2 * 1024 * 1024  # max bytes received per round
+    PROBE_DOWN_TIMEOUT = 8  # tune timeout for a station the prober found down
+    PROBE_SKIP_DOWN = False  # skip the stations which are down while selecting. False -> mark them
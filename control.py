@@ -0,0 +1,286 @@
+"""
+Local control api. A small http server on the unix socket Config.CONTROL_SOCKET and/or 127.0.0.1:Config.CONTROL_PORT
+    GET  /status                 radio status as json
+    GET  /status?since=<version> long poll: wait until the status is newer than version (or Config.CONTROL_LONG_POLL s)
+    GET  /events                 server-sent events: the status on every change
+    GET  /history                the titles in memory, newest first (see history.py)
+    GET  /history?since=<t>&until=<t>&limit=<n>  the titles played between two unix times, oldest first
+    POST /toggle                 the 'toggle radio' button
+    POST /select                 the select button: play the station under the cursor
+    POST /move?steps=<n>         turn the encoder n steps (negative -> counterclockwise)
+    POST /play?station=<id>      play a station. ?name=<prefix> plays the first station with a name starting with prefix
+    POST /volume?value=<0-100>
+    POST /favourite              toggle the favourite flag of the playing station
+    POST /pause                  pause or resume (Config.TIMESHIFT)
+    POST /seek?seconds=<n>       move through the timeshift recording, negative -> rewind
+    POST /live                   jump to the end of the timeshift recording
+    POST /diagnostics?seconds=<n> write a diagnostics report with a profile of n seconds (see diagnostics.py)
+    e.g. curl --unix-socket /run/piradio/control.sock http://radio/events
+The server runs an asyncio loop in its own thread. It never calls the Radio directly: the commands are posted to the
+command queue (commands.py) like the button presses, and the dispatcher only builds a status snapshot when the status
+changes.
+Only /diagnostics is handled in the server thread, it has to work when the dispatcher thread is stuck. /history reads
+the history files in a worker thread.
+Every client gets the latest snapshot, a slow client skips intermediate states instead of queueing them.
+"""
+import asyncio
+import json
+import logging
+import os
+from threading import Thread
+from typing import Callable, Dict, Optional, Tuple
+from urllib.parse import parse_qsl, urlsplit
+
+import diagnostics
+from config import Config
+from history import history
+from metrics import metrics
+from models.catalog import catalog
+from models.enums import Command, States
+from radio import Radio, commands
+from state import store
+from timeshift import timeshift
+
+LOG = logging.getLogger(__name__)
+
+MAX_LINE = 4096  # max length of the request line and the headers
+MAX_BODY = 4096
+WRITE_TIMEOUT = 5  # seconds to drain the writes of a client before it is dropped
+
+
+class RequestError(Exception):
+    """Bad request, answered with the status code"""
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+
+def status_snapshot() -> dict:
+    """Snapshot of the radio status. Runs in the dispatcher thread"""
+    station = Radio.station
+    selecting = Radio.state() is States.SELECT_STATION
+    return {
+        'state': Radio.state().name.lower(),
+        'station': {'id': station.id, 'name': station.name} if station is not None else None,
+        'selected': {'id': Radio.new_station.id, 'name': Radio.new_station.name} if selecting else None,
+        'title': Radio.title(),
+        'volume': store.get('volume'),
+        'favourite': station is not None and station.id in catalog.favourites,
+        'delay': round(timeshift.delay) if Config.TIMESHIFT else None,
+    }
+
+
+def _int(params: Dict[str, str], name: str) -> int:
+    try:
+        return int(params[name])
+    except (KeyError, ValueError) as err:
+        raise RequestError(400, f"parameter '{name}' must be an integer") from err
+
+
+def _station_id(params: Dict[str, str]) -> str:
+    station_id = params.get('station')
+    if station_id is None and params.get('name'):
+        station_id = catalog.find_name(params['name'])
+    if station_id is None or catalog.position(station_id) < 0:
+        raise RequestError(404, "unknown station")
+    return station_id
+
+
+# path -> function(params) returning the command and its arguments for the command queue
+COMMANDS: Dict[str, Callable[[Dict[str, str]], Tuple]] = {
+    '/toggle': lambda params: (Command.TOGGLE,),
+    '/select': lambda params: (Command.SELECT,),
+    '/move': lambda params: (Command.MOVE, _int(params, 'steps')),
+    '/play': lambda params: (Command.PLAY, _station_id(params)),
+    '/volume': lambda params: (Command.VOLUME, _int(params, 'value')),
+    '/favourite': lambda params: (Command.FAVOURITE,),
+    '/pause': lambda params: (Command.PAUSE,),
+    '/seek': lambda params: (Command.SEEK, _int(params, 'seconds')),
+    '/live': lambda params: (Command.LIVE,),
+}
+ENDPOINTS = ('/status', '/events', '/history', '/diagnostics')
+
+
+class ControlServer:
+    """Asyncio http server in a thread"""
+    def __init__(self):
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._status: dict = {}
+        self._version = 0
+        self._changed: Optional[asyncio.Event] = None  # replaced after every change
+        self._clients = 0
+
+    def start(self):
+        """Start the server thread when Config.CONTROL_SOCKET or Config.CONTROL_PORT is set"""
+        if not Config.CONTROL_SOCKET and not Config.CONTROL_PORT:
+            return
+        self._status = status_snapshot()
+        self._version = 1
+        self._loop = asyncio.new_event_loop()
+        Radio.on_status_change(self._status_changed)
+        Thread(target=self._run, name="control_api", daemon=True).start()
+
+    def _status_changed(self):
+        """Radio status listener. Runs in the dispatcher thread"""
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._publish, status_snapshot())
+
+    def _publish(self, snapshot: dict):
+        if snapshot == self._status:
+            return
+        self._status = snapshot
+        self._version += 1
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    def _run(self):
+        asyncio.set_event_loop(self._loop)
+        self._changed = asyncio.Event()
+        try:
+            if Config.CONTROL_SOCKET:
+                if os.path.exists(Config.CONTROL_SOCKET):
+                    os.unlink(Config.CONTROL_SOCKET)
+                self._loop.run_until_complete(asyncio.start_unix_server(self._handle, Config.CONTROL_SOCKET,
+                                                                        limit=MAX_LINE))
+            if Config.CONTROL_PORT:
+                self._loop.run_until_complete(asyncio.start_server(self._handle, '127.0.0.1', Config.CONTROL_PORT,
+                                                                   limit=MAX_LINE))
+        except OSError as err:
+            LOG.error("Cannot start the control api: %s", err)
+            self._loop.close()
+            self._loop = None
+            return
+        LOG.info("Control api listening on %s", ", ".join(
+            str(address) for address in (Config.CONTROL_SOCKET, Config.CONTROL_PORT) if address))
+        self._loop.run_forever()
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """Serve one request per connection"""
+        if self._clients >= Config.CONTROL_MAX_CLIENTS:
+            try:
+                await self._respond(writer, 503, {'error': "too many clients"})
+            except (asyncio.TimeoutError, ConnectionError):
+                pass
+            writer.close()
+            return
+
+        self._clients += 1
+        metrics.set_gauge('control_clients', self._clients)
+        try:
+            method, path, params = await self._read_request(reader)
+            metrics.inc('control_requests_total', path=path if path in COMMANDS or path in ENDPOINTS else 'other')
+            if method == 'GET' and path == '/events':
+                await self._events(writer)
+            elif method == 'GET' and path == '/status':
+                await self._respond(writer, 200, await self._long_poll(params))
+            elif method == 'GET' and path == '/history':
+                await self._respond(writer, 200, await self._history(params))
+            elif method == 'POST' and path in COMMANDS:
+                commands.post(*COMMANDS[path](params))
+                await self._respond(writer, 202, {'accepted': path[1:]})
+            elif method == 'POST' and path == '/diagnostics':
+                await self._respond(writer, 202, {'report': self._diagnostics(params)})
+            elif path in COMMANDS or path in ENDPOINTS:
+                raise RequestError(405, "method not allowed")
+            else:
+                raise RequestError(404, "not found")
+        except RequestError as err:
+            await self._respond(writer, err.status, {'error': str(err)})
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError, ValueError,
+                ConnectionError):
+            pass
+        finally:
+            self._clients -= 1
+            metrics.set_gauge('control_clients', self._clients)
+            writer.close()
+
+    async def _history(self, params: Dict[str, str]) -> dict:
+        limit = _int(params, 'limit') if 'limit' in params else Config.HISTORY_SIZE
+        if 'since' in params:
+            until = _int(params, 'until') if 'until' in params else None
+            entries = await self._loop.run_in_executor(None, history.between, _int(params, 'since'), until, limit)
+        else:
+            entries = history.recent(limit)
+        return {'entries': [entry._asdict() for entry in entries]}
+
+    @staticmethod
+    def _diagnostics(params: Dict[str, str]) -> str:
+        """Start a diagnostics report. @return: the report directory"""
+        report = diagnostics.start(_int(params, 'seconds') if 'seconds' in params else None)
+        if report is None:
+            raise RequestError(409, "a report is being written")
+        return report
+
+    @staticmethod
+    async def _read_request(reader: asyncio.StreamReader) -> Tuple[str, str, Dict[str, str]]:
+        """@return: method, path and the parameters of the query string and the (form or json) body"""
+        request_line = (await asyncio.wait_for(reader.readline(), Config.CONTROL_READ_TIMEOUT)).decode('latin-1')
+        try:
+            method, target, _version = request_line.split()
+        except ValueError as err:
+            raise RequestError(400, "bad request line") from err
+
+        headers = {}
+        while True:
+            line = (await asyncio.wait_for(reader.readline(), Config.CONTROL_READ_TIMEOUT)).decode('latin-1')
+            if line in ('\r\n', '\n', ''):
+                break
+            name, _, value = line.partition(':')
+            headers[name.strip().lower()] = value.strip()
+
+        url = urlsplit(target)
+        params = dict(parse_qsl(url.query))
+        length = int(headers.get('content-length', 0))
+        if length > MAX_BODY:
+            raise RequestError(413, "body too large")
+        if length:
+            body = (await asyncio.wait_for(reader.readexactly(length), Config.CONTROL_READ_TIMEOUT)).decode('utf-8')
+            if headers.get('content-type', '').startswith('application/json'):
+                try:
+                    params.update({key: str(value) for key, value in json.loads(body).items()})
+                except (ValueError, AttributeError) as err:
+                    raise RequestError(400, "body must be a json object") from err
+            else:
+                params.update(parse_qsl(body))
+        return method.upper(), url.path.rstrip('/') or '/', params
+
+    async def _long_poll(self, params: Dict[str, str]) -> dict:
+        """@return: the status, after waiting for a version newer than params['since'] when given"""
+        if 'since' in params:
+            since = _int(params, 'since')
+            if self._version <= since:
+                try:
+                    await asyncio.wait_for(self._changed.wait(), Config.CONTROL_LONG_POLL)
+                except asyncio.TimeoutError:
+                    pass
+        return dict(self._status, version=self._version)
+
+    async def _events(self, writer: asyncio.StreamWriter):
+        """Stream the status as server-sent events until the client disconnects"""
+        writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nCache-Control: no-cache\r\n"
+                     b"Connection: close\r\n\r\n")
+        sent = 0
+        while not writer.is_closing():
+            if sent < self._version:
+                sent = self._version
+                data = json.dumps(self._status)
+                writer.write(f"id: {sent}\nevent: status\ndata: {data}\n\n".encode('utf-8'))
+            else:
+                writer.write(b": keepalive\n\n")
+            await asyncio.wait_for(writer.drain(), WRITE_TIMEOUT)
+            try:
+                await asyncio.wait_for(self._changed.wait(), Config.CONTROL_KEEPALIVE)
+            except asyncio.TimeoutError:
+                pass
+
+    @staticmethod
+    async def _respond(writer: asyncio.StreamWriter, code: int, body: dict):
+        data = json.dumps(body).encode('utf-8')
+        reason = {200: 'OK', 202: 'Accepted', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+                  409: 'Conflict', 413: 'Payload Too Large', 503: 'Service Unavailable'}[code]
+        writer.write(f"HTTP/1.1 {code} {reason}\r\nContent-Type: application/json\r\nContent-Length: {len(data)}\r\n"
+                     f"Connection: close\r\n\r\n".encode('latin-1') + data)
+        await asyncio.wait_for(writer.drain(), WRITE_TIMEOUT)
+
+
+control = ControlServer()
@@ -0,0 +1,174 @@
+"""
+On-demand diagnostics for a radio that got sluggish. Triggered by the signal SIGUSR2
+(systemctl kill -s SIGUSR2 piradio) or by POST /diagnostics of the control api. A report is a directory in
+Config.DIAG_DIR with:
+    threads.txt         stack of every thread, with the thread names
+    snapshot.json       thread count, queue depths (dispatcher, i2c worker, log), radio state, cpu time and memory
+    profile.folded      sampling profile of all threads: Config.DIAG_SAMPLE_RATE stack samples per second for the
+                        profile length, one line per stack with its sample count (flamegraph.pl, speedscope)
+    dispatcher.pstats   cProfile of the dispatcher thread for the profile length (python -m pstats), dispatcher.txt
+                        has the top functions. Missing when the dispatcher thread didn't run the profile callbacks
+The stacks and the snapshot are written at once, the profiles when the profile length is over. Only the newest
+Config.DIAG_KEEP reports are kept.
+The signal also appends the raw stacks to Config.DIAG_STACKS_FILE through faulthandler, which works even when the
+interpreter is stuck, e.g. in a blocking call holding the GIL.
+Nothing runs until a report is requested: no thread, no profiler hook.
+"""
+import cProfile
+import faulthandler
+import io
+import json
+import logging
+import os
+import pstats
+import resource
+import shutil
+import signal
+import sys
+import threading
+import traceback
+from collections import Counter
+from datetime import datetime
+from time import monotonic, process_time, sleep
+from typing import Optional
+
+import logger
+from config import Config
+from dispatcher import dispatcher
+from lcd_screen import lcd
+from radio import Radio
+
+LOG = logging.getLogger(__name__)
+
+_lock = threading.Lock()  # one report at a time
+_stacks_file = None  # kept open for faulthandler
+
+
+def setup():
+    """Install the SIGUSR2 handler. Call from the main thread"""
+    global _stacks_file
+    signal.signal(signal.SIGUSR2, lambda _signum, _frame: start())
+    try:
+        _stacks_file = open(Config.DIAG_STACKS_FILE, 'a', encoding='utf-8')  # pylint: disable=consider-using-with
+    except OSError as err:
+        LOG.warning("Cannot open %s: %s", Config.DIAG_STACKS_FILE, err)
+        return
+    # runs in the c signal handler first, then chains to the python handler above
+    faulthandler.register(signal.SIGUSR2, file=_stacks_file, all_threads=True, chain=True)
+
+
+def start(seconds: float = None) -> Optional[str]:
+    """
+    Write a report in a background thread
+    @param seconds: profile length, default Config.DIAG_PROFILE_SECONDS, at most Config.DIAG_PROFILE_MAX
+    @return: the report directory, None when a report is being written already
+    """
+    if not _lock.acquire(blocking=False):  # pylint: disable=consider-using-with
+        LOG.warning("Diagnostics requested while a report is being written")
+        return None
+    seconds = min(max(0.0, Config.DIAG_PROFILE_SECONDS if seconds is None else seconds), Config.DIAG_PROFILE_MAX)
+    directory = os.path.join(Config.DIAG_DIR, datetime.now().strftime('%Y%m%d-%H%M%S'))
+    threading.Thread(target=_report, args=(directory, seconds), name="diagnostics", daemon=True).start()
+    return directory
+
+
+def thread_stacks() -> str:
+    """Stack of every thread, with the thread names"""
+    threads = {thread.ident: thread for thread in threading.enumerate()}
+    lines = []
+    for ident, frame in sys._current_frames().items():  # pylint: disable=protected-access
+        thread = threads.get(ident)
+        name = thread.name if thread is not None else "?"
+        daemon = " daemon" if thread is not None and thread.daemon else ""
+        native = thread.native_id if thread is not None else "?"
+        lines.append(f'Thread "{name}" (ident {ident}, tid {native}{daemon})')
+        lines.extend(line.rstrip('\n') for line in traceback.format_stack(frame))
+        lines.append('')
+    return "\n".join(lines)
+
+
+def snapshot() -> dict:
+    """Thread count, queue depths and process resources"""
+    events, timers = dispatcher.depth
+    log_queue, log_dropped = logger.queue_depth()
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return {
+        'time': datetime.now().isoformat(timespec='seconds'),
+        'threads': threading.active_count(),
+        'thread_names': sorted(thread.name for thread in threading.enumerate()),
+        'dispatcher_events': events,
+        'dispatcher_timers': timers,
+        'i2c_frames': lcd.queue_depth,
+        'log_queue': log_queue,
+        'log_dropped': log_dropped,
+        'radio_state': Radio.state().name,
+        'cpu_seconds': round(process_time(), 3),
+        'max_rss_kib': usage.ru_maxrss,
+    }
+
+
+def _report(directory: str, seconds: float):
+    try:
+        os.makedirs(directory, exist_ok=True)
+        _write(directory, 'threads.txt', thread_stacks())
+        _write(directory, 'snapshot.json', json.dumps(snapshot(), indent=2))
+        LOG.info("Diagnostics: writing %s, profiling for %.0fs", directory, seconds)
+        if seconds:
+            _profile(directory, seconds)
+        _remove_old_reports()
+        LOG.info("Diagnostics written to %s", directory)
+    except OSError as err:
+        LOG.error("Cannot write diagnostics to %s: %s", directory, err)
+    finally:
+        _lock.release()
+
+
+def _profile(directory: str, seconds: float):
+    """Sample the stacks of all threads in this thread and run cProfile in the dispatcher thread"""
+    profiler = cProfile.Profile()
+    profiled = threading.Event()
+
+    def disable():
+        profiler.disable()
+        profiled.set()
+
+    dispatcher.call_later(0, profiler.enable)
+    dispatcher.call_later(seconds, disable)
+
+    own = threading.get_ident()
+    names = {}
+    samples = Counter()
+    interval = 1 / Config.DIAG_SAMPLE_RATE
+    end = monotonic() + seconds
+    while monotonic() < end:
+        for ident, frame in sys._current_frames().items():  # pylint: disable=protected-access
+            if ident == own:
+                continue
+            if ident not in names:
+                names.update((thread.ident, thread.name) for thread in threading.enumerate())
+            stack = []
+            while frame is not None:
+                stack.append(f"{os.path.basename(frame.f_code.co_filename)}:{frame.f_code.co_name}")
+                frame = frame.f_back
+            samples[";".join([names.get(ident, str(ident))] + stack[::-1])] += 1
+        sleep(interval)
+    _write(directory, 'profile.folded', "".join(f"{stack} {count}\n" for stack, count in samples.most_common()))
+
+    if profiled.wait(1.0):
+        profiler.dump_stats(os.path.join(directory, 'dispatcher.pstats'))
+        text = io.StringIO()
+        pstats.Stats(profiler, stream=text).sort_stats('cumulative').print_stats(40)
+        _write(directory, 'dispatcher.txt', text.getvalue())
+    else:
+        LOG.warning("Diagnostics: the dispatcher thread didn't run the profile, is it stuck?")
+
+
+def _remove_old_reports():
+    reports = sorted(os.listdir(Config.DIAG_DIR))
+    for name in reports[:-Config.DIAG_KEEP]:
+        shutil.rmtree(os.path.join(Config.DIAG_DIR, name), ignore_errors=True)
+
+
+def _write(directory: str, filename: str, text: str):
+    with open(os.path.join(directory, filename), 'w', encoding='utf-8') as file:
+        file.write(text)
@@ -0,0 +1,144 @@
+"""
+Event dispatcher for the main loop.
+Callbacks from the mpv event thread and the gpiozero threads post events on a queue. The main thread sleeps on that
+queue until an event arrives or the next timer is due, so an idle radio doesn't wake up at all.
+"""
+import heapq
+import itertools
+import logging
+from queue import Queue, Empty
+from threading import Lock
+from time import monotonic
+from typing import Callable, Dict, List, Optional, Tuple
+
+from models.enums import Event
+
+LOG = logging.getLogger(__name__)
+
+_WAKE_UP = object()  # sentinel to let the loop recalculate its timeout
+_STOP = object()  # sentinel to end the loop
+
+
+class Timer:
+    """Handle for a callback scheduled with Dispatcher.call_later"""
+    def __init__(self, due: float, callback: Callable, args: tuple):
+        self.due = due
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        """Cancel the timer. A cancelled timer is dropped when it becomes due"""
+        self.cancelled = True
+
+
+class Dispatcher:
+    """
+    Run event handlers and timers in a single thread.
+    post() and call_later() are thread safe. The handlers and timer callbacks always run in the thread calling run().
+    """
+    def __init__(self):
+        self._queue = Queue()
+        self._handlers: Dict[Event, List[Callable]] = {}
+        self._timers = []  # heap with (due, seq, Timer)
+        self._timer_lock = Lock()
+        self._seq = itertools.count()
+
+    @property
+    def depth(self) -> Tuple[int, int]:
+        """Posted events waiting and scheduled timers"""
+        return self._queue.qsize(), len(self._timers)
+
+    def subscribe(self, event: Event, handler: Callable):
+        """
+        Call handler with the posted arguments whenever event is posted
+        @param event: Event
+        @param handler: callable
+        """
+        self._handlers.setdefault(event, []).append(handler)
+
+    def post(self, event: Event, *args):
+        """
+        Post an event. Can be called from any thread
+        @param event: Event
+        @param args: arguments passed to the subscribed handlers
+        """
+        self._queue.put((event, args))
+
+    def call_later(self, delay: float, callback: Callable, *args) -> Timer:
+        """
+        Run callback after delay seconds in the dispatcher thread
+        @param delay: float, seconds
+        @param callback: callable
+        @return: Timer
+        """
+        timer = Timer(monotonic() + delay, callback, args)
+        with self._timer_lock:
+            heapq.heappush(self._timers, (timer.due, next(self._seq), timer))
+        self._queue.put(_WAKE_UP)
+        return timer
+
+    def stop(self):
+        """Let run() return after the events already posted have been handled"""
+        self._queue.put(_STOP)
+
+    def run(self):
+        """Handle events and timers until stop() is called"""
+        while True:
+            timeout = self._run_due_timers()
+            try:
+                item = self._queue.get(timeout=timeout)
+            except Empty:
+                continue
+
+            if item is _STOP:
+                return
+            if item is not _WAKE_UP:
+                self._handle(*item)
+
+    def run_pending(self) -> Optional[float]:
+        """
+        Handle the posted events and the due timers without waiting, e.g. to drive the dispatcher from a replay.
+        A stop() is ignored
+        @return: seconds until the next timer is due or None when no timers are scheduled
+        """
+        while True:
+            timeout = self._run_due_timers()
+            try:
+                item = self._queue.get_nowait()
+            except Empty:
+                return timeout
+
+            if item is not _STOP and item is not _WAKE_UP:
+                self._handle(*item)
+
+    def _handle(self, event: Event, args: tuple):
+        for handler in self._handlers.get(event, ()):
+            try:
+                handler(*args)
+            except Exception:  # pylint: disable=broad-except
+                LOG.exception("Handler %s for %s failed", getattr(handler, '__qualname__', handler), event.name)
+
+    def _run_due_timers(self) -> Optional[float]:
+        """
+        Run the timers which are due
+        @return: seconds until the next timer is due or None when no timers are scheduled
+        """
+        while True:
+            with self._timer_lock:
+                if not self._timers:
+                    return None
+                due, _, timer = self._timers[0]
+                wait = due - monotonic()
+                if wait > 0 and not timer.cancelled:
+                    return wait
+                heapq.heappop(self._timers)
+
+            if not timer.cancelled:
+                try:
+                    timer.callback(*timer.args)
+                except Exception:  # pylint: disable=broad-except
+                    LOG.exception("Timer %s failed", getattr(timer.callback, '__qualname__', timer.callback))
+
+
+dispatcher = Dispatcher()
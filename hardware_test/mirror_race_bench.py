@@ -0,0 +1,83 @@
+"""
+Measure the endpoint race (mirror_race.py) against local http stand-ins with injected delays.
+Every stand-in answers after its delay with an endless audio/mpeg stream. For each scenario the time to the first audio
+bytes is measured for the first endpoint alone and for the race over all endpoints.
+Usage (from the piradio directory): PYTHONPATH=. python hardware_test/mirror_race_bench.py
+"""
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Event, Thread
+from time import monotonic, sleep
+
+from config import Config
+from mirror_race import MirrorRace
+from prefetch import WarmStream
+
+PORT = 8100
+DELAYS = {'fast': 0.05, 'slow': 2.0, 'stalled': 60.0}  # seconds before the response of a stand-in
+DEAD = f'http://127.0.0.1:{PORT - 1}/dead'  # nothing listens on this port
+
+SCENARIOS = (
+    ('first endpoint fast', ['fast', 'slow']),
+    ('first endpoint slow', ['slow', 'fast']),
+    ('first endpoint down', [DEAD, 'fast']),
+    ('first endpoint stalled', ['stalled', 'slow', 'fast']),
+)
+
+
+class StandIn(BaseHTTPRequestHandler):
+    def do_GET(self):
+        sleep(DELAYS[self.path.strip('/')])
+        self.send_response(200)
+        self.send_header('Content-Type', 'audio/mpeg')
+        self.end_headers()
+        try:
+            while True:
+                self.wfile.write(b'\xff' * 1024)
+                sleep(0.05)
+        except OSError:
+            pass
+
+    def log_message(self, *args):
+        pass
+
+
+def url(endpoint: str) -> str:
+    return endpoint if endpoint.startswith('http') else f'http://127.0.0.1:{PORT}/{endpoint}'
+
+
+def single(endpoint: str) -> float:
+    """@return: seconds to the first audio of one endpoint, inf when it didn't deliver"""
+    start = monotonic()
+    changed = Event()
+    stream = WarmStream(url(endpoint), on_change=changed.set)
+    changed.wait(Config.TIMEOUT)
+    seconds = monotonic() - start if stream.alive else float('inf')
+    stream.close()
+    return seconds
+
+
+def race(endpoints) -> float:
+    """@return: seconds to the first audio of the race, inf when no endpoint delivered"""
+    start = monotonic()
+    done = Event()
+    result = []
+
+    def on_done(_race, winner):
+        result.append(winner)
+        done.set()
+
+    MirrorRace([url(endpoint) for endpoint in endpoints], on_done)
+    done.wait(Config.TIMEOUT + 1)
+    seconds = monotonic() - start if result and result[0] is not None else float('inf')
+    if result and result[0] is not None:
+        result[0].close()
+    return seconds
+
+
+server = ThreadingHTTPServer(('127.0.0.1', PORT), StandIn)
+server.daemon_threads = True
+Thread(target=server.serve_forever, daemon=True).start()
+Config.PREFETCH_CONNECT_TIMEOUT = 5
+print(f"stagger {Config.RACE_STAGGER}s, connect timeout {Config.PREFETCH_CONNECT_TIMEOUT}s")
+for name, endpoints in SCENARIOS:
+    print(f"{name:24} first endpoint {single(endpoints[0]):6.3f}s   race {race(endpoints):6.3f}s")
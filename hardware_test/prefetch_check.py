@@ -0,0 +1,119 @@
+"""
+Check the warm streams and the prefetcher (prefetch.py) against stream_server.py.
+The server plays a counting byte pattern with icy metadata. The checks:
+    icy         the titles arrive through on_title and no metadata byte is left in the audio: every byte is the
+                previous one + 1
+    buffer      a warm stream keeps at most Config.PREFETCH_BUFFER bytes (+ one chunk) when nobody reads it
+    cap         warm() opens at most Config.PREFETCH_STREAMS streams, the most likely urls first
+    ttl         expire() closes a stream which wasn't wanted for Config.PREFETCH_TTL, and keeps a younger one
+Usage (from the piradio directory): PYTHONPATH=. python hardware_test/prefetch_check.py
+"""
+import os
+import subprocess
+import sys
+import tempfile
+from time import sleep
+
+from config import Config
+from prefetch import Prefetcher, WarmStream
+
+PORT = 8300
+METAINT = 8000  # not a multiple of the pattern length, so the metadata blocks fall anywhere in the pattern
+BITRATE = 4000  # kbit/s, 500 KB/s
+TITLES = ("Artist - First song", "Artiste - Deuxième chanson")
+URL = f'http://127.0.0.1:{PORT}/stream'
+
+failures = []
+
+
+def check(name: str, ok: bool, details: str = ""):
+    print(f"{'ok  ' if ok else 'FAIL'} {name}{': ' + details if details else ''}")
+    if not ok:
+        failures.append(name)
+
+
+def wait_alive(stream: WarmStream, timeout: float = 5.0) -> bool:
+    for _ in range(int(timeout / 0.05)):
+        if stream.alive:
+            return True
+        sleep(0.05)
+    return False
+
+
+def check_icy():
+    titles = []
+    stream = WarmStream(URL)
+    stream.on_title = titles.append
+    wait_alive(stream)
+    for title in TITLES:
+        server.stdin.write(f"title {title}\n")
+        server.stdin.flush()
+        sleep(0.5)
+    received = bytearray()
+    stream.close()  # chunks() returns the buffered audio, then ends
+    for chunk in stream.chunks():
+        received += chunk
+    check("icy titles", [title for title in titles if title] == list(TITLES), repr(titles))
+    gaps = sum(1 for previous, byte in zip(received, received[1:]) if byte != (previous + 1) % 256)
+    check("icy stripped", gaps == 0 and len(received) > METAINT,
+          f"{len(received)} bytes of audio, {gaps} bytes out of the pattern")
+
+
+def check_buffer():
+    stream = WarmStream(URL)
+    wait_alive(stream)
+    sleep(Config.PREFETCH_BUFFER / (BITRATE * 1000 / 8) * 3)  # the server sends 3 buffers full
+    stream.close()
+    size = sum(len(chunk) for chunk in stream.chunks())
+    check("buffer", 0 < size <= Config.PREFETCH_BUFFER + METAINT,
+          f"{size} bytes kept, PREFETCH_BUFFER {Config.PREFETCH_BUFFER}")
+
+
+def check_cap():
+    prefetcher = Prefetcher()
+    urls = [f'{URL}?{number}' for number in range(Config.PREFETCH_STREAMS + 2)]
+    taken = []
+    for url in urls:
+        prefetcher.warm(urls)  # again: take() closes the other streams
+        sleep(0.5)
+        stream = prefetcher.take(url)
+        taken.append(stream is not None)
+        if stream is not None:
+            stream.close()
+    expected = [True] * Config.PREFETCH_STREAMS + [False] * 2
+    check("cap", taken == expected, f"warm streams for {taken}, PREFETCH_STREAMS {Config.PREFETCH_STREAMS}")
+
+
+def check_ttl():
+    prefetcher = Prefetcher()
+    prefetcher.warm([URL])
+    sleep(Config.PREFETCH_TTL / 2)
+    prefetcher.expire()
+    stream = prefetcher.take(URL)
+    check("ttl young stream kept", stream is not None)
+    if stream is not None:
+        stream.close()
+
+    prefetcher.warm([URL])
+    sleep(Config.PREFETCH_TTL + 0.2)
+    prefetcher.expire()
+    check("ttl old stream closed", prefetcher.take(URL) is None)
+
+
+with tempfile.NamedTemporaryFile(suffix='.mp3', delete=False) as pattern:
+    pattern.write(bytes(range(256)) * 1024)
+server = subprocess.Popen([sys.executable, os.path.join(os.path.dirname(__file__), 'stream_server.py'), pattern.name,
+                           str(PORT), str(BITRATE), str(METAINT)], stdin=subprocess.PIPE, stdout=subprocess.DEVNULL,
+                          stderr=subprocess.DEVNULL, encoding='utf-8')
+try:
+    sleep(1)  # server startup
+    Config.PREFETCH_STREAMS = 3
+    Config.PREFETCH_TTL = 2
+    check_icy()
+    check_buffer()
+    check_cap()
+    check_ttl()
+finally:
+    server.kill()
+    os.unlink(pattern.name)
+sys.exit(1 if failures else 0)
@@ -0,0 +1,122 @@
+"""
+Check the station prober (prober.py) against local http stand-ins.
+Every stand-in plays a kind of station: a healthy icy stream, a redirect, a playlist, a hls playlist, an http error, a
+server which closes without audio, one which answers too late, a redirect loop, and a port where nothing listens. The harness probes
+every stand-in once and prints the result, then runs rounds over a catalog of the stand-ins with a small byte budget to
+show how the rounds go on where the previous one stopped.
+Usage (from the piradio directory): PYTHONPATH=. python hardware_test/prober_bench.py
+"""
+import asyncio
+import logging
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread
+from time import sleep
+
+from config import Config
+from models.catalog import catalog
+from models.stations import Station
+from prober import Prober, probe
+
+PORT = 8200
+BASE = f'http://127.0.0.1:{PORT}'
+DEAD = f'http://127.0.0.1:{PORT - 1}/dead'  # nothing listens on this port
+
+# name -> url and expected result
+STAND_INS = {
+    'ok': (f'{BASE}/ok', "reachable, mp3 128 kbit/s"),
+    'redirect': (f'{BASE}/redirect', "reachable after a redirect to /ok"),
+    'playlist': (f'{BASE}/playlist.m3u', "reachable through the playlist entry /ok"),
+    'hls': (f'{BASE}/hls.m3u8', "reachable, the hls playlist itself"),
+    'missing': (f'{BASE}/missing', "down: http 404"),
+    'empty': (f'{BASE}/empty', "down: no audio"),
+    'slow': (f'{BASE}/slow', "down: timeout"),
+    'loop': (f'{BASE}/loop', "down: too many redirects"),
+    'dead': (DEAD, "down: connection refused"),
+}
+
+
+class StandIn(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path == '/ok':
+            self._stream()
+        elif self.path == '/redirect':
+            self._redirect('/ok')
+        elif self.path == '/loop':
+            self._redirect('/loop')
+        elif self.path == '/playlist.m3u':
+            self._playlist(f"#EXTM3U\n#EXTINF:-1,Stand-in\n{BASE}/ok\n")
+        elif self.path == '/hls.m3u8':
+            self._playlist("#EXTM3U\n#EXT-X-VERSION:3\n#EXT-X-TARGETDURATION:6\n#EXTINF:6,\nseg_001.aac\n")
+        elif self.path == '/empty':
+            self.send_response(200)
+            self.send_header('Content-Type', 'audio/mpeg')
+            self.end_headers()
+        elif self.path == '/slow':
+            sleep(Config.PROBE_TIMEOUT + 1)
+            self._stream()
+        else:
+            self.send_error(404)
+
+    def _playlist(self, text: str):
+        body = text.encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'audio/x-mpegurl')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _redirect(self, location: str):
+        self.send_response(302)
+        self.send_header('Location', location)
+        self.end_headers()
+
+    def _stream(self):
+        self.send_response(200)
+        self.send_header('Content-Type', 'audio/mpeg')
+        self.send_header('icy-br', '128')
+        self.end_headers()
+        try:
+            while True:
+                self.wfile.write(b'\xff' * 1024)
+                sleep(0.05)
+        except OSError:
+            pass
+
+    def log_message(self, *args):
+        pass
+
+
+async def probe_all():
+    for name, (url, expected) in STAND_INS.items():
+        try:
+            result, received = await probe(url)
+            outcome = (f"reachable {result.latency * 1000:5.0f}ms {result.codec} {result.bitrate} kbit/s"
+                       if result.reachable else f"down: {result.error}")
+        except (OSError, asyncio.TimeoutError) as err:  # Prober._probe_station counts these as down
+            outcome, received = f"down: {type(err).__name__}", 0
+        print(f"{name:10} {outcome:40} {received:6} bytes   expected {expected}")
+
+
+async def rounds(prober: Prober, count: int):
+    for _ in range(count):
+        # the prober logs the stations probed in the round
+        await prober._round()  # pylint: disable=protected-access
+    down = sorted(station.name for station in map(catalog.get, catalog.ids) if prober.is_down(station))
+    print(f"down: {', '.join(down)}")
+
+
+server = ThreadingHTTPServer(('127.0.0.1', PORT), StandIn)
+server.daemon_threads = True
+Thread(target=server.serve_forever, daemon=True).start()
+Config.PROBE_TIMEOUT = 2
+
+print(f"probe timeout {Config.PROBE_TIMEOUT}s")
+asyncio.run(probe_all())
+
+# a healthy stand-in costs about 1.2 KiB, so a round stops after a few stations
+Config.PROBE_BUDGET = 2 * 1024
+Config.PROBE_CONCURRENCY = 2
+catalog.load_stations(Station(name, url) for name, (url, _) in STAND_INS.items())
+print(f"\nbudget {Config.PROBE_BUDGET} bytes per round, {Config.PROBE_CONCURRENCY} probes at a time")
+logging.basicConfig(level=logging.INFO, format='%(message)s')
+asyncio.run(rounds(Prober(), 3))
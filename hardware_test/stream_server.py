@@ -0,0 +1,81 @@
+"""
+Local http stream server to test the stream watchdog with the real player, and the warm streams (prefetch_check.py).
+Serves an audio file in a loop at its bitrate. With an icy-metaint, a client which sends 'Icy-MetaData: 1' gets an
+icy metadata block with the StreamTitle after every metaint bytes of audio. Commands on stdin:
+    stall           stop sending data, keep the connections open
+    resume          send data again
+    drop            close the open connections
+    title <text>    StreamTitle of the next metadata blocks
+Usage: python stream_server.py <file.mp3> [port] [bitrate kbit/s] [icy-metaint]
+Add Station("Test", "http://127.0.0.1:8000/stream") to the station list.
+"""
+import sys
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Event, Thread
+from time import sleep
+
+CHUNK = 4096
+
+running = Event()
+running.set()
+drops = [0]  # generation of the connections, incremented by 'drop'
+title = [""]
+
+
+class Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        metaint = METAINT if self.headers.get('Icy-MetaData') == '1' else 0
+        self.send_response(200)
+        self.send_header('Content-Type', 'audio/mpeg')
+        if metaint:
+            self.send_header('icy-metaint', str(metaint))
+        self.end_headers()
+        generation = drops[0]
+        until_metadata = metaint
+        with open(FILENAME, 'rb') as file:
+            while generation == drops[0]:
+                running.wait()
+                chunk = file.read(min(CHUNK, until_metadata) if metaint else CHUNK)
+                if not chunk:
+                    file.seek(0)
+                    continue
+                try:
+                    self.wfile.write(chunk)
+                    until_metadata -= len(chunk)
+                    if metaint and not until_metadata:
+                        self.wfile.write(metadata())
+                        until_metadata = metaint
+                except OSError:
+                    return
+                sleep(len(chunk) / BYTES_PER_SECOND)
+
+
+def metadata() -> bytes:
+    """Icy metadata block: length / 16 in the first byte, then the padded text"""
+    text = f"StreamTitle='{title[0]}';".encode('utf-8')
+    blocks = (len(text) + 15) // 16
+    return bytes([blocks]) + text.ljust(blocks * 16, b'\0')
+
+
+def commands():
+    for line in sys.stdin:
+        command = line.strip()
+        if command == 'stall':
+            running.clear()
+        elif command == 'resume':
+            running.set()
+        elif command == 'drop':
+            drops[0] += 1
+            running.set()
+        elif command.startswith('title '):
+            title[0] = command[6:]
+        print(f"{command}: ok")
+
+
+FILENAME = sys.argv[1]
+PORT = int(sys.argv[2]) if len(sys.argv) > 2 else 8000
+BYTES_PER_SECOND = (int(sys.argv[3]) if len(sys.argv) > 3 else 128) * 1000 / 8
+METAINT = int(sys.argv[4]) if len(sys.argv) > 4 else 0
+
+Thread(target=commands, daemon=True).start()
+ThreadingHTTPServer(('127.0.0.1', PORT), Handler).serve_forever()
@@ -2,6 +2,7 @@ from time import sleep
 
 from lcd_screen import lcd
 
+lcd.init()
 lcd.lcd_backlight_toggle(on=True)
 lcd.display_text("bats bats bats baaats! bats bats bats!")
 
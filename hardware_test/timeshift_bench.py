@@ -0,0 +1,79 @@
+"""
+Benchmark of the timeshift buffer (timeshift.py). Run it on the raspberry pi from the piradio directory.
+    PYTHONPATH=. python hardware_test/timeshift_bench.py
+        ring file only: write and read through Config.TIMESHIFT_SIZE as fast as possible
+    PYTHONPATH=. python hardware_test/timeshift_bench.py http://127.0.0.1:8000/stream [seconds]
+        record a stream and play it back in real time, e.g. a 320 kbps file served by stream_server.py:
+        python hardware_test/stream_server.py test320.mp3 8000 320
+The cpu time is the cpu time of the process (all threads), compare it with the idle radio.
+"""
+import os
+import sys
+from threading import Thread
+from time import monotonic, process_time, sleep
+
+from config import Config
+from prefetch import WarmStream
+from timeshift import CHUNK_SIZE, RingFile, timeshift
+
+STREAM_RATE = 320 * 1000 / 8  # bytes per second of a 320 kbps stream
+SYNTHETIC_BYTES = 256 * 1024 * 1024
+
+
+def ring_only():
+    ring = RingFile(Config.TIMESHIFT_FILE, Config.TIMESHIFT_SIZE)
+    chunk = os.urandom(CHUNK_SIZE)
+    position = 0
+    wall, cpu = monotonic(), process_time()
+    while ring.written < SYNTHETIC_BYTES:
+        ring.append(chunk)
+        while position < ring.written:
+            position += len(bytes(ring.view(position, CHUNK_SIZE)))
+    wall, cpu = monotonic() - wall, process_time() - cpu
+    ring.close()
+    os.unlink(Config.TIMESHIFT_FILE)
+
+    rate = SYNTHETIC_BYTES / cpu
+    print(f"ring file {Config.TIMESHIFT_SIZE // 1024 // 1024} MiB: "
+          f"wrote and read {SYNTHETIC_BYTES // 1024 // 1024} MiB in {wall:.2f}s wall, {cpu:.2f}s cpu "
+          f"-> {rate / 1024 / 1024:.1f} MiB/s per cpu second")
+    print(f"cpu share of a 320 kbps stream: {STREAM_RATE / rate * 100:.3f}%")
+
+
+def stream(url: str, seconds: float):
+    received = [0]
+    first_chunk = []
+
+    def player(start: float):
+        """Read like mpv: as fast as the recording allows, then in real time"""
+        for chunk in timeshift.chunks():
+            if not first_chunk:
+                first_chunk.append(monotonic() - start)
+            received[0] += len(chunk)
+
+    wall, cpu = monotonic(), process_time()
+    timeshift.record(url, WarmStream(url))
+    reader = Thread(target=player, args=(wall,), daemon=True)
+    reader.start()
+    sleep(seconds)
+    wall, cpu = monotonic() - wall, process_time() - cpu
+    print(f"recorded {seconds:.0f}s: {received[0] / 1024:.0f} KiB played ({received[0] * 8 / 1000 / wall:.0f} kbps), "
+          f"first chunk after {first_chunk[0] * 1000 if first_chunk else float('nan'):.0f} ms")
+    print(f"cpu {cpu:.3f}s -> {cpu / wall * 100:.2f}% of one core")
+
+    first_chunk.clear()
+    start = monotonic()
+    delay = timeshift.seek(-seconds / 2)
+    rewind = Thread(target=player, args=(start,), daemon=True)
+    rewind.start()
+    sleep(0.5)
+    print(f"rewind to -{delay:.0f}s: first chunk after "
+          f"{first_chunk[0] * 1000 if first_chunk else float('nan'):.1f} ms")
+    timeshift.close()
+
+
+Config.TIMESHIFT_FILE += '.bench'
+if len(sys.argv) > 1:
+    stream(sys.argv[1], float(sys.argv[2]) if len(sys.argv) > 2 else 30)
+else:
+    ring_only()
@@ -0,0 +1,189 @@
+"""
+Now-playing history: every icy-title shown for the playing station.
+    - the last Config.HISTORY_SIZE entries are kept in a ring in memory. Station names and titles are interned, a title
+      which comes back (jingles, the programme name) is stored once
+    - all entries are appended to Config.HISTORY_FILE, one line per entry: '<unix time>\t<station id>\t<title>'.
+      When the file grows past Config.HISTORY_MAX_BYTES it is rotated to HISTORY_FILE.1 (the older one is dropped)
+    - next to each log file an index HISTORY_FILE.idx has a line 'YYYY-MM-DD <offset>' per day: the byte offset of the
+      first entry of the day, so a lookup by time seeks to the day instead of reading the whole file
+add() only appends to the ring and hands the entry to the writer thread (write_behind.py), which appends the entries
+to the file in batches, Config.HISTORY_DELAY seconds after the first one.
+"""
+import logging
+import os
+import sys
+from collections import deque
+from datetime import date
+from threading import Condition
+from time import monotonic, time
+from typing import Deque, Dict, List, NamedTuple, Optional
+
+from config import Config
+from metrics import metrics
+from models.catalog import catalog
+from models.stations import Station
+from write_behind import WriteBehind
+
+LOG = logging.getLogger(__name__)
+
+
+class Entry(NamedTuple):
+    time: float  # unix time
+    station_id: str
+    station: str  # station name
+    title: str
+
+
+class History:
+    """Ring of the recent titles and the append-only history file"""
+    def __init__(self, filename: Optional[str]):
+        self._filename = filename
+        self._ring: Deque[Entry] = deque(maxlen=Config.HISTORY_SIZE)
+        self._pending: List[Entry] = []  # entries for the writer thread
+        self._pending_since: Optional[float] = None
+        self._cond = Condition()
+        self._writer = WriteBehind("history_writer", self._cond, self._due, self._take, self._write)
+        self._last_day: Optional[str] = None  # last day in the index of the current file
+
+    def add(self, station: Station, title: str):
+        """
+        Record a title of the playing station. Repeats of the last title are ignored. Doesn't wait for the file
+        @param station: Station
+        @param title: str
+        """
+        with self._cond:
+            if self._ring and self._ring[-1].title == title and self._ring[-1].station_id == station.id:
+                return
+            entry = Entry(time(), sys.intern(station.id), sys.intern(station.name), sys.intern(title))
+            self._ring.append(entry)
+            if self._filename is None or self._writer.closed:
+                return
+            self._pending.append(entry)
+            if self._pending_since is None:
+                self._pending_since = monotonic()
+            self._writer.changed()
+
+    def recent(self, count: int = None) -> List[Entry]:
+        """@return: the last count (default all) entries in memory, newest first"""
+        with self._cond:
+            entries = list(self._ring)
+        entries.reverse()
+        return entries[:count] if count is not None else entries
+
+    def between(self, start: float, end: float = None, limit: int = 1000) -> List[Entry]:
+        """
+        Entries between two unix times, from the history files and the entries not written yet
+        @param start: float
+        @param end: float, default now
+        @param limit: max entries returned, the oldest come first
+        @return: list of Entry, oldest first
+        """
+        end = time() if end is None else end
+        entries: List[Entry] = []
+        if self._filename is not None:
+            for filename in (self._filename + '.1', self._filename):
+                entries.extend(_read(filename, start, end, limit - len(entries)))
+        with self._cond:
+            entries.extend(entry for entry in self._pending if start <= entry.time <= end)
+        return entries[:limit]
+
+    def close(self):
+        """Stop the writer thread and write the pending entries"""
+        self._writer.close()
+
+    def _due(self) -> Optional[float]:
+        """Config.HISTORY_DELAY seconds after the first pending entry. Call with the lock held"""
+        return None if self._pending_since is None else self._pending_since + Config.HISTORY_DELAY
+
+    def _take(self) -> Optional[List[Entry]]:
+        """The pending entries. Call with the lock held"""
+        if not self._pending:
+            return None
+        entries, self._pending, self._pending_since = self._pending, [], None
+        return entries
+
+    def _write(self, entries: List[Entry]):
+        """Append entries to the file, rotate it when it is full"""
+        start = monotonic()
+        try:
+            if self._last_day is None:
+                self._last_day = _last_day(self._filename + '.idx')
+            with open(self._filename, 'ab') as file, open(self._filename + '.idx', 'a', encoding='utf-8') as index:
+                for entry in entries:
+                    day = date.fromtimestamp(entry.time).isoformat()
+                    if day != self._last_day:
+                        index.write(f"{day} {file.tell()}\n")
+                        self._last_day = day
+                    title = entry.title.replace('\t', ' ').replace('\n', ' ')
+                    file.write(f"{entry.time:.0f}\t{entry.station_id}\t{title}\n".encode('utf-8'))
+                size = file.tell()
+            if size > Config.HISTORY_MAX_BYTES:
+                os.replace(self._filename, self._filename + '.1')
+                os.replace(self._filename + '.idx', self._filename + '.1.idx')
+                self._last_day = None
+                LOG.info("History file rotated: %s", self._filename)
+        except OSError as err:
+            LOG.warning("Cannot write history %s: %s", self._filename, err)
+            return
+        metrics.inc('history_entries_total', len(entries))
+        metrics.observe('history_write_seconds', monotonic() - start)
+
+
+def _index(filename: str) -> Dict[str, int]:
+    """@return: day -> offset of its first entry, from the index of a history file. Empty when there is no index"""
+    offsets = {}
+    try:
+        with open(filename + '.idx', 'r', encoding='utf-8') as file:
+            for line in file:
+                day, _, offset = line.partition(' ')
+                offsets[day] = int(offset)
+    except FileNotFoundError:
+        pass
+    except (OSError, ValueError) as err:
+        LOG.warning("Ignoring history index %s.idx: %s", filename, err)
+        return {}
+    return offsets
+
+
+def _last_day(index_filename: str) -> Optional[str]:
+    """@return: the last day in an index file"""
+    try:
+        with open(index_filename, 'r', encoding='utf-8') as file:
+            lines = file.read().split()
+        return lines[-2] if len(lines) >= 2 else None
+    except OSError:
+        return None
+
+
+def _read(filename: str, start: float, end: float, limit: int) -> List[Entry]:
+    """Entries of a history file between start and end. Seeks to the first day >= the day of start"""
+    if limit <= 0:
+        return []
+    first_day = date.fromtimestamp(start).isoformat()
+    index = _index(filename)
+    offsets = [offset for day, offset in index.items() if day >= first_day]
+    if index and not offsets:
+        return []  # all days in the file are before start
+    entries: List[Entry] = []
+    try:
+        with open(filename, 'rb') as file:
+            file.seek(min(offsets, default=0))
+            for line in file:
+                try:
+                    timestamp, station_id, title = line.decode('utf-8').rstrip('\n').split('\t', 2)
+                    entry_time = float(timestamp)
+                except (UnicodeDecodeError, ValueError):
+                    continue  # a line cut by a power loss
+                if entry_time > end:
+                    break
+                if entry_time >= start:
+                    station = catalog.get(station_id)
+                    entries.append(Entry(entry_time, station_id, station.name if station else station_id, title))
+                    if len(entries) >= limit:
+                        break
+    except FileNotFoundError:
+        pass
+    return entries
+
+
+history = History(Config.HISTORY_FILE)
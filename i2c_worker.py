@@ -0,0 +1,189 @@
+"""
+Single owner of the i2c bus.
+The lcd is written from the dispatcher thread, the scroll thread and at startup. Instead of sharing the SMBus handle,
+every writer posts a frame (a list of commands and data) to the worker and returns immediately. The worker thread
+writes the frames in order. Consecutive commands and data, also of frames waiting in the queue, are packed into as few
+write_i2c_block_data transactions as possible with the continuation bit (Co) of the control byte:
+    [0x80, cmd, 0x80, cmd, ..., 0x40, data, data, ...]
+A transaction carries at most MAX_BLOCK bytes after the control byte (smbus limit). Commands which need execution time
+(clear display, return home) end a transaction and are followed by a pause.
+The queue depth and the bus time are reported in the metrics, e.g. to compare 100 kHz and 400 kHz bus speeds.
+"""
+import logging
+from dataclasses import dataclass
+from queue import Queue
+from threading import Thread
+from time import monotonic, sleep
+from typing import Callable, List, NamedTuple, Optional, Tuple
+
+from metrics import metrics
+
+LOG = logging.getLogger(__name__)
+
+MAX_BLOCK = 32  # smbus block limit
+CTRL_CONTINUE = 0x80  # Co bit: another control byte follows after the next byte
+CTRL_COMMAND = 0x00
+CTRL_DATA = 0x40
+
+
+class Op(NamedTuple):
+    """A command or a block of data, followed by a pause in seconds"""
+    ctrl: int  # CTRL_COMMAND or CTRL_DATA
+    data: bytes
+    delay: float = 0.0
+
+
+@dataclass
+class BusStats:
+    """Bus traffic. 'bytes' counts the bytes following the address byte (control bytes + payload)"""
+    frames: int = 0
+    transactions: int = 0
+    bytes: int = 0
+    seconds: float = 0.0
+
+
+def batches(ops: List[Op]) -> List[Tuple[List[int], float]]:
+    """
+    Pack operations in transactions
+    @param ops: list of Op
+    @return: list of (transaction, pause after the transaction). A transaction is a list with the control byte and at
+        most MAX_BLOCK bytes. The transaction is empty for a pause after a data block
+    """
+    result = []
+    current: List[int] = []
+    last_ctrl = 0  # index of the last control byte in current
+
+    def close(delay: float = 0.0):
+        nonlocal current
+        if current:
+            current[last_ctrl] &= ~CTRL_CONTINUE  # no control byte follows
+        if current or delay:
+            result.append((current, delay))
+        current = []
+
+    for op in ops:
+        if op.ctrl == CTRL_COMMAND:
+            for cmd in op.data:
+                if len(current) + 2 > MAX_BLOCK + 1:
+                    close()
+                last_ctrl = len(current)
+                current += [CTRL_CONTINUE | CTRL_COMMAND, cmd]
+        else:
+            data = list(op.data)
+            while data:
+                if len(current) + 2 > MAX_BLOCK + 1:
+                    close()
+                room = MAX_BLOCK - len(current)
+                last_ctrl = len(current)
+                current += [CTRL_DATA] + data[:room]
+                data = data[room:]
+                close()  # the data runs until the end of the transaction
+        if op.delay:
+            close(op.delay)
+    close()
+    return result
+
+
+class I2cWorker:
+    """Thread which owns the SMBus handle and writes the posted frames"""
+    def __init__(self, addr: int, on_error: Callable[[], None] = None):
+        """
+        @param addr: i2c address
+        @param on_error: called in the worker thread after a failed write. The frames may be written partly
+        """
+        self._addr = addr
+        self._on_error = on_error
+        self._bus = None
+        self._queue: Queue = Queue()
+        self._thread: Optional[Thread] = None
+        self.last_batch = BusStats()  # traffic of the last write
+        self.total = BusStats()  # traffic since start
+
+    def start(self, bus):
+        """
+        Hand over the bus and start the worker thread. Nobody else uses the bus from now on
+        @param bus: object like smbus.SMBus
+        """
+        self._bus = bus
+        self._thread = Thread(target=self._run, name="i2c_worker", daemon=True)
+        self._thread.start()
+
+    @property
+    def running(self) -> bool:
+        """The worker thread is started"""
+        return self._thread is not None
+
+    @property
+    def depth(self) -> int:
+        """Frames waiting to be written"""
+        return self._queue.qsize()
+
+    def post(self, ops: List[Op], done: Callable[[], None] = None):
+        """
+        Queue a frame. Returns immediately
+        @param ops: list of Op
+        @param done: called in the worker thread when the frame is written
+        """
+        if not ops and done is None:
+            return
+        self._queue.put((ops, done))
+        metrics.set_gauge('i2c_queue_depth', self._queue.qsize())
+
+    def join(self):
+        """Wait until the posted frames are written"""
+        if self._thread is not None:
+            self._queue.join()
+
+    def _run(self):
+        while True:
+            frames = [self._queue.get()]
+            # pack the frames which are waiting too
+            while not self._queue.empty():
+                frames.append(self._queue.get_nowait())
+            metrics.observe('i2c_batch_frames', len(frames))
+            metrics.set_gauge('i2c_queue_depth', 0)
+            try:
+                self._write([op for ops, _ in frames for op in ops], len(frames))
+                for _, done in frames:
+                    if done is not None:
+                        done()
+            except OSError as err:
+                LOG.error("I2c write failed: %s", err)
+                self._error()
+            except Exception:  # pylint: disable=broad-except
+                # keep the thread alive: join() would wait forever for the frames nobody takes from the queue
+                LOG.exception("I2c frames failed")
+                self._error()
+            finally:
+                for _ in frames:
+                    self._queue.task_done()
+
+    def _error(self):
+        if self._on_error is None:
+            return
+        try:
+            self._on_error()
+        except Exception:  # pylint: disable=broad-except
+            LOG.exception("I2c error callback failed")
+
+    def _write(self, ops: List[Op], frames: int):
+        stats = BusStats(frames=frames)
+        for transaction, delay in batches(ops):
+            if transaction:
+                start = monotonic()
+                self._bus.write_i2c_block_data(self._addr, transaction[0], transaction[1:])
+                stats.seconds += monotonic() - start
+                stats.transactions += 1
+                stats.bytes += len(transaction)
+            if delay:
+                sleep(delay)
+
+        self.last_batch = stats
+        self.total.frames += stats.frames
+        self.total.transactions += stats.transactions
+        self.total.bytes += stats.bytes
+        self.total.seconds += stats.seconds
+        metrics.inc('i2c_transactions_total', stats.transactions)
+        metrics.inc('i2c_bytes_total', stats.bytes)
+        metrics.inc('i2c_bus_seconds_total', stats.seconds)
+        metrics.observe('i2c_write_seconds', stats.seconds)
@@ -0,0 +1,174 @@
+"""
+Character encoding for the lcd controller.
+The controller has a ROM character set (HD44780 compatible, ROM code A00): ascii without backslash and tilde, plus a
+few european and greek characters. Other characters are drawn from one of the 8 custom glyphs in CGRAM, when there is
+a glyph for them, or replaced by the nearest ROM character (e.g. 'Å' -> 'A').
+The translation is precomputed and the encoded lines are kept in a LRU cache, so a title which is displayed again
+(scrolling, metadata repeated by the stream) costs a dict lookup.
+"""
+import unicodedata
+from functools import lru_cache
+from typing import Dict, Iterable, List, Optional, Tuple, Union
+
+from config import Config
+
+CGRAM_SLOTS = 8
+GLYPH_ROWS = 8  # 5x8 dots
+UNKNOWN = ord('?')
+
+# ROM characters outside ascii
+ROM_EXTRA = {
+    '¥': 0x5C, '→': 0x7E, '←': 0x7F, '·': 0xA5, 'α': 0xE0, 'ä': 0xE1, 'ß': 0xE2, 'ε': 0xE3, 'µ': 0xE4, 'σ': 0xE5,
+    'ρ': 0xE6, '√': 0xE8, '¢': 0xEC, 'ñ': 0xEE, 'ö': 0xEF, 'θ': 0xF2, 'Ω': 0xF4, 'ü': 0xF5, 'Σ': 0xF6, 'π': 0xF7,
+    '÷': 0xFD, '°': 0xDF,
+}
+
+# characters without ROM code which are replaced before the text is wrapped
+TEXT_REPLACEMENTS = str.maketrans({
+    '\u00a0': ' ', '‘': "'", '’': "'", '‚': "'", '“': '"', '”': '"', '„': '"', '–': '-', '—': '-', '…': '...',
+    '\t': ' ', '\r': ' ', '\n': ' ',
+})
+
+# custom glyphs, 8 rows of 5 dots
+GLYPHS: Dict[str, Tuple[int, ...]] = {
+    'é': (0b00010, 0b00100, 0b01110, 0b10001, 0b11111, 0b10000, 0b01110, 0b00000),
+    'è': (0b01000, 0b00100, 0b01110, 0b10001, 0b11111, 0b10000, 0b01110, 0b00000),
+    'ê': (0b00100, 0b01010, 0b01110, 0b10001, 0b11111, 0b10000, 0b01110, 0b00000),
+    'ë': (0b01010, 0b00000, 0b01110, 0b10001, 0b11111, 0b10000, 0b01110, 0b00000),
+    'à': (0b01000, 0b00100, 0b01110, 0b00001, 0b01111, 0b10001, 0b01111, 0b00000),
+    'â': (0b00100, 0b01010, 0b01110, 0b00001, 0b01111, 0b10001, 0b01111, 0b00000),
+    'ç': (0b00000, 0b01110, 0b10000, 0b10000, 0b10001, 0b01110, 0b00100, 0b01000),
+    'ô': (0b00100, 0b01010, 0b01110, 0b10001, 0b10001, 0b10001, 0b01110, 0b00000),
+    'ù': (0b01000, 0b00100, 0b10001, 0b10001, 0b10001, 0b10011, 0b01101, 0b00000),
+    'û': (0b00100, 0b01010, 0b10001, 0b10001, 0b10001, 0b10011, 0b01101, 0b00000),
+    'î': (0b00100, 0b01010, 0b00000, 0b01100, 0b00100, 0b00100, 0b01110, 0b00000),
+    'ï': (0b01010, 0b00000, 0b01100, 0b00100, 0b00100, 0b00100, 0b01110, 0b00000),
+    'É': (0b00010, 0b00100, 0b11111, 0b10000, 0b11110, 0b10000, 0b11111, 0b00000),
+    'È': (0b01000, 0b00100, 0b11111, 0b10000, 0b11110, 0b10000, 0b11111, 0b00000),
+    '€': (0b00110, 0b01001, 0b11100, 0b01000, 0b11100, 0b01001, 0b00110, 0b00000),
+    '\\': (0b00000, 0b10000, 0b01000, 0b00100, 0b00010, 0b00001, 0b00000, 0b00000),
+    '~': (0b00000, 0b00000, 0b01000, 0b10101, 0b00010, 0b00000, 0b00000, 0b00000),
+}
+
+Cells = Union[bytes, Tuple[Union[int, str], ...]]  # ROM codes, or ROM codes and glyph characters
+
+
+def _build_rom_table() -> Dict[str, int]:
+    table = {chr(code): code for code in range(0x20, 0x7E) if code != 0x5C}
+    table.update(ROM_EXTRA)
+    return table
+
+
+ROM_TABLE = _build_rom_table()
+ROM_REVERSE = {code: char for char, code in ROM_TABLE.items()}
+
+
+def fallback(char: str) -> int:
+    """
+    Nearest ROM code for a character without ROM code, e.g. 'é' -> 'e'
+    @param char: str of length 1
+    @return: int
+    """
+    base = unicodedata.normalize('NFKD', char)[:1]
+    return ROM_TABLE.get(base, UNKNOWN)
+
+
+GLYPH_FALLBACK = {char: fallback(char) for char in GLYPHS}
+GLYPH_FALLBACK.update({'\\': ord('/'), '~': ord('-')})
+
+
+def normalize(text: str) -> str:
+    """Replace the characters which have an ascii equivalent of another length, before the text is wrapped"""
+    return text.translate(TEXT_REPLACEMENTS)
+
+
+@lru_cache(maxsize=Config.LCD_CACHE)
+def encode(line: str) -> Cells:
+    """
+    Encode a line. The characters with a custom glyph are kept as str, their CGRAM slot is known at display time
+    @param line: normalized text
+    @return: bytes when the line doesn't need custom glyphs, else a tuple with ints and str
+    """
+    cells: List[Union[int, str]] = []
+    for char in line:
+        code = ROM_TABLE.get(char)
+        if code is not None:
+            cells.append(code)
+        elif char in GLYPHS:
+            cells.append(char)
+        else:
+            cells.append(fallback(char))
+    if all(isinstance(cell, int) for cell in cells):
+        return bytes(cells)
+    return tuple(cells)
+
+
+def glyphs(cells: Cells) -> List[str]:
+    """@return: the characters which need a custom glyph, in order of appearance"""
+    if isinstance(cells, bytes):
+        return []
+    return [cell for cell in cells if isinstance(cell, str)]
+
+
+class GlyphAllocator:
+    """Assign the custom glyphs to the 8 CGRAM slots. A slot is only rewritten when its glyph changes"""
+    def __init__(self):
+        self._slots: List[Optional[str]] = [None] * CGRAM_SLOTS
+        self._index: Dict[str, int] = {}
+
+    def allocate(self, needed: Iterable[str]) -> List[int]:
+        """
+        Assign slots to the needed glyphs. Glyphs which don't fit fall back to ROM characters
+        @param needed: characters with a custom glyph, most important first
+        @return: the slots which have a new glyph and must be written to CGRAM
+        """
+        needed = list(dict.fromkeys(needed))[:CGRAM_SLOTS]
+        wanted = set(needed)
+        # reuse empty slots first, so the glyphs of the previous text stay loaded as long as possible
+        free = sorted((slot for slot, char in enumerate(self._slots) if char not in wanted),
+                      key=lambda slot: self._slots[slot] is not None)
+        changed = []
+        for char in needed:
+            if char in self._index:
+                continue
+            slot = free.pop(0)
+            old = self._slots[slot]
+            if old is not None:
+                del self._index[old]
+            self._slots[slot] = char
+            self._index[char] = slot
+            changed.append(slot)
+        return changed
+
+    def bitmap(self, slot: int) -> List[int]:
+        """@return: the CGRAM rows of a slot"""
+        return list(GLYPHS[self._slots[slot]])
+
+    def to_bytes(self, cells: Cells) -> bytearray:
+        """
+        Get the DDRAM codes of an encoded line. The codes of the CGRAM slots are 0-7
+        @param cells: encode() result
+        @return: bytearray
+        """
+        if isinstance(cells, bytes):
+            return bytearray(cells)
+        return bytearray(cell if isinstance(cell, int) else self._index.get(cell, GLYPH_FALLBACK[cell])
+                         for cell in cells)
+
+
+def decode(data: bytes, cgram: bytes) -> str:
+    """
+    Text of DDRAM codes, for the simulator
+    @param data: DDRAM codes
+    @param cgram: the 64 bytes of CGRAM, to recognize the custom glyphs
+    @return: str. '?' for codes without character
+    """
+    bitmaps = {bitmap: char for char, bitmap in GLYPHS.items()}
+    chars = []
+    for code in data:
+        if code < CGRAM_SLOTS:
+            bitmap = tuple(cgram[code * GLYPH_ROWS:(code + 1) * GLYPH_ROWS])
+            chars.append(bitmaps.get(bitmap, '?'))
+        else:
+            chars.append(ROM_REVERSE.get(code, '?'))
+    return ''.join(chars)
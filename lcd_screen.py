@@ -8,14 +8,17 @@ Modified for working with VA LCD
 """
 import logging
 import textwrap
-from time import sleep, time
-from threading import Thread
-from typing import List
-
-from gpiozero import OutputDevice
-from smbus import SMBus
+from functools import lru_cache, partial
+from time import monotonic
+from threading import Condition, Lock, Thread
+from typing import Callable, List, Optional, Tuple
 
+import lcd_charset
+from backends import backend
 from config import Config
+from i2c_worker import CTRL_COMMAND, CTRL_DATA, BusStats, I2cWorker, Op
+from lcd_charset import GlyphAllocator
+from metrics import metrics
 
 LOG = logging.getLogger(__name__)
 
@@ -61,56 +64,107 @@ LCD_5x11DOTS = 0x04
 LCD_5x8DOTS = 0x00
 
 # Control bytes
-CTRLBYTE_DATA = 0x40  # write to DDRAM/CGRAM
-CTRLBYTE_COMMAND = 0x00  # write to IR
+CTRLBYTE_DATA = CTRL_DATA  # write to DDRAM/CGRAM
+CTRLBYTE_COMMAND = CTRL_COMMAND  # write to IR
+
+# execution times
+POWER_ON_DELAY = 0.02
+CLEAR_DELAY = 0.01
+
+# display geometry
+LCD_WIDTH = 16
+LCD_LINES = 2
+LINE_ADDRESSES = (0x00, 0x40)  # DDRAM address of the first character of each line
+BLANK = 0x20  # DDRAM content after LCD_CLEARDISPLAY
+STALE = 0xFF  # shadow value of a cell whose glyph changed. Never written by the encoder
+
+# Writing the unchanged cells between two changed runs is cheaper than a new LCD_SETDDRAMADDR command
+# (2 bytes: control byte + command) when the gap is this small
+MAX_GAP = 2
 
 
 class Lcd:
     """
-    Class to write strings to lcd display. Writing a string always clears the lcd and start at the first character in
-    the upper left. When the string doesn't fit on the display, the 2nd line will start scrolling.
+    Class to write strings to lcd display. When the string doesn't fit on the display, the 2nd line will start
+    scrolling.
+    The lcd keeps a shadow copy of the DDRAM. A new frame is compared with the shadow copy and only the changed cells
+    are written to the display.
+    The frames are written by the i2c worker, the callers don't wait for the bus. After a failed write the next frame
+    rewrites the whole display.
+    Nothing is written to the hardware before init() has been called.
     """
     def __init__(self, addr: int = ADDR, bus: int = BUS):
-        self._scroll_text = ""
         self._addr = addr
-        self._bus = SMBus(bus)
-        self._scroll_thread = Thread(target=self._scroll, name="scroll_thread")
-        self._lcd_backlight = OutputDevice(Config.LCD_POWER_PIN)
-
-        # initialize
-        sleep(0.02)
-        self._write_command(LCD_FUNCTIONSET | LCD_8BITMODE | LCD_2LINE | LCD_5x8DOTS)
-        self._write_command(LCD_DISPLAYCONTROL | LCD_DISPLAYON | LCD_CURSOROFF | LCD_BLINKOFF)
-        self._write_command(LCD_CLEARDISPLAY)
-        sleep(0.01)
-        self._write_command(LCD_ENTRYMODESET | LCD_ENTRYLEFT)
+        self._bus_nr = bus
+        self._worker = I2cWorker(addr, on_error=self._invalidate)
+        self._lcd_backlight = None
+        self._scroll_frames: List[Tuple[str, float]] = []
+        self._scroll_index = 0
+        self._scroll_due = 0.0
+        self._scroll_cond = Condition()
+        self._scroll_thread = Thread(target=self._scroll, name="scroll_thread", daemon=True)
+        self._shadow = [bytearray([BLANK] * LCD_WIDTH) for _ in range(LCD_LINES)]
+        self._glyphs = GlyphAllocator()
+        self._frame_lock = Lock()
+        self._ops: List[Op] = []  # the frame being built
+
+    @property
+    def last_frame(self) -> BusStats:
+        """Traffic of the last write of the i2c worker (one or more frames)"""
+        return self._worker.last_batch
+
+    @property
+    def total(self) -> BusStats:
+        """Traffic since start"""
+        return self._worker.total
+
+    @property
+    def queue_depth(self) -> int:
+        """Frames waiting for the i2c worker"""
+        return self._worker.depth
+
+    def init(self, scroll_thread: bool = True):
+        """
+        Open the i2c bus and the backlight pin and initialize the display
+        @param scroll_thread: False -> don't start the scroll thread, the caller scrolls with scroll_step() (replays)
+        """
+        self._worker.start(backend.i2c_bus(self._bus_nr))
+        self._lcd_backlight = backend.output_device(Config.LCD_POWER_PIN)
+        with self._frame_lock:
+            self._ops.append(Op(CTRLBYTE_COMMAND, b'', POWER_ON_DELAY))
+            self._write_command(LCD_FUNCTIONSET | LCD_8BITMODE | LCD_2LINE | LCD_5x8DOTS)
+            self._write_command(LCD_DISPLAYCONTROL | LCD_DISPLAYON | LCD_CURSOROFF | LCD_BLINKOFF)
+            self._write_command(LCD_CLEARDISPLAY, CLEAR_DELAY)
+            self._write_command(LCD_ENTRYMODESET | LCD_ENTRYLEFT)
+            self._end_frame()
+        if scroll_thread:
+            self._scroll_thread.start()
+
+    def wait(self):
+        """Wait until the i2c worker has written the frames"""
+        self._worker.join()
 
     def display_text(self, text: str):
         """
-        Display text. Activate scrolling in separate thread when the text on the second line > 16 characters.
+        Display text. Let the scroll thread scroll the second line when it is > 16 characters.
         @param text: str
         """
-        lines = textwrap.wrap(text, width=16)
-        self.clear()
-        self._display_string(lines[0], 1)
-        if len(lines) == 2:
-            self._display_string(lines[1], 2)
-        elif len(lines) > 2:
-            # concat lines except the first item which is printed on line 1
-            self._scroll_text = " ".join(lines[1:])
-            self._set_up_scroll_thread()
-            self._scroll_thread.start()
+        first, second, frames, glyphs = _layout(text)
+        with self._scroll_cond:
+            self._flush_frame([first, second], glyphs)
+            self._set_scroll(list(frames))
 
     def clear(self):
-        """Clear lcd and set to home"""
-        self._stop_scrolling()
-        self._write_command(LCD_CLEARDISPLAY)
-        sleep(0.001)
-        self._write_command(LCD_RETURNHOME)
-        sleep(0.001)
+        """Clear lcd"""
+        with self._scroll_cond:
+            self._flush_frame(["", ""])
+            self._set_scroll([])
 
     def lcd_backlight_toggle(self, on: bool):
         """Toggle lcd backlight"""
+        if self._lcd_backlight is None:
+            return
+
         self.clear()
         if on:
             self._lcd_backlight.on()
@@ -123,67 +177,176 @@ class Lcd:
         @param string: str
         @param line: put string on specified line nr (1 or 2)
         """
-        if line == 1:
-            self._write_command(LCD_SETDDRAMADDR)
-        elif line == 2:
-            self._write_command(LCD_SETDDRAMADDR + 0x40)
-        else:
+        if line not in (1, 2):
             return
 
-        self._write_block_data([ord(item) for item in string])
+        with self._frame_lock:
+            self._flush_line(line - 1, string)
+            self._end_frame()
 
-    def _scroll(self):
-        """Scroll text on lcd. To be run in separate thread"""
-        scroll_index = 0
-        timer = time()
-        delay = Config.SCROLL_DELAY
+    def _flush_frame(self, lines: List[str], glyphs: Tuple[str, ...] = ()):
+        """
+        Write a new frame to the lcd. Only the cells which differ from the shadow copy are written.
+        @param lines: one string per line
+        @param glyphs: the custom glyphs needed by the frame and its scroll frames
+        """
+        if not self._worker.running:
+            return  # not initialized (yet)
+
+        with self._frame_lock:
+            self._load_glyphs(glyphs)
+            for line, string in enumerate(lines):
+                self._flush_line(line, string)
+            self._end_frame(partial(_frame_written, monotonic()))
 
-        while self._scroll_text:
-            if time() - timer < delay:
+    def _flush_line(self, line: int, string: str):
+        """
+        Write the changed cells of a line. Changed cells close to each other are written in one block.
+        @param line: line index (0 or 1)
+        @param string: str
+        """
+        new = self._glyphs.to_bytes(lcd_charset.encode(string[:LCD_WIDTH].ljust(LCD_WIDTH)))
+        shadow = self._shadow[line]
+        col = 0
+        while col < LCD_WIDTH:
+            if new[col] == shadow[col]:
+                col += 1
                 continue
 
-            text = self._scroll_text[scroll_index: scroll_index + 16]
-            self._display_string(text, 2)
+            # extend the run as long as the next changed cell is within MAX_GAP
+            start = end = col
+            col += 1
+            while col < LCD_WIDTH and col - end <= MAX_GAP + 1:
+                if new[col] != shadow[col]:
+                    end = col
+                col += 1
 
-            if scroll_index in [0, len(self._scroll_text) - 16]:
-                # add two seconds delay at start and end of the text line. Otherwise, it's harder to read
-                delay = Config.SCROLL_DELAY + 2
-            else:
-                delay = Config.SCROLL_DELAY
+            self._write_command(LCD_SETDDRAMADDR | (LINE_ADDRESSES[line] + start))
+            self._write_block_data(list(new[start:end + 1]))
+            col = end + 1
 
-            if scroll_index >= len(self._scroll_text) - 16:
-                scroll_index = 0
-            else:
-                scroll_index += 1
+        self._shadow[line] = new
 
-            timer = time()
-            sleep(0.01)  # drop cpu usage?
+    def _load_glyphs(self, glyphs: Tuple[str, ...]):
+        """Write the glyphs which aren't in CGRAM yet. The cells showing a replaced glyph are rewritten"""
+        for slot in self._glyphs.allocate(glyphs):
+            self._write_command(LCD_SETCGRAMADDR | (slot << 3))
+            self._write_block_data(self._glyphs.bitmap(slot))
+            for shadow in self._shadow:
+                for col, code in enumerate(shadow):
+                    if code == slot:
+                        shadow[col] = STALE
 
-    def _stop_scrolling(self):
-        self._scroll_text = ""
-        if self._scroll_thread.is_alive():
-            self._scroll_thread.join()
+    def _invalidate(self):
+        """
+        A write failed: the DDRAM and CGRAM content is unknown. Mark all cells and glyphs stale, so the next frame
+        rewrites the whole display. Runs in the i2c worker thread
+        """
+        with self._frame_lock:
+            self._glyphs = GlyphAllocator()
+            for shadow in self._shadow:
+                shadow[:] = bytes([STALE]) * LCD_WIDTH
 
-    def _set_up_scroll_thread(self):
-        self._scroll_thread = Thread(target=self._scroll, name="scroll_thread")
+    def _end_frame(self, done: Callable[[], None] = None):
+        """
+        Post the frame to the i2c worker. Hold _frame_lock
+        @param done: called in the worker thread when the frame is written
+        """
+        self._worker.post(self._ops, done)
+        self._ops = []
 
-    def _write_command(self, cmd: int):
+    def scroll_step(self) -> Optional[float]:
         """
-        Write value to IR
-        @type cmd:
+        Show the next scroll frame of the 2nd line when it is due
+        @return: seconds until the next frame is due, None when the 2nd line doesn't scroll
         """
-        self._bus.write_byte_data(self._addr, CTRLBYTE_COMMAND, cmd)
-        sleep(0.0001)
+        with self._scroll_cond:
+            if not self._scroll_frames:
+                return None
+
+            wait = self._scroll_due - monotonic()
+            if wait > 0:
+                return wait
+
+            text, delay = self._scroll_frames[self._scroll_index]
+            self._display_string(text, 2)
+            self._scroll_index = (self._scroll_index + 1) % len(self._scroll_frames)
+            self._scroll_due = monotonic() + delay
+            return delay
+
+    def _scroll(self):
+        """Show the scroll frames of the 2nd line when they are due. Runs in the scroll thread for the lcd lifetime"""
+        with self._scroll_cond:
+            while True:
+                self._scroll_cond.wait(self.scroll_step())
+
+    def _set_scroll(self, frames: List[Tuple[str, float]]):
+        """
+        Retarget the scroll thread. The first frame is expected to be on the display already. Hold _scroll_cond.
+        @param frames: list with (text, delay) tuples, an empty list stops scrolling
+        """
+        self._scroll_frames = frames
+        if frames:
+            self._scroll_index = 1 % len(frames)
+            self._scroll_due = monotonic() + frames[0][1]
+        self._scroll_cond.notify()
+
+    def _write_command(self, cmd: int, delay: float = 0.0):
+        """
+        Add a command to the frame
+        @param cmd: int
+        @param delay: execution time of the command in seconds
+        """
+        self._ops.append(Op(CTRLBYTE_COMMAND, bytes([cmd]), delay))
 
     def _write_data(self, data: int):
-        """Write value to DDRAM/CGRAM"""
-        self._bus.write_byte_data(self._addr, CTRLBYTE_DATA, data)
-        sleep(0.0001)
+        """Add a value for DDRAM/CGRAM to the frame"""
+        self._ops.append(Op(CTRLBYTE_DATA, bytes([data])))
 
     def _write_block_data(self, data: List[int]):
-        """Write """
-        self._bus.write_i2c_block_data(self._addr, CTRLBYTE_DATA, data)
-        sleep(0.0001)
+        """Add a block of values for DDRAM/CGRAM to the frame"""
+        self._ops.append(Op(CTRLBYTE_DATA, bytes(data)))
+
+
+def _frame_written(posted: float):
+    """A frame is on the display. Runs in the i2c worker thread"""
+    metrics.observe('lcd_frame_seconds', monotonic() - posted)
+    metrics.since('input', 'input_to_lcd_seconds', once=True)
+
+
+@lru_cache(maxsize=Config.LCD_CACHE)
+def _layout(text: str) -> Tuple[str, str, Tuple[Tuple[str, float], ...], Tuple[str, ...]]:
+    """
+    Wrap text on the display. Cached, a title is often displayed more than once
+    @param text: str
+    @return: (first line, second line, scroll frames of the second line, custom glyphs needed by the text)
+    """
+    text = lcd_charset.normalize(text)
+    lines = textwrap.wrap(text, width=LCD_WIDTH) or [""]
+    if len(lines) > 2:
+        # concat lines except the first item which is printed on line 1
+        frames = tuple(_scroll_frames(" ".join(lines[1:])))
+        second = " ".join(lines[1:])
+    else:
+        frames = ()
+        second = lines[1] if len(lines) == 2 else ""
+    glyphs = lcd_charset.glyphs(lcd_charset.encode(lines[0])) + lcd_charset.glyphs(lcd_charset.encode(second))
+    return lines[0], frames[0][0] if frames else second, frames, tuple(glyphs)
+
+
+def _scroll_frames(text: str) -> List[Tuple[str, float]]:
+    """
+    Precompute the frames to scroll text on a single line
+    @param text: str, longer than the line width
+    @return: list with (text, delay) tuples. delay is the time the frame stays on the display
+    """
+    last = len(text) - LCD_WIDTH
+    frames = []
+    for index in range(last + 1):
+        # add two seconds delay at start and end of the text line. Otherwise, it's harder to read
+        delay = Config.SCROLL_DELAY + 2 if index in (0, last) else Config.SCROLL_DELAY
+        frames.append((text[index:index + LCD_WIDTH], delay))
+    return frames
 
 
 lcd = Lcd()
@@ -0,0 +1,169 @@
+"""
+Logging setup. The threads which log (gpio callbacks, mpv event thread, dispatcher) only put the record in a bounded
+queue. A background listener thread writes the log file and keeps the last Config.LOG_RING_SIZE records in a ring
+buffer in memory. When the queue is full, records are dropped instead of blocking the caller.
+The ring buffer is written to Config.LOG_DUMP_FILE on demand (dump(), signal SIGUSR1) and after an uncaught exception.
+The 'mpv' logger is rate limited per mpv component: a component logs at most Config.LOG_RATE records per
+Config.LOG_RATE_WINDOW seconds, the number of suppressed records is added to the next record that passes.
+"""
+import logging
+import signal
+import sys
+import threading
+from collections import deque
+from datetime import datetime
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from queue import Full, Queue
+from time import monotonic
+from typing import Dict, List, Optional, Tuple
+
+from config import Config
+
+LOG = logging.getLogger(__name__)
+
+
+class DroppingQueueHandler(QueueHandler):
+    """QueueHandler which drops the record when the queue is full"""
+    def __init__(self, queue: Queue):
+        super().__init__(queue)
+        self.dropped = 0
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except Full:
+            self.dropped += 1
+
+
+class RingBuffer(logging.Handler):
+    """Keep the last records as (created, level name, logger name, message) tuples"""
+    def __init__(self, capacity: int):
+        super().__init__()
+        self._records = deque(maxlen=capacity)
+
+    def emit(self, record: logging.LogRecord):
+        message = record.getMessage()
+        if record.exc_info and not record.exc_text:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+        if record.exc_text:
+            message = f"{message}\n{record.exc_text}"
+        self._records.append((record.created, record.levelname, record.name, message))
+
+    def lines(self) -> List[str]:
+        """The buffered records, oldest first"""
+        with self.lock:
+            records = list(self._records)
+        return [f"[{datetime.fromtimestamp(created).strftime('%D %H:%M:%S.%f')[:-3]}] [{name}] {level}: {message}"
+                for created, level, name, message in records]
+
+
+class RateLimitFilter(logging.Filter):
+    """Let at most Config.LOG_RATE records per window pass for every (logger, component)"""
+    def __init__(self):
+        super().__init__()
+        self._windows: Dict[Tuple[str, str], List] = {}  # key -> [window start, passed, suppressed]
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        key = (record.name, getattr(record, 'component', ''))
+        now = monotonic()
+        window = self._windows.get(key)
+        if window is None or now - window[0] >= Config.LOG_RATE_WINDOW:
+            suppressed = window[2] if window is not None else 0
+            self._windows[key] = [now, 1, 0]
+            if suppressed:
+                record.msg = f"{record.msg} [{suppressed} similar messages suppressed]"
+            return True
+
+        if window[1] < Config.LOG_RATE:
+            window[1] += 1
+            return True
+        window[2] += 1
+        return False
+
+
+_queue_handler: Optional[DroppingQueueHandler] = None
+_listener: Optional[QueueListener] = None
+_ring: Optional[RingBuffer] = None
+
+
+def setup():
+    """Route the log records through the queue to the file, the ring buffer and (debug) the console"""
+    global _queue_handler, _listener, _ring
+    Config.LOG_FORMATTER.default_msec_format = '%s.%03d'
+    file_handler = RotatingFileHandler(filename=Config.LOG_FILE, maxBytes=Config.LOG_MAX_BYTES,
+                                       backupCount=Config.LOG_BACKUPS)
+    file_handler.setFormatter(Config.LOG_FORMATTER)
+    file_handler.setLevel(Config.LOG_LEVEL)
+    handlers: List[logging.Handler] = [file_handler]
+    if Config.LOG_LEVEL == logging.DEBUG:
+        console_handler = logging.StreamHandler()
+        console_handler.setFormatter(Config.LOG_FORMATTER)
+        handlers.append(console_handler)
+    _ring = RingBuffer(Config.LOG_RING_SIZE)
+    handlers.append(_ring)
+
+    _queue_handler = DroppingQueueHandler(Queue(maxsize=Config.LOG_QUEUE_SIZE))
+    _listener = QueueListener(_queue_handler.queue, *handlers, respect_handler_level=True)
+    _listener.start()
+
+    root = logging.getLogger()
+    root.addHandler(_queue_handler)
+    root.setLevel(Config.LOG_LEVEL)
+    logging.getLogger('mpv').addFilter(RateLimitFilter())
+
+    sys.excepthook = _excepthook
+    threading.excepthook = _thread_excepthook
+    signal.signal(signal.SIGUSR1, lambda _signum, _frame: threading.Thread(target=dump, name="log_dump").start())
+
+
+def stop():
+    """Write the queued records and stop the listener thread"""
+    global _listener
+    if _queue_handler is not None and _queue_handler.dropped:
+        LOG.warning("%s log records dropped", _queue_handler.dropped)
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+def queue_depth() -> Tuple[int, int]:
+    """@return: records waiting for the log writer thread and records dropped since start"""
+    if _queue_handler is None:
+        return 0, 0
+    return _queue_handler.queue.qsize(), _queue_handler.dropped
+
+
+def dump(filename: str = None) -> str:
+    """
+    Write the ring buffer to a file
+    @param filename: str, default Config.LOG_DUMP_FILE
+    @return: the file name
+    """
+    filename = filename or Config.LOG_DUMP_FILE
+    lines = _ring.lines() if _ring is not None else []
+    with open(filename, 'w', encoding='utf-8') as file:
+        file.write("\n".join(lines) + "\n")
+    return filename
+
+
+def _excepthook(exc_type, exc_value, exc_traceback):
+    LOG.critical("Uncaught exception", exc_info=(exc_type, exc_value, exc_traceback))
+    _dump_after_crash()
+    sys.__excepthook__(exc_type, exc_value, exc_traceback)
+
+
+def _thread_excepthook(args):
+    LOG.critical("Uncaught exception in thread %s", args.thread.name if args.thread else "?",
+                 exc_info=(args.exc_type, args.exc_value, args.exc_traceback))
+    _dump_after_crash()
+
+
+def _dump_after_crash():
+    """Let the listener write the last records, then dump the ring buffer"""
+    if _listener is not None:
+        _listener.stop()
+        _listener.start()
+    try:
+        dump()
+    except OSError:
+        pass
@@ -68,60 +68,56 @@ atexit module catches SIGINT.
 import atexit
 import logging
 import sys
-from logging.handlers import RotatingFileHandler
-from time import sleep
+from typing import Callable
 
-import mpv
 import setproctitle
 
-from config import Config
-from models.enums import States
+import diagnostics
+import logger
+import startup
+from backends import backend
+from dispatcher import dispatcher
+from history import history
+from lcd_screen import lcd
 from radio import Radio
+from state import store
+from timeshift import timeshift
 
-# Logging config ############################################################################
-LOG_FORMATTER = logging.Formatter(
-    fmt='[%(asctime)s.%(msecs)03d] [%(module)s] %(levelname)s: %(message)s',
-    datefmt='%D %H:%M:%S',
-)
-LOG_FORMATTER.default_msec_format = '%s.%03d'
-LOG_HANDLER_FILE = RotatingFileHandler(filename='piradio.log', maxBytes=2000, backupCount=1)
-LOG_HANDLER_FILE.setFormatter(LOG_FORMATTER)
-LOG_HANDLER_FILE.setLevel(Config.LOG_LEVEL)
-LOG_HANDLER_CONSOLE = logging.StreamHandler()
-LOG_HANDLER_CONSOLE.setFormatter(LOG_FORMATTER)
-LOG_HANDLER_CONSOLE.setLevel(Config.LOG_LEVEL)
+logger.setup()
+diagnostics.setup()
 LOG = logging.getLogger()
-LOG.addHandler(LOG_HANDLER_FILE)
-if Config.LOG_LEVEL == logging.DEBUG:
-    LOG.addHandler(LOG_HANDLER_CONSOLE)
-LOG.setLevel(Config.LOG_LEVEL)
-# End logging config #######################################################################
+
+
+def _shutdown_step(step: Callable[[], None]):
+    """Run a step of exit_program. A failing step is logged, the next steps still run"""
+    try:
+        step()
+    except Exception:  # pylint: disable=broad-except
+        LOG.exception("Shutdown step %s failed", step.__qualname__)
 
 
 @atexit.register
 def exit_program():
-    """handler for atexit -> stop mpv player. clear lcd screen"""
-    Radio.stop()
+    """handler for atexit -> stop mpv player. clear lcd screen. write the radio state and the history"""
+    # the pending state and history first: stopping a player which shut down raises PlayerShutdown
+    # lcd.wait: the frames are written by the i2c worker, the last one clears the display
+    for step in (store.flush, history.close, Radio.stop, timeshift.close, store.close, lcd.wait):
+        _shutdown_step(step)
     line = "#" * 75
     LOG.info("Atexit handler triggered. Exit program\n%s\n", line)
+    logger.stop()
     sys.exit(0)
 
 
 setproctitle.setproctitle("piradio")
 LOG.info("Start program")
 try:
-    while True:
-        # check if radio sends new icy metadata
-        if Radio.state() is States.PLAYING:
-            Radio.check_metadata()
-
-        # check if a new station has been selected
-        if Radio.state() is States.SELECT_STATION:
-            Radio.check_select_station()
-
-        sleep(0.01)
+    startup.run()
+    backend.start()
+    # sleep until mpv, the buttons or a timer have something to do
+    dispatcher.run()
 
-except mpv.ShutdownError:
+except backend.PlayerShutdown:
     LOG.error("ShutdownError from mpv")
 finally:
     exit_program()
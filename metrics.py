@@ -0,0 +1,165 @@
+"""
+Latency instrumentation. Histograms and counters in the prometheus text format.
+The phases of a user interaction are timestamped with mark() and the time between two phases is observed with since().
+    input       button press or encoder tick
+    play        Radio.play -> mpv play call
+    file-loaded, first audio, first icy-title, lcd frame flushed
+The metrics are written to Config.METRICS_FILE (node_exporter textfile collector) every Config.METRICS_INTERVAL seconds
+and served on the unix socket Config.METRICS_SOCKET when set.
+"""
+import logging
+import os
+import socketserver
+from threading import Lock, Thread
+from time import monotonic
+from typing import Dict, List, Optional, Tuple
+
+from config import Config
+from dispatcher import dispatcher
+
+LOG = logging.getLogger(__name__)
+
+PREFIX = 'piradio_'
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+class Histogram:
+    """Cumulative histogram with fixed buckets"""
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        """Count value in its bucket"""
+        for index, bound in enumerate(BUCKETS):
+            if value <= bound:
+                self.counts[index] += 1
+        self.sum += value
+        self.count += 1
+
+
+def _labels(labels: Dict[str, str]) -> Labels:
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def _format_labels(labels: Labels, extra: str = '') -> str:
+    items = [f'{key}="{_escape(value)}"' for key, value in labels]
+    if extra:
+        items.append(extra)
+    return '{' + ','.join(items) + '}' if items else ''
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class Metrics:
+    """Thread safe collection of histograms, counters and gauges"""
+    def __init__(self):
+        self._lock = Lock()
+        self._marks: Dict[str, Tuple[float, set]] = {}  # phase -> (timestamp, histograms observed 'once')
+        self._histograms: Dict[str, Dict[Labels, Histogram]] = {}
+        self._counters: Dict[str, Dict[Labels, float]] = {}
+        self._gauges: Dict[str, Dict[Labels, float]] = {}
+        self._server: Optional[socketserver.BaseServer] = None
+
+    def mark(self, phase: str):
+        """
+        Timestamp a phase
+        @param phase: str
+        """
+        self._marks[phase] = (monotonic(), set())
+
+    def since(self, phase: str, name: str, once: bool = False, **labels) -> Optional[float]:
+        """
+        Observe the time since a marked phase in histogram name
+        @param phase: str
+        @param name: histogram name without prefix, e.g. 'tune_first_audio_seconds'
+        @param once: observe name only the first time for a mark
+        @param labels: prometheus labels
+        @return: the observed seconds or None when phase isn't marked (or already observed)
+        """
+        start, observed = self._marks.get(phase, (None, None))
+        if start is None or (once and name in observed):
+            return None
+        observed.add(name)
+        seconds = monotonic() - start
+        self.observe(name, seconds, **labels)
+        return seconds
+
+    def observe(self, name: str, value: float, **labels):
+        """Add a value to a histogram"""
+        with self._lock:
+            self._histograms.setdefault(name, {}).setdefault(_labels(labels), Histogram()).observe(value)
+
+    def inc(self, name: str, value: float = 1, **labels):
+        """Increment a counter"""
+        with self._lock:
+            counter = self._counters.setdefault(name, {})
+            key = _labels(labels)
+            counter[key] = counter.get(key, 0) + value
+
+    def set_gauge(self, name: str, value: float, **labels):
+        """Set a gauge"""
+        with self._lock:
+            self._gauges.setdefault(name, {})[_labels(labels)] = value
+
+    def render(self) -> str:
+        """Get all metrics in the prometheus text format"""
+        lines: List[str] = []
+        with self._lock:
+            for name, series in sorted(self._histograms.items()):
+                lines.append(f'# TYPE {PREFIX}{name} histogram')
+                for labels, histogram in series.items():
+                    for bound, count in zip(BUCKETS, histogram.counts):
+                        bucket = _format_labels(labels, 'le="%s"' % bound)
+                        lines.append(f'{PREFIX}{name}_bucket{bucket} {count}')
+                    bucket = _format_labels(labels, 'le="+Inf"')
+                    lines.append(f'{PREFIX}{name}_bucket{bucket} {histogram.count}')
+                    lines.append(f'{PREFIX}{name}_sum{_format_labels(labels)} {histogram.sum:.6f}')
+                    lines.append(f'{PREFIX}{name}_count{_format_labels(labels)} {histogram.count}')
+            for kind, collection in (('counter', self._counters), ('gauge', self._gauges)):
+                for name, series in sorted(collection.items()):
+                    lines.append(f'# TYPE {PREFIX}{name} {kind}')
+                    for labels, value in series.items():
+                        lines.append(f'{PREFIX}{name}{_format_labels(labels)} {value:g}')
+        return '\n'.join(lines) + '\n'
+
+    def start_export(self):
+        """Start writing Config.METRICS_FILE and serving Config.METRICS_SOCKET"""
+        if Config.METRICS_FILE:
+            dispatcher.call_later(Config.METRICS_INTERVAL, self._write_file)
+        if Config.METRICS_SOCKET:
+            self._serve(Config.METRICS_SOCKET)
+
+    def _write_file(self):
+        """Write the metrics file and schedule the next write. Runs in the dispatcher thread"""
+        tmp = Config.METRICS_FILE + '.tmp'
+        try:
+            with open(tmp, 'w', encoding='utf-8') as file:
+                file.write(self.render())
+            os.replace(tmp, Config.METRICS_FILE)
+        except OSError as err:
+            LOG.warning("Cannot write metrics file %s: %s", Config.METRICS_FILE, err)
+        dispatcher.call_later(Config.METRICS_INTERVAL, self._write_file)
+
+    def _serve(self, path: str):
+        """Serve the metrics on a unix socket: every connection gets the current metrics"""
+        metrics = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            """Answer every request with the metrics"""
+            def handle(self):
+                self.wfile.write(metrics.render().encode('utf-8'))
+
+        if os.path.exists(path):
+            os.unlink(path)
+        self._server = socketserver.ThreadingUnixStreamServer(path, Handler)
+        self._server.daemon_threads = True
+        Thread(target=self._server.serve_forever, name="metrics_socket", daemon=True).start()
+
+
+metrics = Metrics()
@@ -0,0 +1,75 @@
+"""
+Connection race between the endpoints (Variant.url and Variant.mirrors) of a stream, happy eyeballs style.
+The first endpoint is connected at once, the next one Config.RACE_STAGGER seconds later, or as soon as all started
+connections failed. The first endpoint which delivers audio wins: its connection (a WarmStream) is handed over to mpv
+like a prefetched stream and the other connections are closed.
+"""
+import logging
+from threading import Event, Thread
+from time import monotonic
+from typing import Callable, List, Optional
+
+from config import Config
+from metrics import metrics
+from prefetch import WarmStream
+
+LOG = logging.getLogger(__name__)
+
+
+class MirrorRace:
+    """Race the endpoints of a stream in a thread"""
+    def __init__(self, urls: List[str], on_done: Callable[['MirrorRace', Optional[WarmStream]], None]):
+        """
+        @param urls: endpoints, preferred first
+        @param on_done: called in the race thread with the race and the winning stream, None when all failed
+        """
+        self.urls = urls
+        self._on_done = on_done
+        self._streams: List[WarmStream] = []
+        self._changed = Event()
+        self._cancelled = False
+        Thread(target=self._run, name="mirror_race", daemon=True).start()
+
+    def cancel(self):
+        """Close the connections. on_done won't be called"""
+        self._cancelled = True
+        self._changed.set()
+
+    def _run(self):
+        start = monotonic()
+        deadline = start + Config.TIMEOUT
+        next_start = start
+        winner = None
+        while not self._cancelled:
+            self._changed.clear()
+            now = monotonic()
+            failed = all(stream.ended for stream in self._streams)
+            if len(self._streams) < len(self.urls) and (now >= next_start or failed):
+                stream = WarmStream(self.urls[len(self._streams)], on_change=self._changed.set)
+                self._streams.append(stream)
+                next_start = now + Config.RACE_STAGGER
+                failed = False
+
+            winner = next((stream for stream in self._streams if stream.alive), None)
+            if winner is not None or failed or now >= deadline:
+                break
+            wake_up = next_start if len(self._streams) < len(self.urls) else deadline
+            self._changed.wait(max(0.0, min(wake_up, deadline) - now))
+
+        for stream in self._streams:
+            if stream is not winner or self._cancelled:
+                stream.on_change = None
+                stream.close()
+        if self._cancelled:
+            return
+
+        if winner is None:
+            LOG.warning("No endpoint delivered audio: %s", ", ".join(self.urls))
+        else:
+            winner.on_change = None
+            index = self.urls.index(winner.url)
+            metrics.observe('mirror_race_seconds', monotonic() - start)
+            metrics.inc('mirror_race_wins_total', endpoint=str(index))
+            LOG.debug("Endpoint %s of %s won the race after %.3fs: %s", index + 1, len(self.urls),
+                      monotonic() - start, winner.url)
+        self._on_done(self, winner)
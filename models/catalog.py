@@ -0,0 +1,282 @@
+"""
+Station catalog. Scales to large station lists, e.g. a radio-browser export with thousands of stations.
+The catalog keeps an index with the station ids in display order (favourites first), the names and the genres. The
+station records are loaded on demand and only the last Config.CATALOG_CACHE records are kept in memory.
+Sources:
+    the built-in STATION_LIST
+    json: list of objects with 'id' (or radio-browser 'stationuuid'), 'name', 'url' (or 'url_resolved'), 'genre' (or
+          radio-browser 'tags'), 'favourite', 'bitrate', 'codec', 'mirrors' (other urls of the stream) and 'variants'
+          (list of objects with 'url', 'bitrate', 'codec' and 'mirrors', best first)
+    sqlite: table 'stations' with the columns id, name, url, genre, favourite and position, and optionally bitrate,
+            codec, mirrors and variants (json text, like the json fields)
+"""
+import bisect
+import json
+import logging
+import sqlite3
+from collections import OrderedDict
+from threading import Lock
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from config import Config
+from models.stations import Station, STATION_LIST, Variant
+
+LOG = logging.getLogger(__name__)
+
+IndexRow = Tuple[str, str, str, bool]  # id, name, genre, favourite
+SQLITE_COLUMNS = ('id', 'name', 'url', 'genre', 'bitrate', 'codec', 'mirrors', 'variants')  # record columns
+
+
+class Catalog:
+    """Ordered station list with O(1) lookups and cursor moves by station id"""
+    def __init__(self):
+        self._ids: List[str] = []
+        self._positions: Dict[str, int] = {}
+        self._names: List[Tuple[str, str]] = []  # sorted (lowercase name, id)
+        self._genres: Dict[str, List[str]] = {}
+        self._favourites: List[str] = []
+        self._loader: Callable[[str], Optional[Station]] = lambda _id: None
+        self._cache: 'OrderedDict[str, Station]' = OrderedDict()
+        self._lock = Lock()
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    def __getitem__(self, position: int) -> Station:
+        return self.get(self._ids[position])
+
+    @property
+    def ids(self) -> List[str]:
+        """Station ids in display order"""
+        return self._ids
+
+    @property
+    def favourites(self) -> List[str]:
+        return self._favourites
+
+    def get(self, station_id: str) -> Optional[Station]:
+        """
+        Get a station record. Loaded from the source when it isn't cached
+        @param station_id: str
+        @return: Station or None for an unknown id
+        """
+        with self._lock:
+            station = self._cache.get(station_id)
+            if station is not None:
+                self._cache.move_to_end(station_id)
+                return station
+
+        if station_id not in self._positions:
+            return None
+        station = self._loader(station_id)
+        with self._lock:
+            self._cache[station_id] = station
+            while len(self._cache) > Config.CATALOG_CACHE:
+                self._cache.popitem(last=False)
+        return station
+
+    def position(self, station_id: str) -> int:
+        """
+        @param station_id: str
+        @return: position in display order, -1 for an unknown id
+        """
+        return self._positions.get(station_id, -1)
+
+    def move(self, station_id: str, steps: int) -> str:
+        """
+        Move the cursor. Wraps around at the start and end of the list
+        @param station_id: id at the cursor
+        @param steps: int, negative -> backwards
+        @return: id at the new cursor position
+        """
+        position = self._positions.get(station_id, 0)
+        return self._ids[(position + steps) % len(self._ids)]
+
+    def find_name(self, prefix: str) -> Optional[str]:
+        """
+        Find the first station in alphabetical order with a name starting with prefix
+        @param prefix: str, case insensitive
+        @return: station id or None
+        """
+        prefix = prefix.lower()
+        index = bisect.bisect_left(self._names, (prefix, ''))
+        if index < len(self._names) and self._names[index][0].startswith(prefix):
+            return self._names[index][1]
+        return None
+
+    def genre(self, genre: str) -> List[str]:
+        """
+        @param genre: str, case insensitive
+        @return: ids of the stations of a genre in display order
+        """
+        return self._genres.get(genre.lower(), [])
+
+    def set_favourites(self, favourites: Iterable[str]):
+        """
+        Put the favourite stations first, in the given order
+        @param favourites: station ids
+        """
+        favourites = [station_id for station_id in favourites if station_id in self._positions]
+        selected = set(favourites)
+        others = [station_id for station_id in self._ids if station_id not in selected]
+        self._favourites = favourites
+        self._set_order(favourites + others)
+
+    def load_stations(self, stations: Iterable[Station]):
+        """Use a list of Station objects, e.g. STATION_LIST"""
+        records = {station.id: station for station in stations}
+        self._set_index([(station.id, station.name, station.genre, False) for station in records.values()],
+                        records.get)
+
+    def load_json(self, filename: str):
+        """Use a json file. Only the index and the file offsets are kept, the records are read on demand"""
+        with open(filename, 'r', encoding='utf-8') as file:
+            text = file.read()
+
+        offsets: Dict[str, Tuple[int, int]] = {}  # id -> byte offset and length of the record in the file
+        index: List[IndexRow] = []
+        for item, offset, length in _json_records(text):
+            station_id = _station_id(item)
+            if not station_id or not _url(item) or station_id in offsets:
+                continue
+            offsets[station_id] = (offset, length)
+            index.append((station_id, _name(item, station_id), _genre(item), bool(item.get('favourite'))))
+        del text
+
+        def loader(station_id: str) -> Optional[Station]:
+            offset, length = offsets[station_id]
+            try:
+                with open(filename, 'rb') as file:
+                    file.seek(offset)
+                    station = _station(json.loads(file.read(length).decode('utf-8')))
+            except (OSError, ValueError) as err:
+                LOG.warning("Cannot read station %s from %s: %s", station_id, filename, err)
+                return None
+            if station is None or station.id != station_id:
+                LOG.warning("Station %s moved in %s, reload the catalog", station_id, filename)
+                return None
+            return station
+
+        self._set_index(index, loader)
+
+    def load_sqlite(self, filename: str):
+        """Use a sqlite database. Only the index is read at load time, the records are queried on demand"""
+        connection = sqlite3.connect(filename, check_same_thread=False)
+        connection_lock = Lock()
+        rows = connection.execute("SELECT id, name, genre, favourite FROM stations ORDER BY position, rowid")
+        index = [(str(station_id), name, genre or '', bool(favourite)) for station_id, name, genre, favourite in rows]
+        present = {row[1] for row in connection.execute("PRAGMA table_info(stations)")}
+        columns = [column for column in SQLITE_COLUMNS if column in present]
+        query = f"SELECT {', '.join(columns)} FROM stations WHERE id = ?"
+
+        def loader(station_id: str) -> Optional[Station]:
+            with connection_lock:
+                row = connection.execute(query, (station_id,)).fetchone()
+            if row is None:
+                return None
+            item = {column: value for column, value in zip(columns, row) if value is not None}
+            try:
+                for column in ('mirrors', 'variants'):  # json text
+                    if column in item:
+                        item[column] = json.loads(item[column])
+                return _station(item)
+            except (ValueError, TypeError, KeyError) as err:
+                LOG.warning("Ignoring the bad record of station %s in %s: %s", station_id, filename, err)
+                return None
+
+        self._set_index(index, loader)
+
+    def load(self, filename: Optional[str]):
+        """
+        Load the catalog from a json or sqlite file. None -> built-in STATION_LIST
+        @param filename: str or None
+        """
+        if not filename:
+            self.load_stations(STATION_LIST)
+        elif filename.endswith(('.sqlite', '.sqlite3', '.db')):
+            self.load_sqlite(filename)
+        else:
+            self.load_json(filename)
+        LOG.info("Loaded %s stations (%s favourites) from %s", len(self), len(self._favourites),
+                 filename or "STATION_LIST")
+
+    def _set_index(self, index: List[IndexRow], loader: Callable[[str], Optional[Station]]):
+        with self._lock:
+            self._cache.clear()
+            self._loader = loader
+        self._names = sorted((name.lower(), station_id) for station_id, name, _, _ in index)
+        self._favourites = [station_id for station_id, _, _, favourite in index if favourite]
+        others = [station_id for station_id, _, _, favourite in index if not favourite]
+        self._set_order(self._favourites + others, {station_id: genre for station_id, _, genre, _ in index})
+
+    def _set_order(self, ids: List[str], genres: Dict[str, str] = None):
+        """Rebuild the position and genre indexes for a new display order"""
+        if genres is None:
+            genres = {station_id: genre for genre, members in self._genres.items() for station_id in members}
+        self._positions = {station_id: position for position, station_id in enumerate(ids)}
+        self._ids = ids
+        self._genres = {}
+        for station_id in ids:
+            if genres.get(station_id):
+                self._genres.setdefault(genres[station_id].lower(), []).append(station_id)
+
+
+def _json_records(text: str) -> Iterator[Tuple[dict, int, int]]:
+    """
+    Parse the objects of a json list one by one
+    @param text: content of a json file with a list of objects
+    @return: iterator with (object, byte offset, byte length) of every object in the utf-8 file
+    """
+    decoder = json.JSONDecoder()
+    pos = text.index('[') + 1
+    offset = len(text[:pos].encode('utf-8'))
+    while True:
+        start = pos
+        while pos < len(text) and text[pos] in ' \t\r\n,':
+            pos += 1
+        offset += pos - start  # ascii
+        if pos >= len(text) or text[pos] == ']':
+            return
+        item, end = decoder.raw_decode(text, pos)
+        length = len(text[pos:end].encode('utf-8'))
+        if isinstance(item, dict):
+            yield item, offset, length
+        offset += length
+        pos = end
+
+
+def _station_id(item: dict) -> str:
+    return str(item.get('id') or item.get('stationuuid') or '')
+
+
+def _url(item: dict) -> Optional[str]:
+    return item.get('url_resolved') or item.get('url')
+
+
+def _name(item: dict, station_id: str) -> str:
+    return (item.get('name') or station_id).strip()
+
+
+def _genre(item: dict) -> str:
+    return item.get('genre') or (item.get('tags') or '').split(',')[0]
+
+
+def _station(item: dict) -> Optional[Station]:
+    """
+    Station of a json object or a sqlite row
+    @param item: dict with the fields described in the module docstring
+    @return: Station, None without id or url
+    """
+    station_id, url = _station_id(item), _url(item)
+    if not station_id or not url:
+        return None
+    variants = tuple(Variant(variant['url'], int(variant.get('bitrate') or 0), variant.get('codec', ''),
+                             tuple(variant.get('mirrors', ())))
+                     for variant in item.get('variants', ()))
+    variants = variants or (Variant(url, int(item.get('bitrate') or 0), item.get('codec', '').lower(),
+                                    tuple(item.get('mirrors', ()))),)
+    return Station(_name(item, station_id), url, _genre(item), id=station_id, variants=variants)
+
+
+catalog = Catalog()
+catalog.load_stations(STATION_LIST)
@@ -14,3 +14,32 @@ class States(Enum):
     START_STREAM = 2
     PLAYING = 3
     SELECT_STATION = 4
+    PAUSED = 5
+
+
+class Event(Enum):
+    """Events handled by the dispatcher in the main thread"""
+    SHUTDOWN = 0
+    METADATA = 1
+    CORE_IDLE = 2
+    COMMAND = 3
+    START_FILE = 4
+    FILE_LOADED = 5
+    PLAYBACK_RESTART = 6
+    END_FILE = 7
+    CACHE_DURATION = 8
+    PAUSED_FOR_CACHE = 9
+    CACHE_SPEED = 10
+
+
+class Command(Enum):
+    """Inputs of the radio, run by the dispatcher through the transition table in radio.py"""
+    TOGGLE = 0
+    SELECT = 1
+    MOVE = 2
+    PLAY = 3
+    VOLUME = 4
+    FAVOURITE = 5
+    PAUSE = 6
+    SEEK = 7
+    LIVE = 8
@@ -1,11 +1,32 @@
 """Collection with selectable radio stations"""
+import re
 from dataclasses import dataclass
+from typing import Tuple
+
+
+@dataclass(frozen=True)
+class Variant:
+    """A stream of a station in a given bitrate and codec"""
+    url: str
+    bitrate: int = 0  # kbit/s, 0 -> unknown
+    codec: str = ''
+    mirrors: Tuple[str, ...] = ()  # other endpoints of the same stream, raced with url at tune time
 
 
 @dataclass
 class Station:
     name: str  # displayed on lcd screen
-    url: str
+    url: str  # the best variant
+    genre: str = ''
+    id: str = ''  # stable id, derived from the name when empty
+    variants: Tuple[Variant, ...] = ()  # best first. Empty -> url is the only variant
+
+    def __post_init__(self):
+        if not self.id:
+            self.id = re.sub(r'[^a-z0-9]+', '-', self.name.lower()).strip('-')
+        if not self.variants:
+            self.variants = (Variant(self.url),)
+
 
 STATION_LIST = (
     Station('Vrt NWS', 'http://progressive-audio.vrtcdn.be/content/fixed/11_11niws-snip_hi.mp3'),
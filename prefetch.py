@@ -0,0 +1,183 @@
+"""
+Speculative pre-connect to the stations around the cursor while the user is selecting a station.
+A warm stream opens the http connection (redirects included) and keeps the last seconds of audio in a bounded buffer.
+When the station is committed, the warm stream is handed over to mpv as a python stream so the audio starts from the
+buffer instead of a cold connection.
+The icy metadata is requested and stripped from the audio by the warm stream itself, because mpv can't see the http
+headers of a python stream. The titles are passed to a callback instead.
+"""
+import http.client
+import logging
+import re
+from collections import deque
+from threading import Condition, Lock, Thread
+from time import monotonic
+from typing import Callable, Dict, Iterator, List, Optional
+from urllib.request import Request, urlopen
+
+from config import Config
+
+LOG = logging.getLogger(__name__)
+
+CHUNK_SIZE = 4096
+STREAM_TITLE = re.compile(rb"StreamTitle='(.*?)';")
+
+
+class WarmStream:
+    """Http audio stream opened ahead of time. Runs a reader thread until closed"""
+    def __init__(self, url: str, on_change: Callable[[], None] = None):
+        """
+        @param url: str
+        @param on_change: called in the reader thread on the first audio and at the end of the stream
+        """
+        self.url = url
+        self.touched = monotonic()  # last time the stream was wanted by the prefetcher
+        self.title: Optional[str] = None
+        self.on_title: Optional[Callable[[str], None]] = None
+        self.on_change = on_change
+        self._chunks = deque()
+        self._size = 0
+        self._cond = Condition()
+        self._closed = False
+        self._eof = False
+        self._received = False  # audio arrived
+        self._thread = Thread(target=self._read, name="prefetch", daemon=True)
+        self._thread.start()
+
+    @property
+    def alive(self) -> bool:
+        """True when the connection is open and audio has been received"""
+        with self._cond:
+            return not self._eof and not self._closed and self._size > 0
+
+    @property
+    def ended(self) -> bool:
+        """True when the connection failed or closed"""
+        with self._cond:
+            return self._eof or self._closed
+
+    def close(self):
+        """Stop reading and close the connection"""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+    def chunks(self) -> Iterator[bytes]:
+        """Yield the buffered audio, then the audio as it arrives. Generator for mpv.python_stream"""
+        while True:
+            with self._cond:
+                while not self._chunks and not self._eof and not self._closed:
+                    self._cond.wait()
+                if not self._chunks:
+                    return
+                chunk = self._chunks.popleft()
+                self._size -= len(chunk)
+            yield chunk
+
+    def _read(self):
+        """Reader thread. Keep the last Config.PREFETCH_BUFFER bytes of audio"""
+        try:
+            request = Request(self.url, headers={'Icy-MetaData': '1', 'User-Agent': 'piradio'})
+            with urlopen(request, timeout=Config.PREFETCH_CONNECT_TIMEOUT) as response:
+                metaint = int(response.headers.get('icy-metaint', 0))
+                LOG.debug("Prefetch connected: %s (metaint=%s)", response.geturl(), metaint)
+                while not self._closed:
+                    chunk = response.read(metaint or CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    self._append(chunk)
+                    if metaint:
+                        self._read_metadata(response)
+        except (OSError, ValueError, http.client.HTTPException) as err:
+            LOG.debug("Prefetch failed: %s: %s", self.url, err)
+        finally:
+            with self._cond:
+                self._eof = True
+                self._cond.notify_all()
+            if self.on_change is not None:
+                self.on_change()
+
+    def _read_metadata(self, response):
+        """Read the icy metadata block which follows every 'icy-metaint' bytes of audio"""
+        length = response.read(1)
+        if not length or not length[0]:
+            return
+
+        match = STREAM_TITLE.search(response.read(length[0] * 16))
+        if match:
+            title = match.group(1).decode('utf-8', errors='replace')
+            if title != self.title:
+                self.title = title
+                if self.on_title is not None:
+                    self.on_title(title)
+
+    def _append(self, chunk: bytes):
+        """Add audio to the buffer. Drop the oldest audio when the buffer is full"""
+        first = not self._received
+        self._received = True
+        with self._cond:
+            self._chunks.append(chunk)
+            self._size += len(chunk)
+            while self._size > Config.PREFETCH_BUFFER and len(self._chunks) > 1:
+                self._size -= len(self._chunks.popleft())
+            self._cond.notify_all()
+        if first and self.on_change is not None:
+            self.on_change()
+
+
+class Prefetcher:
+    """Keep at most Config.PREFETCH_STREAMS warm streams for the stations around the cursor"""
+    def __init__(self):
+        self._streams: Dict[str, WarmStream] = {}
+        self._lock = Lock()
+
+    def warm(self, urls: List[str]):
+        """
+        Open warm streams for urls, close the warm streams of other urls.
+        @param urls: list of urls, most likely first. Only the first Config.PREFETCH_STREAMS are used
+        """
+        urls = urls[:Config.PREFETCH_STREAMS]
+        with self._lock:
+            for url in list(self._streams):
+                if url not in urls:
+                    self._streams.pop(url).close()
+            for url in urls:
+                if url in self._streams:
+                    self._streams[url].touched = monotonic()
+                else:
+                    self._streams[url] = WarmStream(url)
+
+    def take(self, url: str) -> Optional[WarmStream]:
+        """
+        Hand over the warm stream for url and close the others
+        @param url: str
+        @return: WarmStream or None when there is no usable warm stream for url
+        """
+        with self._lock:
+            stream = self._streams.pop(url, None)
+            self._close_all()
+
+        if stream is not None and not stream.alive:
+            stream.close()
+            return None
+        return stream
+
+    def expire(self):
+        """Close the warm streams which weren't wanted for Config.PREFETCH_TTL"""
+        with self._lock:
+            for url, stream in list(self._streams.items()):
+                if monotonic() - stream.touched >= Config.PREFETCH_TTL:
+                    self._streams.pop(url).close()
+
+    def close(self):
+        """Close all warm streams"""
+        with self._lock:
+            self._close_all()
+
+    def _close_all(self):
+        for stream in self._streams.values():
+            stream.close()
+        self._streams.clear()
+
+
+prefetcher = Prefetcher()
@@ -0,0 +1,225 @@
+"""
+Background reachability check of the stations.
+Every Config.PROBE_INTERVAL seconds the prober connects to the stations of the catalog, Config.PROBE_CONCURRENCY at a
+time, with a short http/icy handshake: request the stream url (the variant the radio would play, resolved url when
+known), read the response headers and the first PROBE_BODY bytes of audio, close. The result per station is cached:
+    reachable, latency (seconds to the first audio bytes), codec and bitrate from the headers
+A round stops when it used about Config.PROBE_BUDGET bytes (the probes in flight finish), the next round goes on with
+the next stations.
+The radio uses the results to mark (or skip, Config.PROBE_SKIP_DOWN) dead stations while selecting and to give up on a
+station known to be down after Config.PROBE_DOWN_TIMEOUT instead of Config.TIMEOUT.
+The probes run in an asyncio loop in their own thread.
+"""
+import asyncio
+import logging
+import ssl
+from dataclasses import dataclass
+from threading import Thread
+from time import monotonic, time
+from typing import Dict, Optional, Tuple
+from urllib.parse import urljoin, urlsplit
+
+from config import Config
+from metrics import metrics
+from models.catalog import catalog
+from models.stations import Station
+from resolver import PLAYLIST_TYPES, is_hls, parse_playlist, resolver
+from variant_selector import selector
+
+LOG = logging.getLogger(__name__)
+
+PROBE_BODY = 2048  # bytes of audio read to check that the stream delivers
+MAX_HEADER = 16 * 1024
+MAX_REDIRECTS = 3
+CODECS = {'audio/mpeg': 'mp3', 'audio/mp3': 'mp3', 'audio/aac': 'aac', 'audio/aacp': 'aac', 'audio/x-aac': 'aac',
+          'audio/ogg': 'ogg', 'application/ogg': 'ogg', 'audio/flac': 'flac'}
+HLS_TYPES = ('application/vnd.apple.mpegurl', 'application/x-mpegurl')
+
+
+@dataclass
+class Probe:
+    """Result of a reachability check"""
+    reachable: bool
+    latency: float = 0.0  # seconds until the first audio bytes
+    codec: str = ''
+    bitrate: int = 0  # kbit/s, from the icy-br header
+    error: str = ''
+    checked: float = 0.0  # timestamp
+
+    @property
+    def fresh(self) -> bool:
+        """Checked recently enough to be trusted"""
+        return time() - self.checked < 2 * Config.PROBE_INTERVAL
+
+
+def _parse_head(head: bytes) -> Tuple[int, Dict[str, str]]:
+    """
+    @param head: status line and headers of a http or icy response
+    @return: status code and headers with lowercase names
+    @raise ValueError: not a http response
+    """
+    lines = head.decode('latin-1').split('\r\n')
+    _protocol, status, *_reason = lines[0].split(' ', 2)
+    headers = {}
+    for line in lines[1:]:
+        name, _, value = line.partition(':')
+        if name:
+            headers[name.strip().lower()] = value.strip()
+    return int(status), headers
+
+
+def _codec(content_type: str, body: bytes) -> str:
+    """Codec name for a content type. A hls playlist is reachable as it is: mpv plays it itself"""
+    if content_type in HLS_TYPES or (content_type in PLAYLIST_TYPES and is_hls(body.decode('utf-8', errors='replace'))):
+        return 'hls'
+    return CODECS.get(content_type, content_type)
+
+
+async def probe(url: str) -> Tuple[Probe, int]:
+    """
+    Check a stream url
+    @param url: str
+    @return: Probe and the number of bytes received
+    """
+    start = monotonic()
+    received = 0
+    for _ in range(MAX_REDIRECTS + 1):
+        parts = urlsplit(url)
+        https = parts.scheme == 'https'
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(
+            parts.hostname, parts.port or (443 if https else 80), ssl=ssl.create_default_context() if https else None,
+            limit=MAX_HEADER), Config.PROBE_TIMEOUT)
+        try:
+            path = (parts.path or '/') + (f'?{parts.query}' if parts.query else '')
+            writer.write(f"GET {path} HTTP/1.0\r\nHost: {parts.netloc}\r\nUser-Agent: piradio\r\nIcy-MetaData: 1\r\n"
+                         f"\r\n".encode('latin-1'))
+            head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), Config.PROBE_TIMEOUT)
+            received += len(head)
+            status, headers = _parse_head(head)
+            if status in (301, 302, 303, 307, 308) and 'location' in headers:
+                url = urljoin(url, headers['location'])
+                continue
+            if status != 200:
+                return Probe(False, error=f"http {status}", checked=time()), received
+
+            content_type = headers.get('content-type', '').split(';')[0].strip().lower()
+            body = await asyncio.wait_for(reader.read(PROBE_BODY), Config.PROBE_TIMEOUT)
+            received += len(body)
+            if content_type in PLAYLIST_TYPES and not is_hls(body.decode('utf-8', errors='replace')):
+                media_url = parse_playlist(body.decode('utf-8', errors='replace'), url)
+                if media_url is None:
+                    return Probe(False, error="empty playlist", checked=time()), received
+                url = media_url
+                continue
+            if not body:
+                return Probe(False, error="no audio", checked=time()), received
+            try:
+                bitrate = int(headers.get('icy-br', '0').split(',')[0])
+            except ValueError:
+                bitrate = 0
+            return Probe(True, latency=monotonic() - start, codec=_codec(content_type, body),
+                         bitrate=bitrate, checked=time()), received
+        finally:
+            writer.close()
+    return Probe(False, error="too many redirects", checked=time()), received
+
+
+class Prober:
+    """Probe the stations of the catalog in a background thread"""
+    def __init__(self):
+        self._results: Dict[str, Probe] = {}  # station id -> last probe
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._cursor = 0  # position in the catalog of the next station to probe
+
+    def start(self):
+        """Start probing after Config.PROBE_START_DELAY seconds"""
+        if not Config.PROBE:
+            return
+        self._loop = asyncio.new_event_loop()
+        Thread(target=self._loop.run_until_complete, args=(self._run(),), name="prober", daemon=True).start()
+
+    def result(self, station: Station) -> Optional[Probe]:
+        """@return: the last probe of station or None when it wasn't probed (recently)"""
+        result = self._results.get(station.id)
+        return result if result is not None and result.fresh else None
+
+    def is_down(self, station: Station) -> bool:
+        """Check if the last probe of station failed"""
+        result = self.result(station)
+        return result is not None and not result.reachable
+
+    def played(self, station: Station):
+        """station is playing: it isn't down, whatever the last probe said"""
+        result = self._results.get(station.id)
+        if result is not None and not result.reachable:
+            del self._results[station.id]
+
+    def check(self, station: Station):
+        """Probe station now (in the prober thread)"""
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(lambda: self._loop.create_task(self._probe_station(station)))
+
+    async def _run(self):
+        await asyncio.sleep(Config.PROBE_START_DELAY)
+        while True:
+            await self._round()
+            await asyncio.sleep(Config.PROBE_INTERVAL)
+
+    async def _round(self):
+        """Probe the stations from the cursor on, until all are probed or the budget is used"""
+        start = monotonic()
+        semaphore = asyncio.Semaphore(Config.PROBE_CONCURRENCY)
+        spent = 0
+        probed = 0
+        tasks = set()
+
+        async def run(station: Station):
+            nonlocal spent
+            try:
+                spent += await self._probe_station(station)
+            finally:
+                semaphore.release()
+
+        ids = catalog.ids
+        while probed < len(ids):
+            # wait for a free slot, so the budget is checked with the bytes of the finished probes
+            await semaphore.acquire()
+            if spent >= Config.PROBE_BUDGET:
+                semaphore.release()
+                break
+            station = catalog.get(ids[self._cursor % len(ids)])
+            self._cursor = (self._cursor + 1) % len(ids)
+            probed += 1
+            if station is None:
+                semaphore.release()
+                continue
+            task = asyncio.ensure_future(run(station))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        if tasks:
+            await asyncio.wait(tasks)
+
+        down = sum(1 for result in self._results.values() if not result.reachable)
+        metrics.set_gauge('probe_stations_down', down)
+        LOG.info("Probed %s of %s stations in %.1fs, %s KiB, %s down", probed, len(ids), monotonic() - start,
+                 spent // 1024, down)
+
+    async def _probe_station(self, station: Station) -> int:
+        """Probe station and store the result. @return: bytes received"""
+        url = resolver.cached(selector.select(station).url)
+        try:
+            result, received = await probe(url)
+        except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError,
+                ValueError) as err:
+            result, received = Probe(False, error=str(err) or type(err).__name__, checked=time()), 0
+        previous = self._results.get(station.id)
+        if previous is not None and previous.reachable != result.reachable:
+            LOG.info("Station %s is %s", station.name, "reachable" if result.reachable else f"down: {result.error}")
+        self._results[station.id] = result
+        metrics.inc('probe_bytes_total', received)
+        if result.reachable:
+            metrics.observe('probe_seconds', result.latency)
+        return received
+
+
+prober = Prober()
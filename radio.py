@@ -1,75 +1,205 @@
 import logging
 from datetime import datetime
 from functools import partial
-from time import time
-
-import mpv
-from gpiozero import Button, RotaryEncoder
+from time import monotonic
+from typing import Callable, List, Optional
 
+from backends import backend
+from commands import CommandQueue, add, cancel, replace
 from config import Config
+from dispatcher import dispatcher, Timer
+from history import history
 from lcd_screen import lcd
-from models.enums import States, Direction
-from models.stations import Station, STATION_LIST
+from metrics import metrics
+from mirror_race import MirrorRace
+from models.catalog import catalog
+from models.enums import Command, Direction, Event, States
+from models.stations import Station, Variant
+from prefetch import prefetcher, WarmStream
+from prober import prober
+from resolver import resolver
+from rotary import RotaryInput
+from state import store
+from stream_watchdog import StreamWatchdog
+from timeshift import timeshift
+from variant_selector import selector
 
 LOG = logging.getLogger(__name__)
+MPV_LOG = logging.getLogger('mpv')  # rate limited per component, see logger.py
 
 
 def _mpv_log(loglevel: str, component: str, message: str):
-    """Log handler for the python-mpv.MPV instance"""
-    LOG.warning('[python-mpv] [%s] %s: %s', loglevel, component, message)
+    """Log handler for the player"""
+    MPV_LOG.warning('[python-mpv] [%s] %s: %s', loglevel, component, message, extra={'component': component})
 
 
-def _save_last_station(filename: str, radio: Station):
-    """
-    Save station RADIO index to file
-    @param filename: str, file name
-    @param radio: Station
-    """
-    index = STATION_LIST.index(radio)
-    with open(filename, 'w', encoding='utf-8') as file:
-        file.write(str(index))
-    LOG.debug("Saved RADIO index %s to file", index)
+def _mpv_observer(event: Event, _name: str, value):
+    """Property observer for the player. Runs in the mpv event thread -> forward to the dispatcher"""
+    dispatcher.post(event, value)
+
 
+def _mpv_event(name: str, data: dict):
+    """Event callback for the player. Runs in the mpv event thread -> forward to the dispatcher"""
+    if name == 'start-file':
+        dispatcher.post(Event.START_FILE, data['playlist_entry_id'])
+    elif name == 'file-loaded':
+        dispatcher.post(Event.FILE_LOADED)
+    elif name == 'playback-restart':
+        dispatcher.post(Event.PLAYBACK_RESTART)
+    elif name == 'end-file':
+        dispatcher.post(Event.END_FILE, data['playlist_entry_id'], data['reason'])
+    elif name == 'shutdown':
+        dispatcher.post(Event.SHUTDOWN)
 
-def _get_saved_station(filename: str) -> Station:
+
+def _icy_title(title: str):
+    """Title callback for a warm stream. Runs in the prefetch thread -> forward to the dispatcher"""
+    dispatcher.post(Event.METADATA, {'icy-title': title})
+
+
+def _get_saved_station(station_id: str) -> Station:
     """
-    Get saved RADIO index nr
-    @param filename: str, file name
+    Get the saved station. Older versions saved the index nr in STATION_LIST
+    @param station_id: str, saved station id
     @return: Station
     """
-    try:
-        with open(filename, 'r', encoding='utf-8') as file:
-            index = int(file.readline())
-        LOG.debug("Retrieving saved last radio index: %s", index)
-    except FileNotFoundError:
-        index = 0
-        LOG.warning("Error while reading saved playlist index nr. Getting first item instead")
-
-    return STATION_LIST[index]
+    LOG.debug("Retrieving saved last radio id: %s", station_id)
+    station = catalog.get(station_id)
+    if station is None and station_id.isdigit() and int(station_id) < len(catalog):
+        station = catalog[int(station_id)]
+    if station is None:
+        LOG.warning("Error while reading saved station id. Getting first item instead")
+        station = catalog[0]
+    return station
 
 
 class Radio:
     """Global vars"""
-    station: Station = _get_saved_station(Config.SAVED_STATION)
-    new_station: Station = _get_saved_station(Config.SAVED_STATION)
+    station: Station = None  # set by load_station()
+    new_station: Station = None
     _state: States = States.OFF
-    _player = mpv.MPV(log_handler=_mpv_log, audio_device=Config.AUDIO_DEVICE, ytdl=False)
-    _player.set_loglevel('error')
+    _player = None  # created by init_player()
     _current_lcd_text = ""
-    _prior_timer: time = None
+    _prior_timer: float = None
+    _commit_timer: Timer = None
+    _tune_timer: Timer = None
+    _prefetch_timer: Timer = None
+    _warm_stream: WarmStream = None  # prefetched stream handed over to mpv
+    _python_stream = None  # mpv python stream reading from _warm_stream
+    _race: MirrorRace = None  # connection race between the endpoints of the variant being tuned
+    _entry_id: int = None  # mpv playlist entry of the stream being tuned/played. None while waiting for 'start-file'
+    _variant: Variant = None  # variant of the station being tuned/played
+    _stream_url: str = None  # url passed to mpv for the station: resolved url or the variant url
+    _metadata: dict = None
+    _core_idle: bool = True
+    _playing_since: float = None  # monotonic time the audio of the station started, for the station stats
+    _seeked = False  # the timeshift read position moved while paused
+    _history_position = 0  # history entry shown with the select button, 0 -> station name
+    _history_shown: float = None  # _prior_timer of the last text shown by show_history()
+    _status_listeners: List[Callable[[], None]] = []
+    _status_pending = False
 
     @classmethod
     def state(cls):
         return cls._state
 
+    @classmethod
+    def _set_state(cls, state: States):
+        cls._state = state
+        metrics.since('input', 'input_to_state_seconds', once=True)
+        cls._status_changed()
+
+    @classmethod
+    def title(cls) -> Optional[str]:
+        """@return: the icy-title of the playing stream"""
+        if cls._state is not States.PLAYING or not cls._metadata:
+            return None
+        return cls._metadata.get('icy-title')
+
+    @classmethod
+    def on_status_change(cls, listener: Callable[[], None]):
+        """
+        Call listener in the dispatcher thread when the state, the station, the title, the volume or the favourites
+        change. The changes made by one handler are notified once
+        """
+        cls._status_listeners.append(listener)
+
+    @classmethod
+    def _status_changed(cls):
+        if cls._status_listeners and not cls._status_pending:
+            cls._status_pending = True
+            dispatcher.call_later(0, cls._notify_status)
+
+    @classmethod
+    def _notify_status(cls):
+        cls._status_pending = False
+        for listener in cls._status_listeners:
+            listener()
+
+    @classmethod
+    def load_station(cls):
+        """Get the last played station"""
+        cls.station = cls.new_station = _get_saved_station(store.get('station', ''))
+
+    @classmethod
+    def init_player(cls):
+        """Start the mpv core and connect its events"""
+        cls._player = backend.player(log_handler=_mpv_log, audio_device=Config.AUDIO_DEVICE)
+        volume = store.get('volume')
+        if volume is not None:
+            cls._player.set_volume(volume)
+        if Config.TIMESHIFT:
+            # python-mpv sets an attribute on the registered function, a bound method doesn't take one
+            cls._player.python_stream('timeshift')(lambda: timeshift.chunks())  # pylint: disable=unnecessary-lambda
+            timeshift.on_title = _icy_title
+        cls.connect_events()
+
+    @classmethod
+    def connect_events(cls):
+        """Observe the mpv properties and events and subscribe the handlers to the dispatcher"""
+        cls._player.observe_property('metadata', partial(_mpv_observer, Event.METADATA))
+        cls._player.observe_property('core-idle', partial(_mpv_observer, Event.CORE_IDLE))
+        if Config.WATCHDOG:
+            cls._player.observe_property('demuxer-cache-duration', partial(_mpv_observer, Event.CACHE_DURATION))
+            cls._player.observe_property('paused-for-cache', partial(_mpv_observer, Event.PAUSED_FOR_CACHE))
+            dispatcher.subscribe(Event.CACHE_DURATION, watchdog.on_cache_duration)
+            dispatcher.subscribe(Event.PAUSED_FOR_CACHE, watchdog.on_paused_for_cache)
+        if Config.WATCHDOG and Config.ABR:
+            # a variant switch is a reconnect of the watchdog
+            cls._player.observe_property('cache-speed', partial(_mpv_observer, Event.CACHE_SPEED))
+            dispatcher.subscribe(Event.PAUSED_FOR_CACHE, cls.on_paused_for_cache)
+            dispatcher.subscribe(Event.CACHE_SPEED, cls.on_cache_speed)
+        cls._player.on_event(_mpv_event)
+        dispatcher.subscribe(Event.METADATA, cls.on_metadata)
+        dispatcher.subscribe(Event.CORE_IDLE, cls.on_core_idle)
+        dispatcher.subscribe(Event.START_FILE, cls.on_start_file)
+        dispatcher.subscribe(Event.FILE_LOADED, cls.on_file_loaded)
+        dispatcher.subscribe(Event.PLAYBACK_RESTART, cls.on_playback_restart)
+        dispatcher.subscribe(Event.END_FILE, cls.on_end_file)
+        dispatcher.subscribe(Event.SHUTDOWN, dispatcher.stop)
+
     @classmethod
     def stop(cls):
         """Stop the radio"""
-        cls._state = States.OFF
+        cls._set_state(States.OFF)
+        cls._cancel_tuning()
+        cls._entry_id = None
+        cls._end_listening()
+        watchdog.stop()
+        selector.stop()
+        rotary.reset()
         LOG.info("Stop player")
         lcd.lcd_backlight_toggle(on=False)
-        Radio._player.stop()
-        ButtonPanel.disable()
+        if Config.TIMESHIFT:
+            timeshift.stop()
+        prefetcher.close()
+        cls._release_warm_stream()
+        try:
+            if Radio._player is not None:
+                Radio._player.stop()  # raises PlayerShutdown when mpv is gone already, e.g. at exit
+                Radio._player.pause(False)
+        finally:
+            ButtonPanel.disable()
 
     @classmethod
     def start(cls):
@@ -85,59 +215,431 @@ class Radio:
         Check if a new station is selected.
         The new station will play when user waits 3 seconds or pressed the rotary select button
         """
-        if Radio.new_station != Radio.station:
-            if ButtonPanel.button_select.is_active or time() - ButtonPanel.button_rotary_timestamp > 3:
-                cls.play(cls.new_station)
+        if cls._commit_timer is not None:
+            cls._commit_timer.cancel()
+            cls._commit_timer = None
+
+        if cls._state is States.SELECT_STATION and Radio.new_station != Radio.station:
+            cls.play(cls.new_station)
 
     @classmethod
-    def select_station(cls, direction: Direction):
+    def select_station(cls, steps: int):
         """
-        Set a new station ready in the Radio.new_station field based on the direction of the RotaryEncoder.
+        Set a new station ready in the Radio.new_station field based on the movement of the RotaryEncoder.
         Print selected station on lcd
+        @param steps: int, negative -> counterclockwise
         """
-        cls._state = States.SELECT_STATION
+        cls._set_state(States.SELECT_STATION)
 
-        index = STATION_LIST.index(cls.new_station)
-        if direction == Direction.CLOCKWISE:
-            index = 0 if index == len(STATION_LIST) - 1 else index + 1
-        else:
-            index = len(STATION_LIST) - 1 if index == 0 else index - 1
+        station_id = catalog.move(cls.new_station.id, steps)
+        station = catalog.get(station_id)
+        # skip the records which fail to load, and the stations which are down
+        for _ in range(len(catalog) - 1):
+            if station is not None and not (Config.PROBE_SKIP_DOWN and prober.is_down(station)):
+                break
+            station_id = catalog.move(station_id, 1 if steps > 0 else -1)
+            station = catalog.get(station_id)
+        if station is None:
+            LOG.error("No station record can be loaded")
+            return
+        cls.new_station = station
+        cls.set_lcd_text(f"{cls.new_station.name} (offline)" if prober.is_down(cls.new_station)
+                         else cls.new_station.name)
+        cls._status_changed()
+
+        # (re)start the 3 seconds countdown to play the selected station
+        if cls._commit_timer is not None:
+            cls._commit_timer.cancel()
+        cls._commit_timer = dispatcher.call_later(3, cls.check_select_station)
+
+        if Config.PREFETCH:
+            if cls._prefetch_timer is not None:
+                cls._prefetch_timer.cancel()
+            cls._prefetch_timer = dispatcher.call_later(Config.PREFETCH_DELAY, cls._prefetch)
 
-        cls.new_station = STATION_LIST[index]
-        cls.set_lcd_text(cls.new_station.name)
+    @classmethod
+    def _prefetch(cls):
+        """Pre-connect to the station under the cursor and its neighbours"""
+        cls._prefetch_timer = None
+        if cls._state is not States.SELECT_STATION:
+            return
+
+        candidates = [cls.new_station]
+        for distance in range(1, Config.PREFETCH_NEIGHBOURS + 1):
+            candidates.append(catalog.get(catalog.move(cls.new_station.id, distance)))
+            candidates.append(catalog.get(catalog.move(cls.new_station.id, -distance)))
+
+        # the station on air doesn't need a second connection
+        urls = []
+        for station in candidates:
+            url = resolver.lookup(selector.select(station).url)
+            if station != cls.station and url not in urls:
+                urls.append(url)
+        prefetcher.warm(urls)
+        dispatcher.call_later(Config.PREFETCH_TTL, prefetcher.expire)
 
     @classmethod
     def play(cls, station: Station):
-        """Start playing station. Display error message when PLAYER is still idle after n seconds"""
-        cls._state = States.START_STREAM
-        timestamp = time()
-        lcd.clear()
+        """
+        Start tuning station and return immediately. The mpv events decide whether the stream started.
+        A new call cancels the tuning in progress. Display error message when the stream didn't start after n seconds
+        """
+        cls._cancel_tuning()
+        cls._entry_id = None  # ignore the events of the previous stream
+        watchdog.stop()
+        selector.stop()
+        metrics.mark('play')
+        cls._set_state(States.START_STREAM)
         cls.set_lcd_text("Tuning...")
+        cls._end_listening()
         cls.station = station
-        Radio._player.play(Radio.station.url)
-        while Radio._player.core_idle:
-            if time() - timestamp >= Config.TIMEOUT:
-                LOG.error("Cannot start radio")
-                cls.set_lcd_text("ERROR: cannot start playing")
-                cls._state = States.MAIN
-                break
+        cls._variant = selector.select(station)
+        cls._start_stream(resolver.lookup(cls._variant.url))
+
+    @classmethod
+    def _start_stream(cls, url: str, timeout: bool = True):
+        """
+        Start loading url for the station being tuned. Use the prefetched stream for url when there is one, race url
+        and the mirrors of the variant when it has mirrors
+        @param url: str
+        @param timeout: give up after Config.TIMEOUT seconds, Config.PROBE_DOWN_TIMEOUT for a station known to be down
+        """
+        cls._stream_url = url
+        if timeout:
+            seconds = Config.PROBE_DOWN_TIMEOUT if prober.is_down(cls.station) else Config.TIMEOUT
+            cls._tune_timer = dispatcher.call_later(seconds, cls._tune_failed, "timeout")
+        cls._release_warm_stream()
+        warm = prefetcher.take(url) if Config.PREFETCH else None
+        metrics.since('play', 'play_call_seconds', prefetched=warm is not None)
+        if warm is None and cls._variant.mirrors:
+            urls = [url] + [resolver.cached(mirror) for mirror in cls._variant.mirrors]
+            cls._race = MirrorRace(urls, partial(dispatcher.call_later, 0, cls._race_done))
+            return
+        cls._play_stream(url, warm)
+
+    @classmethod
+    def _race_done(cls, race: MirrorRace, winner: Optional[WarmStream]):
+        """The endpoints of the variant raced. A failed race of a reconnect is left to the watchdog"""
+        if race is not cls._race:
+            if winner is not None:
+                winner.close()
+            return
+        cls._race = None
+        if winner is not None:
+            cls._play_stream(winner.url, winner)
+        elif cls._state is States.START_STREAM:
+            cls._tune_failed("no endpoint")
+
+    @classmethod
+    def _play_stream(cls, url: str, warm: Optional[WarmStream]):
+        """Let mpv play url, from the open connection warm when given"""
+        if Config.TIMESHIFT:
+            # record the station and play the recording
+            timeshift.record(url, warm or WarmStream(url))
+            cls._play_timeshift()
+            return
+        if warm is None:
+            Radio._player.play(url)
+            return
+
+        # play from the prefetched connection
+        LOG.debug("Use prefetched stream: %s", url)
+        cls._warm_stream = warm
+
+        def reader():
+            return warm.chunks()
+
+        cls._python_stream = cls._player.python_stream('prefetch')(reader)
+        warm.on_title = _icy_title
+        if warm.title:
+            _icy_title(warm.title)
+        Radio._player.play('python://prefetch')
+
+    @classmethod
+    def _play_timeshift(cls):
+        """Play the timeshift recording from its read position"""
+        Radio._player.pause(False)
+        Radio._player.play('python://timeshift')
+
+    @classmethod
+    def toggle_pause(cls):
+        """Pause the playing station or resume it. Only with Config.TIMESHIFT: the recording goes on while paused"""
+        if not Config.TIMESHIFT:
+            return
+        if cls._state is States.PLAYING:
+            watchdog.stop()
+            selector.stop()
+            cls._end_listening()
+            cls._player.pause(True)
+            cls._seeked = False
+            cls._set_state(States.PAUSED)
+            cls.set_lcd_text(f"Paused {_format_delay(timeshift.delay)}")
+        elif cls._state is States.PAUSED:
+            cls._resume()
 
-        if not Radio._player.core_idle:
-            cls.set_lcd_text(Radio.station.name)
-            _save_last_station(Config.SAVED_STATION, Radio.station)
-            LOG.info("Radio stream started: %s - %s", Radio.station.name, Radio.station.url)
-            cls._state = States.PLAYING
+    @classmethod
+    def seek(cls, seconds: float):
+        """
+        Move through the timeshift recording. While paused, the new position plays when the radio resumes
+        @param seconds: float, negative -> rewind
+        """
+        if not Config.TIMESHIFT or cls._state not in (States.PLAYING, States.PAUSED):
+            return
+        delay = timeshift.seek(seconds)
+        if cls._state is States.PAUSED:
+            cls._seeked = True
+            cls.set_lcd_text(f"Paused {_format_delay(delay)}")
+            cls._status_changed()
+        else:
+            cls._entry_id = None
+            cls._play_timeshift()
+
+    @classmethod
+    def go_live(cls):
+        """Play the end of the timeshift recording"""
+        if not Config.TIMESHIFT or cls._state not in (States.PLAYING, States.PAUSED):
+            return
+        timeshift.live()
+        cls._seeked = True
+        if cls._state is States.PAUSED:
+            cls._resume()
+        else:
+            cls._entry_id = None
+            cls._play_timeshift()
+
+    @classmethod
+    def _resume(cls):
+        """Play again after a pause. A moved read position needs a new mpv stream"""
+        if cls._seeked:
+            cls._entry_id = None
+            cls._play_timeshift()
+        else:
+            cls._player.pause(False)
+        cls._set_state(States.PLAYING)
+        cls.set_lcd_text(cls.station.name)
+        cls._playing_since = monotonic()
+        if Config.WATCHDOG:
+            watchdog.start(cls.station)
+            selector.start(cls.station, cls._variant)
+
+    @classmethod
+    def _release_warm_stream(cls):
+        """Close the prefetched stream handed over to mpv and the racing connections"""
+        if cls._race is not None:
+            cls._race.cancel()
+            cls._race = None
+        if cls._python_stream is not None:
+            cls._python_stream.unregister()
+            cls._python_stream = None
+        if cls._warm_stream is not None:
+            cls._warm_stream.close()
+            cls._warm_stream = None
+
+    @classmethod
+    def on_start_file(cls, entry_id: int):
+        """Handler for the mpv 'start-file' event"""
+        cls._entry_id = entry_id
+
+    @classmethod
+    def on_file_loaded(cls):
+        """Handler for the mpv 'file-loaded' event -> the stream is opened, waiting for audio"""
+        if cls._state is States.START_STREAM and cls._entry_id is not None:
+            metrics.since('play', 'tune_file_loaded_seconds', once=True, station=cls.station.name)
+            LOG.debug("Stream loaded: %s", cls._stream_url)
+
+    @classmethod
+    def on_playback_restart(cls):
+        """Handler for the mpv 'playback-restart' event -> audio is playing"""
+        if cls._state is States.PLAYING and watchdog.reconnecting and cls._entry_id is not None:
+            LOG.info("Radio stream reconnected: %s - %s", Radio.station.name, cls._stream_url)
+            watchdog.on_playback_restart()
+            selector.start(cls.station, cls._variant)
+            return
+        if cls._state is not States.START_STREAM or cls._entry_id is None:
+            return
+
+        cls._cancel_tuning()
+        metrics.since('play', 'tune_first_audio_seconds', once=True, station=cls.station.name)
+        cls._set_state(States.PLAYING)
+        cls.set_lcd_text(Radio.station.name)
+        cls._playing_since = monotonic()
+        prober.played(Radio.station)
+        store.set('station', Radio.station.id)
+        store.add_stats(Radio.station.id, plays=1)
+        if Config.WATCHDOG:
+            watchdog.start(Radio.station)
+            selector.start(Radio.station, cls._variant)
+        LOG.info("Radio stream started: %s - %s", Radio.station.name, cls._stream_url)
+
+    @classmethod
+    def on_end_file(cls, entry_id: int, reason: str):
+        """
+        Handler for the mpv 'end-file' event. An error of the stream being tuned fails the tuning, the end of the
+        playing stream goes to the watchdog
+        """
+        if entry_id != cls._entry_id:
+            return
+        if cls._state is States.START_STREAM and reason == 'error':
+            cls._tune_failed("end-file error")
+        elif cls._state is States.PLAYING:
+            watchdog.on_end_file(reason)
+
+    @classmethod
+    def reconnect(cls):
+        """Play the station again for the watchdog. The lcd keeps its text"""
+        cls._entry_id = None
+        cls._start_stream(resolver.lookup(cls._variant.url), timeout=False)
+
+    @classmethod
+    def on_paused_for_cache(cls, paused: bool):
+        """Handler for changes of the mpv 'paused-for-cache' property -> rebuffer events for the variant selector"""
+        if cls._state is States.PLAYING and not watchdog.reconnecting:
+            cls._switch_variant(selector.on_rebuffer(paused))
+
+    @classmethod
+    def on_cache_speed(cls, speed: float):
+        """Handler for changes of the mpv 'cache-speed' property (bytes/s) -> throughput for the variant selector"""
+        if cls._state is States.PLAYING and not watchdog.reconnecting:
+            cls._switch_variant(selector.on_throughput(speed))
+
+    @classmethod
+    def _switch_variant(cls, variant: Variant):
+        """Play another variant of the station. The lcd keeps its text"""
+        if variant is None:
+            return
+        cls._variant = variant
+        watchdog.restart()
+
+    @classmethod
+    def stream_lost(cls, reason: str):
+        """The watchdog gave up reconnecting"""
+        cls._entry_id = None
+        cls._player.stop()
+        cls._end_listening()
+        metrics.inc('tune_failures_total', station=cls.station.name, reason=reason)
+        cls.set_lcd_text("ERROR: stream lost")
+        cls._set_state(States.MAIN)
+
+    @classmethod
+    def _tune_failed(cls, reason: str):
+        """
+        Stop tuning and display error message. A failing resolved url is retried with the original variant url, then
+        the next variant of the station is tried
+        """
+        cls._cancel_tuning()
+        if cls._stream_url != cls._variant.url:
+            # the cached url may be outdated
+            LOG.warning("Cannot start %s (%s). Retry with %s", cls._stream_url, reason, cls._variant.url)
+            resolver.invalidate(cls._variant.url)
+            cls._entry_id = None
+            cls._start_stream(cls._variant.url)
+            return
+
+        variant = selector.failed(cls.station, cls._variant)
+        if variant is not None:
+            LOG.warning("Cannot start %s (%s). Try %s", cls._variant.url, reason, variant.url)
+            cls._variant = variant
+            cls._entry_id = None
+            cls._start_stream(resolver.lookup(variant.url))
+            return
+
+        metrics.inc('tune_failures_total', station=cls.station.name, reason=reason)
+        store.add_stats(cls.station.id, failures=1)
+        prober.check(cls.station)
+        LOG.error("Cannot start radio (%s): %s - %s", reason, cls.station.name, cls.station.url)
+        cls.set_lcd_text("ERROR: cannot start playing")
+        cls._set_state(States.MAIN)
+
+    @classmethod
+    def _end_listening(cls):
+        """Add the listening time of the playing station to its stats"""
+        if cls._playing_since is not None:
+            store.add_stats(cls.station.id, seconds=round(monotonic() - cls._playing_since, 1))
+            cls._playing_since = None
+
+    @classmethod
+    def set_volume(cls, volume: int):
+        """
+        Set and save the volume
+        @param volume: int, 0-100
+        """
+        volume = max(0, min(100, volume))
+        cls._player.set_volume(volume)
+        store.set('volume', volume)
+        cls._status_changed()
+
+    @classmethod
+    def toggle_favourite(cls, station: Station):
+        """Add station to or remove it from the favourites. The favourites come first in the station list"""
+        favourites = list(store.get('favourites', []))
+        if station.id in favourites:
+            favourites.remove(station.id)
+        else:
+            favourites.append(station.id)
+        store.set('favourites', favourites)
+        catalog.set_favourites(favourites)
+        cls._status_changed()
+
+    @classmethod
+    def _cancel_tuning(cls):
+        """Cancel the tuning timeout and the endpoint race"""
+        if cls._tune_timer is not None:
+            cls._tune_timer.cancel()
+            cls._tune_timer = None
+        if cls._race is not None:
+            cls._race.cancel()
+            cls._race = None
+
+    @classmethod
+    def on_metadata(cls, metadata: dict):
+        """Handler for changes of the mpv 'metadata' property"""
+        cls._metadata = metadata
+        cls.check_metadata()
+        cls._status_changed()
+
+    @classmethod
+    def on_core_idle(cls, idle: bool):
+        """Handler for changes of the mpv 'core-idle' property"""
+        cls._core_idle = idle
+        LOG.debug("mpv core-idle: %s", idle)
 
     @classmethod
     def check_metadata(cls):
         """Update the metadata on the lcd screen if necessary"""
+        if cls._state is not States.PLAYING:
+            return
+
         try:
-            if cls._player.metadata is not None:
-                if cls._current_lcd_text != cls._player.metadata['icy-title']:
-                    cls.set_lcd_text(Radio._player.metadata['icy-title'], prior=False)
-        except (KeyError, AttributeError):
-            # ignore exceptions raised because of missing 'metadata' attribute or missing 'icy-title' key
-            pass
+            title = cls._metadata['icy-title']
+        except (KeyError, TypeError):
+            # ignore missing metadata or missing 'icy-title' key
+            return
+
+        history.add(cls.station, title)
+        if cls._current_lcd_text != title:
+            cls.set_lcd_text(title, prior=False)
+            if cls._current_lcd_text == title:
+                metrics.since('play', 'tune_first_title_seconds', once=True, station=cls.station.name)
+
+    @classmethod
+    def show_history(cls):
+        """
+        Select button while playing: the first press shows the station name, every next press while the text is still
+        on the display goes back one title in the history, e.g. '14:02 Artist - Song'
+        """
+        showing = (cls._prior_timer is not None and cls._prior_timer == cls._history_shown
+                   and monotonic() - cls._prior_timer < 3)
+        cls._history_position = cls._history_position + 1 if showing else 0
+        entries = history.recent(cls._history_position)
+        if cls._history_position == 0:
+            cls.set_lcd_text(cls.station.name)
+        elif len(entries) < cls._history_position:
+            cls._history_position = -1  # the next press shows the station name again
+            cls.set_lcd_text("End of history")
+        else:
+            entry = entries[-1]
+            cls.set_lcd_text(f"{datetime.fromtimestamp(entry.time).strftime('%H:%M')} {entry.title}")
+        cls._history_shown = cls._prior_timer
 
     @classmethod
     def set_lcd_text(cls, text: str, prior: bool = True):
@@ -147,56 +649,125 @@ class Radio:
         new 'prior' calls. (So far only the icy data has no prior...)
         """
         if not prior and cls._prior_timer is not None:
-            if time() - cls._prior_timer < 3:
+            if monotonic() - cls._prior_timer < 3:
                 # a message will be dropped if not prior itself or passed with prior override
                 return
 
             cls._prior_timer = None
 
         if prior:
-            cls._prior_timer = time()
+            cls._prior_timer = monotonic()
+            # show the metadata again when the 'prior' text expires
+            dispatcher.call_later(3, cls.check_metadata)
 
         lcd.display_text(text)
         cls._current_lcd_text = text
         LOG.debug(f"New text for lcd: '%s'. prior=%s", text, str(prior).upper())
 
 
-# Button handlers
+def _format_delay(seconds: float) -> str:
+    """Timeshift delay for the lcd, e.g. '-02:35' or 'live'"""
+    seconds = int(seconds)
+    return f"-{seconds // 60:02d}:{seconds % 60:02d}" if seconds else "live"
+
+
+def _start_station(station_id: str):
+    """Switch the radio on with a station of the control api"""
+    Radio.station = Radio.new_station = catalog.get(station_id)
+    Radio.start()
+
+
+def _play_station(station_id: str):
+    """Play a station of the control api"""
+    Radio.new_station = catalog.get(station_id)
+    Radio.play(Radio.new_station)
+
+
+def _seek_steps(steps: int):
+    """Encoder movement while paused: move through the timeshift recording"""
+    Radio.seek(steps * Config.TIMESHIFT_STEP)
+
+
+watchdog = StreamWatchdog(Radio.reconnect, Radio.stream_lost)
+
+_ON = tuple(state for state in States if state is not States.OFF)
+_LISTENING = (States.PLAYING, States.PAUSED)
+
+# (command, state) -> handler. The commands without an entry for the state are ignored
+TRANSITIONS = {
+    (Command.TOGGLE, States.OFF): Radio.start,
+    **{(Command.TOGGLE, state): Radio.stop for state in _ON},
+    (Command.SELECT, States.SELECT_STATION): Radio.check_select_station,
+    (Command.SELECT, States.PLAYING): Radio.toggle_pause if Config.TIMESHIFT else Radio.show_history,
+    (Command.SELECT, States.PAUSED): Radio.toggle_pause,
+    **{(Command.MOVE, state): Radio.select_station for state in (States.MAIN, States.PLAYING, States.SELECT_STATION)},
+    (Command.MOVE, States.PAUSED): _seek_steps,
+    (Command.PLAY, States.OFF): _start_station,
+    **{(Command.PLAY, state): _play_station for state in _ON},
+    **{(Command.VOLUME, state): Radio.set_volume for state in States},
+    **{(Command.FAVOURITE, state): lambda: Radio.toggle_favourite(Radio.station) for state in States},
+    **{(Command.PAUSE, state): Radio.toggle_pause for state in _LISTENING},
+    **{(Command.SEEK, state): Radio.seek for state in _LISTENING},
+    **{(Command.LIVE, state): Radio.go_live for state in _LISTENING},
+}
+
+# a command posted again before it ran: toggles cancel out, moves add up, the last value wins
+commands = CommandQueue(TRANSITIONS, Radio.state, {
+    Command.TOGGLE: cancel,
+    Command.MOVE: add,
+    Command.PLAY: replace,
+    Command.VOLUME: replace,
+    Command.FAVOURITE: cancel,
+    Command.PAUSE: cancel,
+    Command.SEEK: add,
+    Command.LIVE: replace,
+})
+
+# accelerate only for long station lists, a short list must stay easy to browse one by one
+rotary = RotaryInput(partial(commands.execute, Command.MOVE), max_acceleration=lambda: len(catalog) // 20)
+
+
+# Button handlers. They run in the gpio threads: only post a command
 def btn_toggle_handler():
     """Handler for the 'toggle radio' button"""
-    LOG.debug("Button toggle radio pressed")
-    if Radio.state() is States.OFF:
-        Radio.start()
-    else:
-        Radio.stop()
+    metrics.mark('input')
+    commands.post(Command.TOGGLE)
 
 
 def btn_select_handler():
-    """Handler for push button from rotary encoder -> play next radio station"""
-    LOG.debug("Btn_select pressed %s", datetime.now().strftime("%H:%M:%S"))
-    if Radio.state() is States.PLAYING:
-        Radio.set_lcd_text(Radio.station.name)
+    """
+    Handler for push button from rotary encoder -> play next radio station, or step back through the title history
+    while playing. With Config.TIMESHIFT it pauses and resumes the playing station
+    """
+    metrics.mark('input')
+    commands.post(Command.SELECT)
 
 
 def btn_rotary_handler(direction: Direction):
-    """Handler -> play next radio station"""
-    LOG.debug("Rotary encoder turned %s. direction = %s", direction.name, direction.name)
-    ButtonPanel.button_rotary_timestamp = time()
-    if Radio.state() in [States.MAIN, States.PLAYING, States.SELECT_STATION]:
-        Radio.select_station(direction)
+    """Handler -> select the next radio station. The ticks are coalesced by the rotary input stage"""
+    metrics.mark('input')
+    rotary.tick(direction)
 
 
 # End Button handlers
 
 
 class ButtonPanel:
-    button_toggle_radio: Button = Button(Config.PIN_BTN_TOGGLE, pull_up=True, bounce_time=Config.BTN_BOUNCE)
-    button_toggle_radio.when_pressed = btn_toggle_handler  # always enabled
-    button_select: Button = Button(Config.PIN_BTN_ROTARY, pull_up=True, bounce_time=Config.BTN_BOUNCE)
-    button_rotary: RotaryEncoder = RotaryEncoder(Config.PIN_ROTARY_DT, Config.PIN_ROTARY_CLK,
-                                                 bounce_time=Config.BTN_BOUNCE, max_steps=len(STATION_LIST) - 1,
-                                                 wrap=True)
-    button_rotary_timestamp: time = time()
+    """Gpio devices. Created by setup()"""
+    button_toggle_radio = None
+    button_select = None
+    button_rotary = None
+
+    @staticmethod
+    def setup():
+        """Create the gpio devices. The toggle button is always enabled"""
+        ButtonPanel.button_toggle_radio = backend.button(Config.PIN_BTN_TOGGLE, pull_up=True,
+                                                         bounce_time=Config.BTN_BOUNCE)
+        ButtonPanel.button_toggle_radio.when_pressed = btn_toggle_handler
+        ButtonPanel.button_select = backend.button(Config.PIN_BTN_ROTARY, pull_up=True, bounce_time=Config.BTN_BOUNCE)
+        # only the rotation handlers are used, so the encoder doesn't need to count the steps (max_steps=0)
+        ButtonPanel.button_rotary = backend.rotary_encoder(Config.PIN_ROTARY_DT, Config.PIN_ROTARY_CLK,
+                                                           bounce_time=Config.BTN_BOUNCE, max_steps=0, wrap=False)
 
     @staticmethod
     def enable():
@@ -208,6 +779,9 @@ class ButtonPanel:
     @staticmethod
     def disable():
         """Disconnect button handlers"""
-        ButtonPanel.when_rotated_clockwise = None
-        ButtonPanel.when_rotated_counter_clockwise = None
+        if ButtonPanel.button_select is None:
+            return
+
+        ButtonPanel.button_rotary.when_rotated_clockwise = None
+        ButtonPanel.button_rotary.when_rotated_counter_clockwise = None
         ButtonPanel.button_select.when_pressed = None
@@ -0,0 +1,203 @@
+"""
+Persistent cache with the resolved stream urls.
+A station url often redirects to another host or points to a playlist (m3u/pls) with the actual stream url. Resolving
+that again for every tune costs several round trips. The resolver stores the final media url and a few server hints per
+station url in a json file. Stale entries are still used, but revalidated in a background
+thread. The caller falls back to the original url when a cached url fails.
+"""
+import http.client
+import json
+import logging
+import os
+import re
+from dataclasses import asdict, dataclass, field, fields
+from threading import Lock, Thread
+from time import time
+from typing import Dict, Iterable, List, Optional
+from urllib.parse import urljoin, urlparse
+from urllib.request import Request, urlopen
+
+from config import Config
+
+LOG = logging.getLogger(__name__)
+
+# no hls (.m3u8, application/vnd.apple.mpegurl): mpv plays it itself
+PLAYLIST_TYPES = ('audio/x-mpegurl', 'audio/mpegurl', 'audio/x-scpls', 'application/pls+xml')
+PLAYLIST_EXTENSIONS = ('.m3u', '.pls')
+MAX_PLAYLIST_SIZE = 16 * 1024
+MAX_DEPTH = 5  # nested playlists, e.g. a playlist pointing to itself
+PLS_ENTRY = re.compile(r'^([A-Za-z]+)\d*=(.*)$')  # e.g. 'File1=http://...', 'NumberOfEntries=1'
+
+
+@dataclass
+class Resolution:
+    """Resolved station url"""
+    final_url: str
+    server: Dict[str, str] = field(default_factory=dict)  # server hints: 'server', 'content-type', 'icy-br', ...
+    resolved: float = 0.0  # timestamp
+
+    @property
+    def stale(self) -> bool:
+        """Older than Config.RESOLVER_TTL"""
+        return time() - self.resolved > Config.RESOLVER_TTL
+
+
+def is_hls(body: str) -> bool:
+    """
+    Check if a playlist is a hls playlist. Its entries are segments of a few seconds, not a stream url
+    @param body: playlist content
+    @return: bool
+    """
+    return body.lstrip().startswith('#EXTM3U') and '#EXT-X-' in body
+
+
+def parse_playlist(body: str, base_url: str) -> Optional[str]:
+    """
+    Get the first stream url from a m3u or pls playlist
+    @param body: playlist content
+    @param base_url: url of the playlist, for relative entries
+    @return: url or None
+    """
+    for line in body.splitlines():
+        line = line.strip()
+        if not line or line.startswith(('#', '[')):
+            continue
+
+        match = PLS_ENTRY.match(line)
+        if match is None:
+            return urljoin(base_url, line)  # m3u entry
+        if match.group(1).lower() == 'file':
+            return urljoin(base_url, match.group(2).strip())
+    return None
+
+
+def resolve(url: str, depth: int = 0) -> Resolution:
+    """
+    Follow the redirects and playlists of url
+    @param url: station url
+    @param depth: playlists followed so far
+    @return: Resolution
+    @raise OSError: url can't be resolved
+    """
+    if depth > MAX_DEPTH:
+        raise OSError(f"More than {MAX_DEPTH} nested playlists: {url}")
+    request = Request(url, headers={'User-Agent': 'piradio', 'Icy-MetaData': '1'})
+    with urlopen(request, timeout=Config.RESOLVER_TIMEOUT) as response:
+        final_url = response.geturl()
+        content_type = response.headers.get_content_type()
+        server = {key: response.headers[key] for key in ('server', 'icy-br', 'icy-name') if key in response.headers}
+        server['content-type'] = content_type
+        if content_type in PLAYLIST_TYPES or urlparse(final_url).path.lower().endswith(PLAYLIST_EXTENSIONS):
+            body = response.read(MAX_PLAYLIST_SIZE).decode('utf-8', errors='replace')
+            if is_hls(body):
+                return Resolution(final_url=url, server=server, resolved=time())  # mpv plays the playlist
+            media_url = parse_playlist(body, final_url)
+            if media_url is None:
+                raise OSError(f"Empty playlist: {final_url}")
+            # the media url itself can redirect too
+            media = resolve(media_url, depth + 1)
+            media.server.setdefault('playlist', final_url)
+            return media
+
+    return Resolution(final_url=final_url, server=server, resolved=time())
+
+
+FIELDS = {item.name for item in fields(Resolution)}
+
+
+class Resolver:
+    """Cache with Resolution's per station url, saved in a json file"""
+    def __init__(self, filename: str):
+        self._filename = filename
+        self._entries: Dict[str, Resolution] = {}
+        self._pending = set()  # urls being revalidated
+        self._lock = Lock()
+        self._save_lock = Lock()
+        self._load()
+
+    def lookup(self, url: str) -> str:
+        """
+        Get the url to play for a station url. Start revalidation in the background when the entry is stale
+        @param url: station url
+        @return: the cached final url or url itself when it isn't resolved yet
+        """
+        entry = self._entries.get(url)
+        if entry is None or entry.stale:
+            self.refresh([url])
+        return url if entry is None else entry.final_url
+
+    def cached(self, url: str) -> str:
+        """
+        Like lookup(), without revalidation
+        @param url: station url
+        @return: the cached final url or url itself when it isn't resolved yet
+        """
+        entry = self._entries.get(url)
+        return url if entry is None else entry.final_url
+
+    def invalidate(self, url: str):
+        """
+        Drop the entry for url, e.g. because the cached url failed to play. It will be resolved again in the background
+        @param url: station url
+        """
+        with self._lock:
+            dropped = self._entries.pop(url, None)
+        if dropped is not None:
+            LOG.info("Resolver entry dropped: %s -> %s", url, dropped.final_url)
+            self._save()
+        self.refresh([url])
+
+    def refresh(self, urls: Iterable[str]):
+        """
+        Resolve the missing or stale urls in a background thread
+        @param urls: station urls
+        """
+        with self._lock:
+            todo = [url for url in urls if url not in self._pending and
+                    (url not in self._entries or self._entries[url].stale)]
+            self._pending.update(todo)
+        if todo:
+            Thread(target=self._resolve_all, args=(todo,), name="resolver", daemon=True).start()
+
+    def _resolve_all(self, urls: List[str]):
+        for url in urls:
+            try:
+                entry = resolve(url)
+                with self._lock:
+                    self._entries[url] = entry
+                LOG.debug("Resolved %s -> %s", url, entry.final_url)
+            except (OSError, ValueError, http.client.HTTPException) as err:
+                # keep the old entry. play() falls back to the original url when it fails
+                LOG.warning("Cannot resolve %s: %s", url, err)
+            finally:
+                with self._lock:
+                    self._pending.discard(url)
+        self._save()
+
+    def _load(self):
+        try:
+            with open(self._filename, 'r', encoding='utf-8') as file:
+                # fields of older versions (the host addresses) are dropped
+                self._entries = {url: Resolution(**{key: value for key, value in entry.items() if key in FIELDS})
+                                 for url, entry in json.load(file).items()}
+            LOG.debug("Loaded %s resolver entries", len(self._entries))
+        except FileNotFoundError:
+            pass
+        except (ValueError, TypeError) as err:
+            LOG.warning("Ignoring corrupt resolver cache %s: %s", self._filename, err)
+
+    def _save(self):
+        """Write the cache file. Replace the old file atomically"""
+        with self._lock:
+            data = {url: asdict(entry) for url, entry in self._entries.items()}
+        tmp = self._filename + '.tmp'
+        try:
+            with self._save_lock:
+                with open(tmp, 'w', encoding='utf-8') as file:
+                    json.dump(data, file, indent=1)
+                os.replace(tmp, self._filename)
+        except OSError as err:
+            LOG.warning("Cannot save resolver cache %s: %s", self._filename, err)
+
+
+resolver = Resolver(Config.RESOLVER_CACHE)
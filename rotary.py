@@ -0,0 +1,71 @@
+"""
+Input stage for the rotary encoder.
+Every detent fires a callback in the gpio thread. Rendering every intermediate station costs a lcd update over i2c per
+tick, which can't keep up when the knob is spun. The ticks are summed into one net movement instead, which is passed on
+in the dispatcher thread at most Config.ROTARY_RENDER_RATE times per second. Fast spinning accelerates: a tick counts
+for several steps when the ticks follow each other faster than Config.ROTARY_ACCEL_RATE per second.
+"""
+import logging
+from threading import Lock
+from time import monotonic
+from typing import Callable
+
+from config import Config
+from dispatcher import dispatcher
+from metrics import metrics
+from models.enums import Direction
+
+LOG = logging.getLogger(__name__)
+
+
+class RotaryInput:
+    """Coalesce the encoder ticks into movements"""
+    def __init__(self, on_move: Callable[[int], None], max_acceleration: Callable[[], int] = lambda: 1):
+        """
+        @param on_move: callback(steps), called in the dispatcher thread. steps < 0 -> counterclockwise
+        @param max_acceleration: callable returning the maximum steps per tick, e.g. depending on the list size
+        """
+        self._on_move = on_move
+        self._max_acceleration = max_acceleration
+        self._lock = Lock()
+        self._steps = 0
+        self._last_tick = float('-inf')
+        self._last_move = float('-inf')
+        self._pending = False  # a _move is scheduled
+
+    def tick(self, direction: Direction):
+        """Add an encoder tick. Called in the gpio thread"""
+        now = monotonic()
+        metrics.inc('rotary_ticks_total')
+        with self._lock:
+            steps = self._acceleration(now - self._last_tick)
+            self._steps += steps if direction is Direction.CLOCKWISE else -steps
+            self._last_tick = now
+            if self._pending:
+                return
+            self._pending = True
+            delay = max(0.0, self._last_move + 1 / Config.ROTARY_RENDER_RATE - now)
+        dispatcher.call_later(delay, self._move)
+
+    def reset(self):
+        """Drop the ticks which weren't passed on yet"""
+        with self._lock:
+            self._steps = 0
+
+    def _acceleration(self, interval: float) -> int:
+        """Steps for a tick, interval seconds after the previous tick"""
+        if interval <= 0 or 1 / interval < Config.ROTARY_ACCEL_RATE:
+            return 1
+        steps = int(1 / interval / Config.ROTARY_ACCEL_RATE) + 1
+        return max(1, min(steps, Config.ROTARY_ACCEL_MAX, self._max_acceleration()))
+
+    def _move(self):
+        """Pass the net movement on. Runs in the dispatcher thread"""
+        with self._lock:
+            steps, self._steps = self._steps, 0
+            self._pending = False
+            self._last_move = monotonic()
+        metrics.inc('rotary_moves_total')
+        if steps:
+            LOG.debug("Rotary encoder moved %s steps", steps)
+            self._on_move(steps)
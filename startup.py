@@ -0,0 +1,121 @@
+"""
+Startup sequence. The slow parts run in parallel: the mpv core, the connection to the last played station, the lcd
+initialization (which needs fixed delays) and the gpio devices. With Config.RESUME_ON_BOOT the radio starts playing
+the last station as soon as everything is ready.
+The duration of every stage is kept in STAGES, the time since process start of the milestones in MILESTONES.
+"""
+import logging
+import os
+from threading import Thread
+from time import monotonic
+from typing import Callable, Dict, List
+
+from config import Config
+from control import control
+from dispatcher import dispatcher
+from lcd_screen import lcd
+from metrics import metrics
+from models.catalog import catalog
+from models.enums import Event
+from prefetch import prefetcher
+from prober import prober
+from radio import ButtonPanel, Radio
+from resolver import resolver
+from state import store
+from variant_selector import selector
+
+LOG = logging.getLogger(__name__)
+
+STAGES: Dict[str, float] = {}  # stage -> duration in seconds
+MILESTONES: Dict[str, float] = {}  # milestone -> seconds since process start
+
+
+def process_age() -> float:
+    """
+    Seconds since the process was started (linux only)
+    @return: float, 0.0 when unknown
+    """
+    try:
+        with open('/proc/self/stat', 'r', encoding='utf-8') as file:
+            # field 22 'starttime' in clock ticks after boot. Skip the command name, it may contain spaces
+            start_ticks = int(file.read().rsplit(')', 1)[1].split()[19])
+        with open('/proc/uptime', 'r', encoding='utf-8') as file:
+            uptime = float(file.read().split()[0])
+        return uptime - start_ticks / os.sysconf('SC_CLK_TCK')
+    except (OSError, ValueError, IndexError):
+        return 0.0
+
+
+def run():
+    """Run the startup stages. Return when the radio is ready to be used"""
+    MILESTONES['imports'] = process_age()
+    _stage('catalog', _load_catalog)
+    _stage('station', Radio.load_station)  # the stream stage needs the station
+
+    errors: List[BaseException] = []
+    threads = [Thread(target=_stage, args=(name, function, errors), name=f"startup_{name}")
+               for name, function in (('player', Radio.init_player),
+                                      ('stream', _warm_last_station),
+                                      ('lcd', lcd.init),
+                                      ('gpio', ButtonPanel.setup))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+
+    dispatcher.subscribe(Event.PLAYBACK_RESTART, _first_audio)
+    metrics.start_export()
+    control.start()
+    resolver.refresh(catalog.get(station_id).url for station_id in catalog.ids[:Config.RESOLVER_PRELOAD])
+    prober.start()
+    MILESTONES['ready'] = process_age()
+    LOG.info("Startup stages: %s", ", ".join(f"{name} {duration:.3f}s" for name, duration in STAGES.items()))
+    LOG.info("Radio ready %.3fs after process start (imports %.3fs)", MILESTONES['ready'], MILESTONES['imports'])
+
+    if Config.RESUME_ON_BOOT:
+        Radio.start()
+
+
+def _load_catalog():
+    """Load the station catalog and put the saved favourites first"""
+    catalog.load(Config.CATALOG)
+    favourites = store.get('favourites')
+    if favourites:
+        catalog.set_favourites(favourites)
+
+
+def _stage(name: str, function: Callable, errors: List[BaseException] = None):
+    """
+    Run and time a stage
+    @param name: stage name
+    @param function: callable
+    @param errors: list to collect the exception of a stage running in a thread. None -> raise
+    """
+    start = monotonic()
+    try:
+        function()
+    except BaseException as err:  # pylint: disable=broad-except
+        LOG.exception("Startup stage '%s' failed", name)
+        if errors is None:
+            raise
+        errors.append(err)
+    finally:
+        STAGES[name] = monotonic() - start
+        metrics.observe('startup_stage_seconds', STAGES[name], stage=name)
+
+
+def _warm_last_station():
+    """Open the connection to the last played station while the other stages run"""
+    if Config.PREFETCH:
+        prefetcher.warm([resolver.lookup(selector.select(Radio.station).url)])
+        dispatcher.call_later(Config.PREFETCH_TTL, prefetcher.expire)
+
+
+def _first_audio():
+    """Handler for the first 'playback-restart' event"""
+    if 'first_audio' not in MILESTONES:
+        MILESTONES['first_audio'] = process_age()
+        metrics.set_gauge('startup_first_audio_seconds', MILESTONES['first_audio'])
+        LOG.info("First audio %.3fs after process start", MILESTONES['first_audio'])
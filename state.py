@@ -0,0 +1,151 @@
+"""
+Persistent radio state: last station, volume, favourites and per-station stats.
+The state is kept in memory. Changes are coalesced and written behind by a background thread, at most
+Config.STATE_WRITES_PER_HOUR times per hour, so the tuning path never waits for the sd card and a radio that switches
+stations often doesn't wear out the flash. The file is replaced atomically (write, fsync, rename) so a power cut leaves
+either the old or the new state.
+"""
+import json
+import logging
+import os
+from threading import Condition, Lock
+from time import monotonic, time
+from typing import Any, Dict, Optional, Tuple
+
+from config import Config
+from metrics import metrics
+from write_behind import WriteBehind
+
+LOG = logging.getLogger(__name__)
+
+DEFAULTS = {'station': None, 'volume': None, 'favourites': [], 'stats': {}}
+
+
+class StateStore:
+    """Radio state saved in a json file"""
+    def __init__(self, filename: str):
+        self._filename = filename
+        self._data: Dict[str, Any] = json.loads(json.dumps(DEFAULTS))
+        self._cond = Condition()
+        self._write_lock = Lock()
+        self._dirty_since: Optional[float] = None  # monotonic time of the oldest unsaved change
+        self._version = 0  # incremented by every change
+        self._last_write = float('-inf')
+        self._writer = WriteBehind("state_writer", self._cond, self._due, self._take_changes, self._write)
+        self._load()
+
+    def get(self, key: str, default=None):
+        with self._cond:
+            value = self._data.get(key)
+        return default if value is None else value
+
+    def set(self, key: str, value):
+        """
+        Change a value. Returns immediately, the change is written later
+        @param key: 'station', 'volume', 'favourites', ...
+        @param value: json serializable value
+        """
+        with self._cond:
+            if self._data.get(key) == value:
+                return
+            self._data[key] = value
+            self._changed()
+
+    def station_stats(self, station_id: str) -> Dict[str, float]:
+        """
+        @param station_id: str
+        @return: copy of the stats of a station: plays, seconds, failures, last_played (timestamp)
+        """
+        with self._cond:
+            return dict(self._data['stats'].get(station_id, {}))
+
+    def add_stats(self, station_id: str, **increments: float):
+        """
+        Add to the stats of a station, e.g. add_stats(station.id, plays=1)
+        @param station_id: str
+        @param increments: stat name -> value to add
+        """
+        with self._cond:
+            stats = self._data['stats'].setdefault(station_id, {})
+            for name, value in increments.items():
+                stats[name] = stats.get(name, 0) + value
+            if increments.get('plays'):
+                stats['last_played'] = int(time())
+            self._changed()
+
+    def flush(self):
+        """Write the pending changes now, ignoring the write budget"""
+        self._writer.flush()
+
+    def close(self):
+        """Stop the writer thread and write the pending changes"""
+        self._writer.close()
+
+    def _changed(self):
+        """Mark the state dirty. Call with the lock held"""
+        if self._dirty_since is None:
+            self._dirty_since = monotonic()
+        self._version += 1
+        self._writer.changed()
+
+    def _due(self) -> Optional[float]:
+        """Config.STATE_DELAY after the first change, within the write budget. Call with the lock held"""
+        if self._dirty_since is None:
+            return None
+        return max(self._dirty_since + Config.STATE_DELAY, self._last_write + 3600 / Config.STATE_WRITES_PER_HOUR)
+
+    def _take_changes(self) -> Optional[Tuple[int, str]]:
+        """Serialize the state if it is dirty. Call with the lock held. The state stays dirty until it is written"""
+        if self._dirty_since is None:
+            return None
+        return self._version, json.dumps(self._data, indent=1)
+
+    def _write(self, changes: Tuple[int, str]):
+        version, data = changes
+        tmp = self._filename + '.tmp'
+        start = monotonic()
+        try:
+            with self._write_lock:
+                with open(tmp, 'w', encoding='utf-8') as file:
+                    file.write(data)
+                    file.flush()
+                    os.fsync(file.fileno())
+                os.replace(tmp, self._filename)
+                directory = os.open(os.path.dirname(os.path.abspath(self._filename)), os.O_RDONLY)
+                try:
+                    os.fsync(directory)
+                finally:
+                    os.close(directory)
+        except OSError as err:
+            LOG.warning("Cannot save state %s: %s", self._filename, err)
+            return  # still dirty: retried within the write budget
+        finally:
+            self._last_write = monotonic()
+        with self._cond:
+            if self._version == version:  # no change since the state was serialized
+                self._dirty_since = None
+        metrics.inc('state_writes_total')
+        metrics.observe('state_write_seconds', monotonic() - start)
+        LOG.debug("Saved state %s", self._filename)
+
+    def _load(self):
+        try:
+            with open(self._filename, 'r', encoding='utf-8') as file:
+                self._data.update(json.load(file))
+            LOG.debug("Loaded state %s", self._filename)
+        except FileNotFoundError:
+            self._load_saved_station()
+        except (ValueError, TypeError) as err:
+            LOG.warning("Ignoring corrupt state file %s: %s", self._filename, err)
+
+    def _load_saved_station(self):
+        """Import the station saved by older versions in Config.SAVED_STATION"""
+        try:
+            with open(Config.SAVED_STATION, 'r', encoding='utf-8') as file:
+                self._data['station'] = file.readline().strip() or None
+            LOG.info("Imported %s into %s", Config.SAVED_STATION, self._filename)
+        except OSError:
+            pass
+
+
+store = StateStore(Config.STATE_FILE)
@@ -0,0 +1,172 @@
+"""
+Stream health watchdog.
+Once a station is playing, the watchdog follows the mpv properties 'demuxer-cache-duration' and 'paused-for-cache' and
+the 'end-file' reasons:
+    the server closed the stream (end-file eof/error)             -> reconnect
+    playback paused for the cache for Config.WATCHDOG_STALL s     -> reconnect
+    cache didn't grow for Config.WATCHDOG_STALL s and is almost empty -> reconnect before the buffer runs dry
+The reconnects are spaced with a jittered exponential backoff. After Config.WATCHDOG_ATTEMPTS failed attempts the
+watchdog gives up. Every dropout and the seconds of audio lost are counted per station (metrics and station stats).
+All methods run in the dispatcher thread.
+"""
+import logging
+import random
+from time import monotonic
+from typing import Callable, Optional
+
+from config import Config
+from dispatcher import dispatcher, Timer
+from metrics import metrics
+from models.stations import Station
+from state import store
+
+LOG = logging.getLogger(__name__)
+
+
+class StreamWatchdog:
+    """Watch the playing stream and reconnect when it stalls or drops"""
+    def __init__(self, reconnect: Callable[[], None], give_up: Callable[[str], None]):
+        """
+        @param reconnect: callback to play the station again without touching the lcd
+        @param give_up: callback(reason) when reconnecting failed
+        """
+        self._reconnect = reconnect
+        self._give_up = give_up
+        self._station: Optional[Station] = None
+        self._cache: Optional[float] = None  # seconds in the demuxer cache
+        self._cache_grown = 0.0  # last time the cache grew
+        self._dropout: Optional[float] = None  # start of the current dropout
+        self._silent_since: Optional[float] = None  # start of the audio gap of the current dropout
+        self._attempt = 0
+        self._reconnecting = False
+        self._check_timer: Optional[Timer] = None
+        self._reconnect_timer: Optional[Timer] = None
+
+    @property
+    def reconnecting(self) -> bool:
+        return self._reconnecting
+
+    def start(self, station: Station):
+        """Watch the stream of station, which just started playing"""
+        self.stop()
+        self._station = station
+        self._cache_grown = monotonic()
+        self._check_timer = dispatcher.call_later(Config.WATCHDOG_INTERVAL, self._check)
+
+    def stop(self):
+        """Stop watching, e.g. because another station is tuned"""
+        for timer in (self._check_timer, self._reconnect_timer):
+            if timer is not None:
+                timer.cancel()
+        self._check_timer = self._reconnect_timer = None
+        self._station = None
+        self._cache = None
+        self._dropout = self._silent_since = None
+        self._attempt = 0
+        self._reconnecting = False
+
+    def on_cache_duration(self, seconds: Optional[float]):
+        """Handler for changes of the mpv 'demuxer-cache-duration' property"""
+        if seconds is None or self._station is None:
+            return
+        if self._cache is None or seconds > self._cache:
+            self._cache_grown = monotonic()
+        self._cache = seconds
+
+    def on_paused_for_cache(self, paused: bool):
+        """Handler for changes of the mpv 'paused-for-cache' property"""
+        if self._station is None or self._reconnecting:
+            return
+        if paused:
+            self._start_dropout()
+            self._silent_since = self._silent_since or monotonic()
+        elif self._dropout is not None:
+            self._recovered()  # mpv refilled the cache by itself
+
+    def on_end_file(self, reason: str):
+        """Handler for the 'end-file' event of the playing stream (or of a reconnect attempt)"""
+        if self._station is None or reason not in ('eof', 'error'):
+            return
+        self._start_dropout()
+        self._silent_since = self._silent_since or monotonic()
+        if self._reconnect_timer is None:
+            self._schedule_reconnect(f"end-file {reason}")
+
+    def on_playback_restart(self):
+        """Handler for the 'playback-restart' event during a reconnect"""
+        if self._reconnecting:
+            self._recovered()
+
+    def restart(self):
+        """Replace the playing stream on purpose, e.g. with another variant. Not counted as dropout"""
+        if self._station is None:
+            return
+        if self._reconnect_timer is not None:
+            self._reconnect_timer.cancel()
+        self._reconnecting = True
+        self._reconnect_timer = dispatcher.call_later(Config.WATCHDOG_CONNECT_TIMEOUT, self._attempt_timeout)
+        self._reconnect()
+
+    def _check(self):
+        """Look for a stalled stream every Config.WATCHDOG_INTERVAL seconds"""
+        self._check_timer = dispatcher.call_later(Config.WATCHDOG_INTERVAL, self._check)
+        if self._reconnecting:
+            return
+
+        now = monotonic()
+        if self._silent_since is not None and now - self._silent_since >= Config.WATCHDOG_STALL:
+            self._schedule_reconnect("paused for cache")
+        elif (self._cache is not None and self._cache <= Config.WATCHDOG_LOW_CACHE
+              and now - self._cache_grown >= Config.WATCHDOG_STALL):
+            self._start_dropout()
+            self._schedule_reconnect(f"stalled, {self._cache:.1f}s in cache")
+
+    def _start_dropout(self):
+        if self._dropout is None:
+            self._dropout = monotonic()
+
+    def _schedule_reconnect(self, reason: str):
+        """Reconnect after a jittered exponential backoff, or give up"""
+        if self._attempt >= Config.WATCHDOG_ATTEMPTS:
+            LOG.error("Stream lost (%s): %s", reason, self._station.name)
+            self._count_dropout()
+            self.stop()
+            self._give_up(reason)
+            return
+
+        delay = min(Config.WATCHDOG_BACKOFF_MAX, Config.WATCHDOG_BACKOFF * 2 ** self._attempt)
+        delay *= random.uniform(0.5, 1.0)
+        self._attempt += 1
+        self._reconnecting = True
+        LOG.warning("Stream %s (%s). Reconnect attempt %s in %.2fs", self._station.name, reason, self._attempt, delay)
+        self._reconnect_timer = dispatcher.call_later(delay, self._reconnect_now)
+
+    def _reconnect_now(self):
+        # the audio stops when the stream is replaced
+        self._silent_since = self._silent_since or monotonic()
+        metrics.inc('stream_reconnects_total', station=self._station.name)
+        self._reconnect_timer = dispatcher.call_later(Config.WATCHDOG_CONNECT_TIMEOUT, self._attempt_timeout)
+        self._reconnect()
+
+    def _attempt_timeout(self):
+        self._reconnect_timer = None
+        self._schedule_reconnect("reconnect timeout")
+
+    def _recovered(self):
+        if self._reconnect_timer is not None:
+            self._reconnect_timer.cancel()
+            self._reconnect_timer = None
+        if self._dropout is not None:
+            LOG.info("Stream %s recovered after %.1fs", self._station.name, monotonic() - self._dropout)
+            self._count_dropout()
+        self._dropout = self._silent_since = None
+        self._cache = None
+        self._cache_grown = monotonic()
+        self._attempt = 0
+        self._reconnecting = False
+
+    def _count_dropout(self):
+        lost = monotonic() - self._silent_since if self._silent_since is not None else 0.0
+        metrics.inc('stream_dropouts_total', station=self._station.name)
+        metrics.inc('stream_seconds_lost_total', lost, station=self._station.name)
+        store.add_stats(self._station.id, dropouts=1, seconds_lost=round(lost, 1))
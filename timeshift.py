@@ -0,0 +1,251 @@
+"""
+Timeshift buffer: pause and rewind live radio.
+The stream of the playing station is recorded into a fixed size ring file (Config.TIMESHIFT_FILE, on tmpfs by default)
+which is memory-mapped, so the buffer never uses more than Config.TIMESHIFT_SIZE bytes of memory. mpv doesn't play the
+station url but the python stream 'python://timeshift', which reads the ring file from a read position:
+    live        the read position follows the recording
+    pause       mpv is paused, the recording goes on
+    rewind      the read position moves back in the recording (at most Config.TIMESHIFT_SIZE bytes)
+    jump live   the read position moves to the end of the recording
+The recorded audio is addressed by offsets counted since the start of the recording, offset % size is the position in
+the ring file. Reads take a memoryview of the map (no copy), only the chunk handed over to mpv is copied.
+The icy titles are recorded with their offset and passed on when the read position reaches them, so a rewound
+programme shows its own titles.
+"""
+import bisect
+import logging
+import mmap
+import os
+from collections import deque
+from threading import Condition, Thread
+from time import monotonic
+from typing import Callable, Deque, Iterator, List, Optional, Tuple
+
+from config import Config
+from metrics import metrics
+from prefetch import WarmStream
+
+LOG = logging.getLogger(__name__)
+
+CHUNK_SIZE = 4096
+MARK_INTERVAL = 1.0  # seconds between two (time, offset) marks of the recording
+DEFAULT_RATE = 128 * 1000 / 8  # bytes per second until the rate of the recording is measured
+
+
+class RingFile:
+    """Memory-mapped ring of bytes with a fixed size. Not thread safe"""
+    def __init__(self, filename: str, size: int):
+        """
+        @param filename: str, the file is created or truncated to size
+        @param size: int, bytes
+        """
+        self.size = size
+        fd = os.open(filename, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            os.ftruncate(fd, size)
+            self._map = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+        self._view = memoryview(self._map)
+        self.start = 0  # offset of the first byte of the recording
+        self.written = 0  # offset of the end of the recording
+
+    @property
+    def oldest(self) -> int:
+        """Offset of the oldest byte which isn't overwritten yet"""
+        return max(self.start, self.written - self.size)
+
+    def append(self, data: bytes):
+        """Add data at the end, overwriting the oldest bytes. Of data longer than the ring only the tail is kept"""
+        skipped = max(0, len(data) - self.size)
+        self.written += skipped  # the skipped head is overwritten at once
+        data = memoryview(data)[skipped:]
+        position = self.written % self.size
+        first = min(len(data), self.size - position)
+        self._view[position:position + first] = data[:first]
+        self._view[:len(data) - first] = data[first:]
+        self.written += len(data)
+
+    def view(self, offset: int, length: int) -> memoryview:
+        """
+        @param offset: int, between oldest and written
+        @param length: int, max bytes
+        @return: memoryview of the map with at most length bytes from offset. Shorter at the end of the file
+        """
+        position = offset % self.size
+        length = min(length, self.written - offset, self.size - position)
+        return self._view[position:position + length]
+
+    def reset(self):
+        """Forget the recorded bytes"""
+        self.start = self.written
+
+    def close(self):
+        self._view.release()
+        self._map.close()
+
+
+class Timeshift:
+    """Record the playing station into the ring file and play the recording from a read position"""
+    def __init__(self):
+        self.on_title: Optional[Callable[[str], None]] = None  # called with the title at the read position
+        self._ring: Optional[RingFile] = None
+        self._cond = Condition()
+        self._url: Optional[str] = None
+        self._source: Optional[WarmStream] = None
+        self._finished = False  # the source ended
+        self._position = 0  # offset of the next chunk for mpv
+        self._generation = 0  # incremented to end the reading generator
+        self._marks: Deque[Tuple[float, int]] = deque(maxlen=60)
+        self._titles: List[Tuple[int, str]] = []  # (offset, title) in order of offset
+        self._title: Optional[str] = None  # title passed to on_title
+
+    @property
+    def delay(self) -> float:
+        """Seconds between the read position and the end of the recording"""
+        with self._cond:
+            if self._ring is None:
+                return 0.0
+            return (self._ring.written - self._position) / self._rate()
+
+    def record(self, url: str, source: WarmStream):
+        """
+        Record source, which is connected to url. The recording of another url is dropped, a recording of the same url
+        (reconnect) goes on
+        @param url: str
+        @param source: WarmStream, owned by the timeshift from now on
+        """
+        with self._cond:
+            if self._ring is None:
+                self._ring = RingFile(Config.TIMESHIFT_FILE, Config.TIMESHIFT_SIZE)
+            if self._source is not None:
+                self._source.close()
+            if url != self._url:
+                self._ring.reset()
+                self._marks.clear()
+                self._titles.clear()
+                self._title = None
+                self._position = self._ring.written
+            self._url = url
+            self._source = source
+            self._finished = False
+            self._interrupt()
+        source.on_title = lambda title: self._add_title(source, title)
+        if source.title:
+            self._add_title(source, source.title)
+        Thread(target=self._record, args=(source,), name="timeshift", daemon=True).start()
+
+    def seek(self, seconds: float) -> float:
+        """
+        Move the read position
+        @param seconds: float, negative -> back in time
+        @return: the delay at the new position
+        """
+        with self._cond:
+            if self._ring is None:
+                return 0.0
+            offset = self._position + int(seconds * self._rate())
+            self._position = min(max(offset, self._ring.oldest), self._ring.written)
+            self._interrupt()
+        return self.delay
+
+    def live(self):
+        """Move the read position to the end of the recording"""
+        with self._cond:
+            if self._ring is not None:
+                self._position = self._ring.written
+            self._interrupt()
+
+    def stop(self):
+        """Stop recording and reading. The ring file is kept for the next recording"""
+        with self._cond:
+            if self._source is not None:
+                self._source.close()
+                self._source = None
+            self._url = None
+            self._interrupt()
+
+    def close(self):
+        """Stop and remove the ring file"""
+        self.stop()
+        with self._cond:
+            if self._ring is not None:
+                self._ring.close()
+                self._ring = None
+                try:
+                    os.unlink(Config.TIMESHIFT_FILE)
+                except OSError:
+                    pass
+
+    def chunks(self) -> Iterator[bytes]:
+        """Yield the recording from the read position. Generator for mpv.python_stream, one per mpv stream"""
+        with self._cond:
+            self._generation += 1
+            generation = self._generation
+            self._cond.notify_all()
+
+        while True:
+            with self._cond:
+                while (generation == self._generation and self._ring is not None
+                       and self._position >= self._ring.written and not self._finished):
+                    self._cond.wait()
+                if generation != self._generation or self._ring is None or self._position >= self._ring.written:
+                    return
+                if self._position < self._ring.oldest:
+                    LOG.warning("Timeshift read position overwritten, skip %s bytes",
+                                self._ring.oldest - self._position)
+                    self._position = self._ring.oldest
+                chunk = bytes(self._ring.view(self._position, CHUNK_SIZE))
+                self._position += len(chunk)
+                title = self._title_at(self._position)
+            if title is not None and title != self._title:
+                self._title = title
+                if self.on_title is not None:
+                    self.on_title(title)
+            yield chunk
+
+    def _interrupt(self):
+        """End the reading generator, e.g. before mpv opens the stream at another position. Hold the lock"""
+        self._generation += 1
+        self._cond.notify_all()
+
+    def _rate(self) -> float:
+        """Bytes per second of the recording. Hold the lock"""
+        if len(self._marks) < 2:
+            return DEFAULT_RATE
+        (start, first), (end, last) = self._marks[0], self._marks[-1]
+        return (last - first) / (end - start) if end > start and last > first else DEFAULT_RATE
+
+    def _record(self, source: WarmStream):
+        """Recording thread: append the audio of source until it ends or another source is recorded"""
+        for chunk in source.chunks():
+            with self._cond:
+                if source is not self._source:
+                    return
+                self._ring.append(chunk)
+                now = monotonic()
+                if not self._marks or now - self._marks[-1][0] >= MARK_INTERVAL:
+                    self._marks.append((now, self._ring.written))
+                    while self._titles[1:] and self._titles[1][0] <= self._ring.oldest:
+                        self._titles.pop(0)  # the first title is the title at the oldest offset
+                self._cond.notify_all()
+            metrics.inc('timeshift_bytes_total', len(chunk))
+
+        with self._cond:
+            if source is self._source:
+                LOG.debug("Timeshift source ended: %s", source.url)
+                self._finished = True
+                self._cond.notify_all()
+
+    def _add_title(self, source: WarmStream, title: str):
+        with self._cond:
+            if source is self._source:
+                self._titles.append((self._ring.written, title))
+
+    def _title_at(self, offset: int) -> Optional[str]:
+        """Title at offset. Hold the lock"""
+        index = bisect.bisect_right(self._titles, (offset, chr(0x10FFFF)))
+        return self._titles[index - 1][1] if index else None
+
+
+timeshift = Timeshift()
@@ -0,0 +1,160 @@
+"""
+Adaptive choice between the stream variants of a station (Station.variants, best first).
+The selector measures the throughput of the playing stream (mpv 'cache-speed') and the rebuffer events
+('paused-for-cache') and moves one variant down when the stream doesn't keep up:
+    the throughput stayed below Config.ABR_MIN_RATIO x the bitrate for Config.ABR_SLOW seconds
+    Config.ABR_REBUFFERS rebuffer events within Config.ABR_WINDOW seconds
+After Config.ABR_PROBE_AFTER seconds without problems it probes one variant up. A probe which has to move down again
+doubles the time before the next probe of the station (up to Config.ABR_PROBE_MAX).
+The chosen variant of every station is kept in the state store, so the radio starts with a variant that keeps up.
+All methods run in the dispatcher thread.
+"""
+import logging
+from collections import deque
+from time import monotonic
+from typing import Deque, Dict, Optional
+
+from config import Config
+from metrics import metrics
+from models.stations import Station, Variant
+from state import store
+
+LOG = logging.getLogger(__name__)
+
+
+class VariantSelector:
+    """Choose the variant to play and switch while playing"""
+    def __init__(self):
+        self._probe_after: Dict[str, float] = {}  # station id -> seconds before probing up
+        self._station: Optional[Station] = None
+        self._level = 0  # index in station.variants
+        self._since = 0.0  # playing the current level since
+        self._upswitched = False  # the current level is a probe
+        self._rebuffers: Deque[float] = deque()
+        self._slow_since: Optional[float] = None
+        self._throughput: Optional[float] = None  # smoothed kbit/s
+
+    @property
+    def throughput(self) -> Optional[float]:
+        """Smoothed throughput of the playing stream in kbit/s"""
+        return self._throughput
+
+    def select(self, station: Station) -> Variant:
+        """
+        @param station: Station
+        @return: the variant to play: the last one that kept up
+        """
+        return station.variants[self._saved_level(station)]
+
+    def failed(self, station: Station, variant: Variant) -> Optional[Variant]:
+        """
+        A variant didn't start playing
+        @return: the next variant to try or None when there is none left
+        """
+        level = station.variants.index(variant) + 1
+        if level >= len(station.variants):
+            self._save_level(station, 0)  # the station is down, start from the best variant next time
+            return None
+        self._save_level(station, level)
+        return station.variants[level]
+
+    def start(self, station: Station, variant: Variant):
+        """The variant of station is playing (again)"""
+        level = station.variants.index(variant)
+        if station is self._station and level == self._level:
+            return  # reconnected to the same variant, keep the measurements
+        self._station = station
+        self._level = level
+        self._since = monotonic()
+        self._rebuffers.clear()
+        self._slow_since = None
+        self._throughput = None
+
+    def stop(self):
+        self._station = None
+        self._upswitched = False
+
+    def on_rebuffer(self, paused: bool) -> Optional[Variant]:
+        """
+        Handler for changes of 'paused-for-cache'
+        @return: variant to switch to, or None
+        """
+        if self._station is None or not paused:
+            return None
+
+        now = monotonic()
+        self._rebuffers.append(now)
+        while self._rebuffers and now - self._rebuffers[0] > Config.ABR_WINDOW:
+            self._rebuffers.popleft()
+        if len(self._rebuffers) >= Config.ABR_REBUFFERS:
+            return self._switch(1, f"{len(self._rebuffers)} rebuffers")
+        return None
+
+    def on_throughput(self, bytes_per_second: Optional[float]) -> Optional[Variant]:
+        """
+        Handler for changes of 'cache-speed'
+        @return: variant to switch to, or None
+        """
+        if self._station is None or bytes_per_second is None:
+            return None
+
+        kbps = bytes_per_second * 8 / 1000
+        if self._throughput is None:
+            self._throughput = kbps
+        else:
+            self._throughput += Config.ABR_SMOOTHING * (kbps - self._throughput)
+
+        now = monotonic()
+        bitrate = self._station.variants[self._level].bitrate
+        if bitrate and self._throughput < bitrate * Config.ABR_MIN_RATIO:
+            if self._slow_since is None:
+                self._slow_since = now
+            elif now - self._slow_since >= Config.ABR_SLOW:
+                return self._switch(1, f"{self._throughput:.0f} kbit/s")
+        else:
+            self._slow_since = None
+
+        if self._level > 0 and now - self._since >= self._probe_interval():
+            return self._switch(-1, "probe")
+        return None
+
+    def _probe_interval(self) -> float:
+        return self._probe_after.get(self._station.id, Config.ABR_PROBE_AFTER)
+
+    def _switch(self, step: int, reason: str) -> Optional[Variant]:
+        """Move step variants down (> 0) or up (< 0)"""
+        level = min(max(self._level + step, 0), len(self._station.variants) - 1)
+        if level == self._level:
+            return None
+
+        station = self._station
+        if step > 0 and self._upswitched and monotonic() - self._since < self._probe_interval():
+            # the probe failed, wait longer for the next one
+            self._probe_after[station.id] = min(self._probe_interval() * 2, Config.ABR_PROBE_MAX)
+        elif step > 0:
+            self._probe_after.pop(station.id, None)
+        self._upswitched = step < 0
+
+        variant = station.variants[level]
+        LOG.info("Switch %s to %s kbit/s %s (%s)", station.name, variant.bitrate, variant.codec, reason)
+        metrics.inc('variant_switches_total', station=station.name, direction='down' if step > 0 else 'up')
+        self._save_level(station, level)
+        self.start(station, variant)
+        return variant
+
+    @staticmethod
+    def _saved_level(station: Station) -> int:
+        level = store.get('variants', {}).get(station.id, 0)
+        return min(level, len(station.variants) - 1)
+
+    @staticmethod
+    def _save_level(station: Station, level: int):
+        levels = dict(store.get('variants', {}))
+        if level:
+            levels[station.id] = level
+        else:
+            levels.pop(station.id, None)
+        store.set('variants', levels)
+
+
+selector = VariantSelector()
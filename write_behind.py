@@ -0,0 +1,69 @@
+"""
+Write-behind thread for data kept in memory and saved to a file later, e.g. the radio state and the title history.
+The owner changes its data holding its condition and calls changed(). The thread is started by the first change. It
+sleeps until the pending changes are due, takes them holding the condition and writes them without it, so the callers
+never wait for the sd card.
+"""
+from threading import Condition, Thread
+from time import monotonic
+from typing import Any, Callable, Optional
+
+
+class WriteBehind:
+    """Thread which writes the pending changes of its owner when they are due"""
+    def __init__(self, name: str, cond: Condition, due: Callable[[], Optional[float]], take: Callable[[], Any],
+                 write: Callable[[Any], None]):
+        """
+        @param name: thread name
+        @param cond: condition of the owner, held while the data changes
+        @param due: monotonic time the pending changes are due, None when nothing is pending. Called holding cond
+        @param take: the pending changes, None when there are none. Called holding cond
+        @param write: write the result of take(). Called without cond
+        """
+        self._name = name
+        self._cond = cond
+        self._due = due
+        self._take = take
+        self._write = write
+        self._thread: Optional[Thread] = None
+        self.closed = False
+
+    def changed(self):
+        """Wake up the thread, start it on the first change. Call holding cond"""
+        if self._thread is None and not self.closed:
+            self._thread = Thread(target=self._run, name=self._name, daemon=True)
+            self._thread.start()
+        self._cond.notify_all()
+
+    def flush(self):
+        """Write the pending changes now in the calling thread"""
+        with self._cond:
+            changes = self._take()
+        if changes is not None:
+            self._write(changes)
+
+    def close(self):
+        """Stop the thread and write the pending changes"""
+        with self._cond:
+            self.closed = True
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+        self.flush()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self.closed:
+                    due = self._due()
+                    if due is None:
+                        self._cond.wait()
+                        continue
+                    if monotonic() >= due:
+                        break
+                    self._cond.wait(due - monotonic())
+                if self.closed:
+                    return
+                changes = self._take()
+            if changes is not None:
+                self._write(changes)